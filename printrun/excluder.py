@@ -52,7 +52,6 @@ class ExcluderWindow(gviz.GvizWindow):
                 self.basetrans = self.p.translate
             self.p.translate = [self.basetrans[0] + (e[0] - self.initpos[0]),
                                 self.basetrans[1] + (e[1] - self.initpos[1])]
-            self.p.dirty = 1
             wx.CallAfter(self.p.Refresh)
         elif event.Dragging() and event.LeftIsDown():
             x, y = event.GetPositionTuple()
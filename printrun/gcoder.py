@@ -20,6 +20,9 @@ import math
 import datetime
 import logging
 from array import array
+from bisect import bisect_left, bisect_right
+
+import numpy
 
 gcode_parsed_args = ["x", "y", "e", "f", "z", "i", "j"]
 gcode_parsed_nonargs = ["g", "t", "m", "n"]
@@ -29,6 +32,11 @@ gcode_strip_comment_exp = re.compile("\([^\(\)]*\)|;.*|[/\*].*\n")
 m114_exp = re.compile("\([^\(\)]*\)|[/\*].*\n|([XYZ]):?([-+]?[0-9]*\.?[0-9]*)")
 specific_exp = "(?:\([^\(\)]*\))|(?:;.*)|(?:[/\*].*\n)|(%s[-+]?[0-9]*\.?[0-9]*)"
 move_gcodes = ["G0", "G1", "G2", "G3"]
+# Extruding moves which lift Z by less than this fraction of the layer height
+# are taken for spiral (vase mode) printing rather than for layer changes
+vase_mode_max_rise = 0.25
+# Tolerance of the Z comparisons done while segmenting layers
+z_epsilon = 1e-6
 
 class PyLine(object):
 
@@ -100,6 +108,187 @@ def parse_coordinates(line, split_raw, imperial = False, force = False):
         if code not in gcode_parsed_nonargs and bit[1]:
             setattr(line, code, unit_factor * float(bit[1]))
 
+def arc_sweep(x0, y0, x1, y1, i, j, clockwise):
+    """Signed angle (in radians, negative when clockwise) swept by an arc going
+    from (x0, y0) to (x1, y1) around (x0 + i, y0 + j). An arc ending where it
+    starts is a full circle."""
+    # Angle between the center-to-start and center-to-end vectors, computed
+    # from their cross and dot products to be immune to -0. issues
+    ex = x1 - x0 - i
+    ey = y1 - y0 - j
+    sweep = math.atan2(j * ex - i * ey, - i * ex - j * ey)
+    if clockwise:
+        if sweep >= 0: sweep -= 2 * math.pi
+    elif sweep <= 0:
+        sweep += 2 * math.pi
+    return sweep
+
+def arc_length(x0, y0, x1, y1, i, j, clockwise, dz = 0):
+    """Length of an arc (helical if dz is not 0), see arc_sweep"""
+    sweep = arc_sweep(x0, y0, x1, y1, i, j, clockwise)
+    return math.hypot(math.hypot(i, j) * sweep, dz)
+
+# Vectorized versions of the above for arrays of arcs
+
+def arc_sweeps(x0, y0, x1, y1, i, j, clockwise):
+    ex = x1 - x0 - i
+    ey = y1 - y0 - j
+    sweeps = numpy.arctan2(j * ex - i * ey, - i * ex - j * ey)
+    sweeps[clockwise & (sweeps >= 0)] -= 2 * math.pi
+    sweeps[~clockwise & (sweeps <= 0)] += 2 * math.pi
+    return sweeps
+
+def arc_lengths(x0, y0, z0, x1, y1, z1, i, j, clockwise):
+    sweeps = arc_sweeps(x0, y0, x1, y1, i, j, clockwise)
+    return numpy.hypot(numpy.hypot(i, j) * sweeps, z1 - z0)
+
+def arc_bboxes(x0, y0, x1, y1, i, j, clockwise):
+    """XY bounding boxes of arcs, as an array of (xmin, xmax, ymin, ymax)
+    rows: an arc goes beyond its endpoints wherever it crosses one of the
+    axes going through its center"""
+    start = numpy.arctan2(-j, -i)
+    sweeps = arc_sweeps(x0, y0, x1, y1, i, j, clockwise)
+    radius = numpy.hypot(i, j)
+    cx = x0 + i
+    cy = y0 + j
+    bboxes = numpy.column_stack((numpy.minimum(x0, x1), numpy.maximum(x0, x1),
+                                 numpy.minimum(y0, y1), numpy.maximum(y0, y1)))
+    # Angle of the extremum, column of the bbox, center and radius sign
+    for angle, column, center, sign in ((0, 1, cx, 1),
+                                        (math.pi / 2, 3, cy, 1),
+                                        (math.pi, 0, cx, -1),
+                                        (3 * math.pi / 2, 2, cy, -1)):
+        # Angle to travel from the start to reach the extremum
+        travel = numpy.where(clockwise, start - angle, angle - start)
+        crossed = numpy.mod(travel, 2 * math.pi) <= numpy.abs(sweeps)
+        bboxes[crossed, column] = center[crossed] + sign * radius[crossed]
+    return bboxes
+
+def tessellate_arcs(x0, y0, z0, x1, y1, z1, i, j, clockwise, tolerance):
+    """Split arcs into polylines whose segments deviate at most by
+    tolerance from the true arcs. Returns the (N, 3) array of polyline
+    points, starting points excluded, and the array of the offsets of each
+    arc's first point in it (plus the final number of points)."""
+    start = numpy.arctan2(-j, -i)
+    sweeps = arc_sweeps(x0, y0, x1, y1, i, j, clockwise)
+    radius = numpy.hypot(i, j)
+    # Largest angle whose chord stays within tolerance of the arc
+    max_steps = 2 * numpy.arccos(1 - tolerance / numpy.maximum(radius, tolerance))
+    counts = numpy.maximum(1, numpy.ceil(numpy.abs(sweeps) / max_steps)).astype(numpy.intp)
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+    arc_of_point = numpy.repeat(numpy.arange(len(counts)), counts)
+    t = (numpy.arange(offsets[-1]) - offsets[arc_of_point] + 1.) / counts[arc_of_point]
+    angles = start[arc_of_point] + sweeps[arc_of_point] * t
+    points = numpy.empty((offsets[-1], 3))
+    points[:, 0] = x0[arc_of_point] + i[arc_of_point] + radius[arc_of_point] * numpy.cos(angles)
+    points[:, 1] = y0[arc_of_point] + j[arc_of_point] + radius[arc_of_point] * numpy.sin(angles)
+    points[:, 2] = z0[arc_of_point] + (z1 - z0)[arc_of_point] * t
+    # Make sure polylines end exactly on the arc endpoints
+    last = offsets[1:] - 1
+    points[last, 0] = x1
+    points[last, 1] = y1
+    points[last, 2] = z1
+    return points, offsets
+
+def expand_changes(change_moves, values, count, dtype):
+    """Per-move array of a value recorded as (index of the first move using
+    it, value) pairs in the change_moves and values arrays"""
+    change_moves = numpy.frombuffer(change_moves, dtype = numpy.uint32)
+    repeats = numpy.diff(numpy.append(change_moves, count).astype(numpy.intp))
+    return numpy.repeat(numpy.frombuffer(values, dtype = dtype), repeats)
+
+class GCodeState(object):
+    """Modal machine state right before a given G-Code line"""
+
+    __slots__ = ("imperial", "relative", "relative_e", "current_tool",
+                 "current_x", "current_y", "current_z", "current_e",
+                 "offset_x", "offset_y", "offset_z", "offset_e",
+                 "current_f", "extruder_temps", "bed_temp", "fan_speed")
+
+    def __init__(self, imperial, relative, relative_e, current_tool,
+                 current_x, current_y, current_z, current_e,
+                 offset_x, offset_y, offset_z, offset_e,
+                 current_f, extruder_temps, bed_temp, fan_speed):
+        self.imperial = imperial
+        self.relative = relative
+        self.relative_e = relative_e
+        self.current_tool = current_tool
+        self.current_x = current_x
+        self.current_y = current_y
+        self.current_z = current_z
+        self.current_e = current_e
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.offset_z = offset_z
+        self.offset_e = offset_e
+        self.current_f = current_f
+        # Tuple of last target temperatures indexed by tool number
+        self.extruder_temps = extruder_temps
+        self.bed_temp = bed_temp
+        self.fan_speed = fan_speed
+
+    def _get_abs_pos(self):
+        return (self.current_x - self.offset_x,
+                self.current_y - self.offset_y,
+                self.current_z - self.offset_z)
+    abs_pos = property(_get_abs_pos)
+
+    def _get_abs_e(self):
+        return self.current_e - self.offset_e
+    abs_e = property(_get_abs_e)
+
+def set_tool_temp(temps, tool, temp):
+    """Return a copy of the temps tuple with the given tool temp updated"""
+    if tool >= len(temps):
+        temps += (None,) * (tool + 1 - len(temps))
+    return temps[:tool] + (temp,) + temps[tool + 1:]
+
+def resume_preamble(state, home = True, wait = True):
+    """Build the commands restoring the machine to the given state, so that
+    printing can resume right where the state was recorded. The Z axis is
+    never homed, as the nozzle would crash into the partial print; its
+    position is instead set to the recorded one."""
+    commands = []
+    if state.bed_temp:
+        commands.append("M140 S%g" % state.bed_temp)
+    tool_temps = [(tool, temp) for tool, temp in enumerate(state.extruder_temps)
+                  if temp]
+    for tool, temp in tool_temps:
+        commands.append("M104 T%d S%g" % (tool, temp))
+    if wait:
+        if state.bed_temp:
+            commands.append("M190 S%g" % state.bed_temp)
+        for tool, temp in tool_temps:
+            commands.append("M109 T%d S%g" % (tool, temp))
+    commands.append("T%d" % state.current_tool)
+    # Positions are stored in mm, switch to imperial units only at the end
+    commands.append("G21")
+    commands.append("G90")
+    abs_x, abs_y, abs_z = state.abs_pos
+    commands.append("G92 Z%.5f" % abs_z)
+    if home:
+        # Homing resets the coordinate offsets, go back to the machine
+        # position and restore the offsets afterwards
+        commands.append("G28 X Y")
+        commands.append("G1 X%.5f Y%.5f" % (state.current_x, state.current_y))
+        if state.offset_x or state.offset_y:
+            commands.append("G92 X%.5f Y%.5f" % (abs_x, abs_y))
+    else:
+        commands.append("G1 X%.5f Y%.5f" % (abs_x, abs_y))
+    commands.append("G92 E%.5f" % state.abs_e)
+    if state.current_f:
+        commands.append("G1 F%g" % state.current_f)
+    if state.fan_speed:
+        commands.append("M106 S%g" % state.fan_speed)
+    else:
+        commands.append("M107")
+    if state.relative:
+        commands.append("G91")
+    commands.append("M83" if state.relative_e else "M82")
+    if state.imperial:
+        commands.append("G20")
+    return commands
+
 class Layer(list):
 
     __slots__ = ("duration", "z")
@@ -138,6 +327,10 @@ class GCode(object):
     max_e = 0
     # Current feedrate
     current_f = 0
+    # Last target temperatures (indexed by tool) and fan speed
+    extruder_temps = ()
+    bed_temp = None
+    fan_speed = None
     # Offset: current offset between the machine origin and the machine current
     # absolute coordinate system (as shifted by G92s)
     offset_x = 0
@@ -166,6 +359,56 @@ class GCode(object):
     height = None
 
     est_layer_height = None
+    # Z events: index of each line changing Z, the new Z, and whether it
+    # started a layer (as opposed to being part of a z-hop)
+    z_event_idxs = None
+    z_event_zs = None
+    z_event_layers = None
+
+    # Per-move arrays, filled while building layers: index of the move line,
+    # machine position, length of filament extruded, feedrate, tool and
+    # whether the move gives any coordinate
+    move_idxs = None
+    move_x = None
+    move_y = None
+    move_z = None
+    move_e = None
+    move_f = None
+    move_tool = None
+    move_xyz = None
+    # Revision and number of lines the per-move arrays were built for
+    move_arrays_revision = None
+    move_arrays_lines = None
+    # Arc moves: index in the move arrays, start position, center offset and
+    # direction
+    arc_moves = None
+    arc_x0 = None
+    arc_y0 = None
+    arc_z0 = None
+    arc_i = None
+    arc_j = None
+    arc_cw = None
+    # Distances covered by non-extruding and extruding moves
+    travel_distance = None
+    extrusion_distance = None
+
+    # Modal state checkpoints: checkpoints[k] is the state right before line
+    # checkpoint_idxs[k]. One is recorded at each layer start and at most
+    # every checkpoint_interval lines, so that state_at() never has to replay
+    # more than checkpoint_interval lines. Lower values trade memory (about
+    # 200 bytes per checkpoint) for faster lookups, 0 only keeps layer starts.
+    checkpoint_interval = 1000
+    checkpoints = None
+    checkpoint_idxs = None
+    # Indices of the layers printing something, and highest Z printed up to
+    # each of them, used to find layers by Z
+    printed_layers = None
+    printed_max_zs = None
+
+    # File the G-Code was read from, if any, and number of edits made to
+    # it since
+    filename = None
+    revision = 0
 
     # abs_x is the current absolute X in machine current coordinate system
     # (after the various G92 transformations) and can be used to store the
@@ -202,6 +445,21 @@ class GCode(object):
             self.home_x, self.home_y, self.home_z = home_pos
     home_pos = property(_get_home_pos, _set_home_pos)
 
+    def _get_state(self):
+        return GCodeState(self.imperial, self.relative, self.relative_e,
+                          self.current_tool,
+                          self.current_x, self.current_y, self.current_z,
+                          self.current_e,
+                          self.offset_x, self.offset_y, self.offset_z,
+                          self.offset_e,
+                          self.current_f, self.extruder_temps,
+                          self.bed_temp, self.fan_speed)
+
+    def _set_state(self, state):
+        for name in GCodeState.__slots__:
+            setattr(self, name, getattr(state, name))
+    state = property(_get_state, _set_state)
+
     def _get_layers_count(self):
         return len(self.all_zs)
     layers_count = property(_get_layers_count)
@@ -213,6 +471,7 @@ class GCode(object):
 
     def prepare(self, data = None, home_pos = None, layer_callback = None):
         self.home_pos = home_pos
+        self.filename = getattr(data, "name", None)
         if data:
             line_class = self.line_class
             self.lines = [line_class(l2) for l2 in
@@ -225,6 +484,10 @@ class GCode(object):
             self.append_layer_id = 0
             self.append_layer = Layer([])
             self.all_layers = [self.append_layer]
+            self.checkpoints = [self.state]
+            self.checkpoint_idxs = array('I', [0])
+            self.printed_layers = []
+            self.printed_max_zs = []
             self.all_zs = set()
             self.layers = {}
             self.layer_idxs = array('I', [])
@@ -263,6 +526,8 @@ class GCode(object):
             # Update indices arrays & global gcodes list
             self.layer_idxs.insert(end_index + i, layer_idx)
             self.line_idxs.insert(end_index + i, end_line + i + 1)
+        self._shift_checkpoints(start_index, start_index, len(commands))
+        self.revision += 1
         return commands[::-1]
 
     def rewrite_layer(self, commands, layer_idx):
@@ -281,6 +546,8 @@ class GCode(object):
         self.layer_idxs = self.layer_idxs[:start_index] + array('I', len(commands) * [layer_idx]) + self.layer_idxs[end_index:]
         self.line_idxs = self.line_idxs[:start_index] + array('I', range(len(commands))) + self.line_idxs[end_index:]
         del self.lines[start_index:end_index]
+        self._shift_checkpoints(start_index, end_index,
+                                len(commands) - (end_index - start_index))
         del layer[:]
         for i, command in enumerate(commands):
             gline = Line(command)
@@ -292,8 +559,25 @@ class GCode(object):
             layer.insert(0, gline)
             # Insert gline at beginning of list
             self.lines.insert(start_index, gline)
+        self.revision += 1
         return commands[::-1]
 
+    def _shift_checkpoints(self, start_index, end_index, delta):
+        """Move checkpoints after lines were inserted or removed, dropping
+        those which pointed inside the replaced [start_index, end_index]
+        range"""
+        checkpoints = []
+        checkpoint_idxs = array('I', [])
+        for state, idx in zip(self.checkpoints, self.checkpoint_idxs):
+            if idx > end_index:
+                idx += delta
+            elif idx > start_index:
+                continue
+            checkpoints.append(state)
+            checkpoint_idxs.append(idx)
+        self.checkpoints = checkpoints
+        self.checkpoint_idxs = checkpoint_idxs
+
     def append(self, command, store = True):
         command = command.strip()
         if not command:
@@ -319,9 +603,13 @@ class GCode(object):
         current_x = self.current_x
         current_y = self.current_y
         current_z = self.current_z
+        current_f = self.current_f
         offset_x = self.offset_x
         offset_y = self.offset_y
         offset_z = self.offset_z
+        extruder_temps = self.extruder_temps
+        bed_temp = self.bed_temp
+        fan_speed = self.fan_speed
 
         # Extrusion computation
         current_e = self.current_e
@@ -334,18 +622,27 @@ class GCode(object):
 
         # Initialize layers and other global computations
         if build_layers:
-            # Bounding box computation
-            xmin = float("inf")
-            ymin = float("inf")
+            # Bounding box and statistics are computed on these at the end
+            move_idxs = array('I')
+            move_x = array('d')
+            move_y = array('d')
+            move_z = array('d')
+            move_e = array('f')
+            move_xyz = array('B')
+            # Feedrate and tool only get recorded when they change, along
+            # with the index of the first move using them
+            f_moves = array('I', [0])
+            f_values = array('f', [current_f])
+            tool_moves = array('I', [0])
+            tool_values = array('H', [current_tool])
+            arc_moves = array('I')
+            arc_x0 = array('d')
+            arc_y0 = array('d')
+            arc_z0 = array('d')
+            arc_i = array('d')
+            arc_j = array('d')
+            arc_cw = array('B')
             zmin = 0
-            xmax = float("-inf")
-            ymax = float("-inf")
-            zmax = float("-inf")
-            # Also compute extrusion-only values
-            xmin_e = float("inf")
-            ymin_e = float("inf")
-            xmax_e = float("-inf")
-            ymax_e = float("-inf")
 
             # Duration estimation
             # TODO:
@@ -364,16 +661,45 @@ class GCode(object):
 
             # Initialize layers
             all_layers = self.all_layers = []
+            checkpoints = self.checkpoints = [self.state]
+            checkpoint_idxs = self.checkpoint_idxs = [0]
+            checkpoint_interval = self.checkpoint_interval or float("inf")
+            lines_since_checkpoint = 0
+            # State before the last line changing Z, which may start a layer
+            z_line_state = None
             all_zs = self.all_zs = set()
+            printed_layers = []
             layer_idxs = self.layer_idxs = []
             line_idxs = self.line_idxs = []
 
             layer_id = 0
             layer_line = 0
 
-            last_layer_z = None
+            # Layer segmentation: each line changing Z is recorded as a Z
+            # event. The lines following an event are only moved to a new
+            # layer once something gets printed at the new height. Until
+            # then they may just be a z-hop (lift Z on travel moves), which
+            # is folded back into the current layer once Z returns to it.
+            z_event_idxs = array('I')
+            z_event_zs = array('d')
+            z_event_layers = array('B')
+            layer_z = None
+            has_printed = False
+            # First line and Z event of the lines at another height than
+            # layer_z, with the duration and state right before them
+            pending_idx = None
+            pending_event = None
+            pending_duration = 0.0
+            pending_state = None
+            # Until something gets printed, Z events followed by horizontal
+            # moves are kept aside as (line index, Z event, duration, state,
+            # Z): they only make layers if the whole file never prints, as
+            # do milling files, as the start code would otherwise get split
+            # on its travel moves
+            travel_splits = []
+            travel_split = None
+            travel_z = None
             prev_z = None
-            prev_base_z = (None, None)
             cur_z = None
             cur_lines = []
 
@@ -382,6 +708,14 @@ class GCode(object):
         else:
             get_line = lambda l: l
         for true_line in lines:
+            if build_layers and lines_since_checkpoint >= checkpoint_interval:
+                checkpoints.append(GCodeState(
+                    imperial, relative, relative_e, current_tool,
+                    current_x, current_y, current_z, current_e,
+                    offset_x, offset_y, offset_z, offset_e,
+                    current_f, extruder_temps, bed_temp, fan_speed))
+                checkpoint_idxs.append(len(layer_idxs))
+                lines_since_checkpoint = 0
             # # Parse line
             # Use a heavy copy of the light line to preprocess
             line = get_line(true_line)
@@ -408,9 +742,35 @@ class GCode(object):
                     relative_e = True
                 elif line.command[0] == "T":
                     current_tool = int(line.command[1:])
+                    if build_layers:
+                        tool_moves.append(len(move_idxs))
+                        tool_values.append(current_tool)
+                elif line.command == "M104" or line.command == "M109":
+                    temp = S(line)
+                    if temp is not None:
+                        tool = find_specific_code(line, "T")
+                        tool = int(tool) if tool is not None else current_tool
+                        extruder_temps = set_tool_temp(extruder_temps,
+                                                       tool, temp)
+                elif line.command == "M140" or line.command == "M190":
+                    temp = S(line)
+                    if temp is not None:
+                        bed_temp = temp
+                elif line.command == "M106":
+                    fan_speed = S(line)
+                    if fan_speed is None:
+                        fan_speed = 255
+                elif line.command == "M107":
+                    fan_speed = 0
 
                 if line.command[0] == "G":
                     parse_coordinates(line, split_raw, imperial)
+                    if build_layers and line.z is not None:
+                        z_line_state = GCodeState(
+                            imperial, relative, relative_e, current_tool,
+                            current_x, current_y, current_z, current_e,
+                            offset_x, offset_y, offset_z, offset_e,
+                            current_f, extruder_temps, bed_temp, fan_speed)
 
                 # Compute current position
                 if line.is_move:
@@ -418,8 +778,20 @@ class GCode(object):
                     y = line.y
                     z = line.z
 
+                    if build_layers and (line.command == "G2" or line.command == "G3"):
+                        arc_moves.append(len(move_idxs))
+                        arc_x0.append(current_x)
+                        arc_y0.append(current_y)
+                        arc_z0.append(current_z)
+                        arc_i.append(line.i or 0)
+                        arc_j.append(line.j or 0)
+                        arc_cw.append(line.command == "G2")
+
                     if line.f is not None:
-                        self.current_f = line.f
+                        if build_layers and line.f != current_f:
+                            f_moves.append(len(move_idxs))
+                            f_values.append(line.f)
+                        current_f = line.f
 
                     if line.relative:
                         x = current_x + (x or 0)
@@ -456,43 +828,37 @@ class GCode(object):
                 line.current_z = current_z
 
                 # # Process extrusion
+                extruded = 0
                 if line.e is not None:
                     if line.is_move:
                         if line.relative_e:
-                            line.extruding = line.e > 0
-                            total_e += line.e
-                            current_e += line.e
+                            extruded = line.e
                         else:
-                            new_e = line.e + offset_e
-                            line.extruding = new_e > current_e
-                            total_e += new_e - current_e
-                            current_e = new_e
+                            extruded = line.e + offset_e - current_e
+                        line.extruding = extruded > 0
+                        total_e += extruded
+                        current_e += extruded
                         max_e = max(max_e, total_e)
-                        cur_layer_has_extrusion |= line.extruding
                     elif line.command == "G92":
                         offset_e = current_e - line.e
 
                 # # Create layers and perform global computations
                 if build_layers:
-                    # Update bounding box
+                    line_idx = len(layer_idxs)
+                    line_start_duration = totalduration
+
+                    # Record move
                     if line.is_move:
-                        if line.extruding:
-                            if line.current_x is not None:
-                                xmin_e = min(xmin_e, line.current_x)
-                                xmax_e = max(xmax_e, line.current_x)
-                            if line.current_y is not None:
-                                ymin_e = min(ymin_e, line.current_y)
-                                ymax_e = max(ymax_e, line.current_y)
-                        if max_e <= 0:
-                            if line.current_x is not None:
-                                xmin = min(xmin, line.current_x)
-                                xmax = max(xmax, line.current_x)
-                            if line.current_y is not None:
-                                ymin = min(ymin, line.current_y)
-                                ymax = max(ymax, line.current_y)
+                        move_idxs.append(line_idx)
+                        move_x.append(current_x)
+                        move_y.append(current_y)
+                        move_z.append(current_z)
+                        move_e.append(extruded)
+                        move_xyz.append(line.x is not None or line.y is not None
+                                        or line.z is not None)
 
                     # Compute duration
-                    if line.command == "G0" or line.command == "G1":
+                    if line.is_move:
                         x = line.x if line.x is not None else lastx
                         y = line.y if line.y is not None else lasty
                         z = line.z if line.z is not None else lastz
@@ -520,7 +886,12 @@ class GCode(object):
                         if dx * lastdx + dy * lastdy <= 0:
                             lastf = 0
 
-                        currenttravel = math.hypot(dx, dy)
+                        if line.command == "G2" or line.command == "G3":
+                            currenttravel = arc_length(lastx, lasty, x, y,
+                                                       line.i or 0, line.j or 0,
+                                                       line.command == "G2")
+                        else:
+                            currenttravel = math.hypot(dx, dy)
                         if currenttravel == 0:
                             if line.z is not None:
                                 currenttravel = abs(line.z) if line.relative else abs(line.z - lastz)
@@ -558,7 +929,6 @@ class GCode(object):
                             moveduration /= 1000.0
                             totalduration += moveduration
 
-                    # FIXME : looks like this needs to be tested with "lift Z on move"
                     if line.z is not None:
                         if line.command == "G92":
                             cur_z = line.z
@@ -568,47 +938,92 @@ class GCode(object):
                             else:
                                 cur_z = line.z
 
-                    # FIXME: the logic behind this code seems to work, but it might be
-                    # broken
                     if cur_z != prev_z:
-                        if prev_z is not None and last_layer_z is not None:
-                            offset = self.est_layer_height if self.est_layer_height else 0.01
-                            if abs(prev_z - last_layer_z) < offset:
-                                if self.est_layer_height is None:
-                                    zs = sorted([l.z for l in all_layers if l.z is not None])
-                                    heights = [round(zs[i + 1] - zs[i], 3) for i in range(len(zs) - 1)]
-                                    heights = [height for height in heights if height]
-                                    if len(heights) >= 2: self.est_layer_height = heights[1]
-                                    elif heights: self.est_layer_height = heights[0]
-                                    else: self.est_layer_height = 0.1
-                                base_z = round(prev_z - (prev_z % self.est_layer_height), 2)
-                            else:
-                                base_z = round(prev_z, 2)
+                        z_event_idxs.append(line_idx)
+                        z_event_zs.append(cur_z)
+                        z_event_layers.append(False)
+                        if cur_z == layer_z:
+                            # Back to the layer height: it was a z-hop
+                            pending_idx = None
+                        elif pending_idx is None or not has_printed:
+                            # Before the first layer only the last height
+                            # matters, the start code keeps its travel moves
+                            pending_idx = line_idx
+                            pending_event = len(z_event_idxs) - 1
+                            pending_duration = line_start_duration
+                            pending_state = z_line_state
+                        if not has_printed:
+                            if cur_z == travel_z:
+                                travel_split = None
+                            elif travel_split is None:
+                                travel_split = (line_idx, len(z_event_idxs) - 1,
+                                                line_start_duration,
+                                                z_line_state)
+
+                    # Only printing moves settle pending Z events
+                    prints = extruded > 0 and (line.x is not None or line.y is not None)
+                    if travel_split is not None and not has_printed \
+                       and line.is_move \
+                       and (line.x is not None or line.y is not None):
+                        travel_splits.append(travel_split + (cur_z,))
+                        travel_z = cur_z
+                        travel_split = None
+                    if pending_idx is not None and prints:
+                        # Extruding moves slightly lifting Z by themselves
+                        # are the mark of spiral (vase mode) printing: only
+                        # start a new layer every layer height
+                        est_height = self.est_layer_height
+                        if pending_idx == line_idx and est_height \
+                           and layer_z is not None and prev_z is not None \
+                           and 0 < cur_z - prev_z \
+                           < vase_mode_max_rise * est_height - z_epsilon \
+                           and abs(cur_z - layer_z) < est_height - z_epsilon:
+                            pending_idx = None
                         else:
-                            base_z = prev_z
-
-                        if base_z != prev_base_z:
-                            new_layer = Layer(cur_lines, base_z)
-                            new_layer.duration = totalduration - layerbeginduration
-                            layerbeginduration = totalduration
-                            all_layers.append(new_layer)
-                            if cur_layer_has_extrusion and prev_z not in all_zs:
-                                all_zs.add(prev_z)
-                            cur_lines = []
-                            cur_layer_has_extrusion = False
-                            layer_id += 1
-                            layer_line = 0
-                            last_layer_z = base_z
-                            if layer_callback is not None:
-                                layer_callback(self, len(all_layers) - 1)
-
-                        prev_base_z = base_z
+                            moved_lines = line_idx - pending_idx
+                            kept_lines = len(cur_lines) - moved_lines
+                            if kept_lines:
+                                if self.est_layer_height is None \
+                                   and cur_layer_has_extrusion \
+                                   and layer_z is not None and cur_z != layer_z:
+                                    self.est_layer_height = abs(cur_z - layer_z)
+                                new_layer = Layer(cur_lines[:kept_lines], layer_z)
+                                new_layer.duration = pending_duration - layerbeginduration
+                                layerbeginduration = pending_duration
+                                all_layers.append(new_layer)
+                                if cur_layer_has_extrusion:
+                                    printed_layers.append(len(all_layers) - 1)
+                                    if layer_z not in all_zs:
+                                        all_zs.add(layer_z)
+                                cur_lines = cur_lines[kept_lines:]
+                                cur_layer_has_extrusion = False
+                                layer_id += 1
+                                layer_line = moved_lines
+                                for k in xrange(pending_idx, line_idx):
+                                    layer_idxs[k] = layer_id
+                                    line_idxs[k] = k - pending_idx
+                                checkpoint = bisect_left(checkpoint_idxs, pending_idx)
+                                if checkpoint == len(checkpoint_idxs):
+                                    lines_since_checkpoint = moved_lines
+                                if checkpoint == len(checkpoint_idxs) \
+                                   or checkpoint_idxs[checkpoint] != pending_idx:
+                                    checkpoints.insert(checkpoint, pending_state)
+                                    checkpoint_idxs.insert(checkpoint, pending_idx)
+                                if layer_callback is not None:
+                                    layer_callback(self, len(all_layers) - 1)
+                            z_event_layers[pending_event] = True
+                            layer_z = cur_z
+                            pending_idx = None
+                    if prints:
+                        has_printed = True
+                        cur_layer_has_extrusion = True
 
             if build_layers:
                 cur_lines.append(true_line)
                 layer_idxs.append(layer_id)
                 line_idxs.append(layer_line)
                 layer_line += 1
+                lines_since_checkpoint += 1
                 prev_z = cur_z
             # ## Loop done
 
@@ -620,9 +1035,13 @@ class GCode(object):
         self.current_x = current_x
         self.current_y = current_y
         self.current_z = current_z
+        self.current_f = current_f
         self.offset_x = offset_x
         self.offset_y = offset_y
         self.offset_z = offset_z
+        self.extruder_temps = extruder_temps
+        self.bed_temp = bed_temp
+        self.fan_speed = fan_speed
 
         self.current_e = current_e
         self.offset_e = offset_e
@@ -631,20 +1050,64 @@ class GCode(object):
 
         # Finalize layers
         if build_layers:
+            if not has_printed and travel_splits:
+                # Nothing got printed: lay the lines out on the heights they
+                # were travelled at instead
+                layer_start = 0
+                for split_idx, split_event, split_duration, split_state, \
+                        split_z in travel_splits:
+                    z_event_layers[split_event] = True
+                    if split_idx > layer_start:
+                        new_layer = Layer(cur_lines[layer_start:split_idx],
+                                          layer_z)
+                        new_layer.duration = split_duration - layerbeginduration
+                        layerbeginduration = split_duration
+                        all_layers.append(new_layer)
+                        for k in xrange(layer_start, split_idx):
+                            layer_idxs[k] = layer_id
+                            line_idxs[k] = k - layer_start
+                        layer_id += 1
+                        checkpoint = bisect_left(checkpoint_idxs, split_idx)
+                        if checkpoint == len(checkpoint_idxs) \
+                           or checkpoint_idxs[checkpoint] != split_idx:
+                            checkpoints.insert(checkpoint, split_state)
+                            checkpoint_idxs.insert(checkpoint, split_idx)
+                        if layer_callback is not None:
+                            layer_callback(self, len(all_layers) - 1)
+                    layer_z = split_z
+                    layer_start = split_idx
+                for k in xrange(layer_start, len(cur_lines)):
+                    layer_idxs[k] = layer_id
+                    line_idxs[k] = k - layer_start
+                cur_lines = cur_lines[layer_start:]
             if cur_lines:
-                new_layer = Layer(cur_lines, prev_z)
+                new_layer = Layer(cur_lines, layer_z)
                 new_layer.duration = totalduration - layerbeginduration
                 layerbeginduration = totalduration
                 all_layers.append(new_layer)
-                if cur_layer_has_extrusion and prev_z not in all_zs:
-                    all_zs.add(prev_z)
+                if cur_layer_has_extrusion:
+                    printed_layers.append(len(all_layers) - 1)
+                    if layer_z not in all_zs:
+                        all_zs.add(layer_z)
 
             self.append_layer_id = len(all_layers)
             self.append_layer = Layer([])
             self.append_layer.duration = 0
             all_layers.append(self.append_layer)
+            self.checkpoint_idxs = array('I', checkpoint_idxs)
+            max_z = float("-inf")
+            self.printed_layers = printed_layers
+            self.printed_max_zs = []
+            for layer_idx in printed_layers:
+                printed_z = all_layers[layer_idx].z
+                if printed_z is not None and printed_z > max_z:
+                    max_z = printed_z
+                self.printed_max_zs.append(max_z)
             self.layer_idxs = array('I', layer_idxs)
             self.line_idxs = array('I', line_idxs)
+            self.z_event_idxs = numpy.frombuffer(z_event_idxs, dtype = numpy.uint32)
+            self.z_event_zs = numpy.frombuffer(z_event_zs, dtype = numpy.float64)
+            self.z_event_layers = numpy.frombuffer(z_event_layers, dtype = numpy.bool_)
 
             # Compute bounding box
             all_zs = self.all_zs.union(set([zmin])).difference(set([None]))
@@ -653,16 +1116,37 @@ class GCode(object):
 
             self.filament_length = self.max_e
 
+            self.move_idxs = numpy.frombuffer(move_idxs, dtype = numpy.uint32)
+            self.move_x = numpy.frombuffer(move_x, dtype = numpy.float64)
+            self.move_y = numpy.frombuffer(move_y, dtype = numpy.float64)
+            self.move_z = numpy.frombuffer(move_z, dtype = numpy.float64)
+            self.move_e = numpy.frombuffer(move_e, dtype = numpy.float32)
+            self.move_f = expand_changes(f_moves, f_values, len(move_idxs),
+                                         numpy.float32)
+            self.move_tool = expand_changes(tool_moves, tool_values,
+                                            len(move_idxs), numpy.uint16)
+            self.move_xyz = numpy.frombuffer(move_xyz, dtype = numpy.bool_)
+            self.move_arrays_revision = self.revision
+            self.move_arrays_lines = len(self.lines)
+            self.arc_moves = numpy.frombuffer(arc_moves, dtype = numpy.uint32)
+            self.arc_x0 = numpy.frombuffer(arc_x0, dtype = numpy.float64)
+            self.arc_y0 = numpy.frombuffer(arc_y0, dtype = numpy.float64)
+            self.arc_z0 = numpy.frombuffer(arc_z0, dtype = numpy.float64)
+            self.arc_i = numpy.frombuffer(arc_i, dtype = numpy.float64)
+            self.arc_j = numpy.frombuffer(arc_j, dtype = numpy.float64)
+            self.arc_cw = numpy.frombuffer(arc_cw, dtype = numpy.bool_)
+            self._arc_polylines = {}
+
+            # Only account for extruding moves if there are some
             if self.filament_length > 0:
-                self.xmin = xmin_e if not math.isinf(xmin_e) else 0
-                self.xmax = xmax_e if not math.isinf(xmax_e) else 0
-                self.ymin = ymin_e if not math.isinf(ymin_e) else 0
-                self.ymax = ymax_e if not math.isinf(ymax_e) else 0
+                bbox = self._bbox(self.move_e > 0)
             else:
-                self.xmin = xmin if not math.isinf(xmin) else 0
-                self.xmax = xmax if not math.isinf(xmax) else 0
-                self.ymin = ymin if not math.isinf(ymin) else 0
-                self.ymax = ymax if not math.isinf(ymax) else 0
+                bbox = self._bbox(None)
+            self.xmin, self.xmax, self.ymin, self.ymax = bbox
+            distances = self.move_distances()
+            extruding = self.move_e > 0
+            self.extrusion_distance = float(distances[extruding].sum())
+            self.travel_distance = float(distances[~extruding].sum())
             self.zmin = zmin if not math.isinf(zmin) else 0
             self.zmax = zmax if not math.isinf(zmax) else 0
             self.width = self.xmax - self.xmin
@@ -676,6 +1160,154 @@ class GCode(object):
     def idxs(self, i):
         return self.layer_idxs[i], self.line_idxs[i]
 
+    def _arc_args(self):
+        """Start, end, center offset and direction of arcs, as expected by
+        the arc_* and tessellate_arcs functions"""
+        arc_moves = self.arc_moves
+        return (self.arc_x0, self.arc_y0, self.arc_z0,
+                self.move_x[arc_moves], self.move_y[arc_moves],
+                self.move_z[arc_moves],
+                self.arc_i, self.arc_j, self.arc_cw)
+
+    def _bbox(self, mask):
+        """XY bounding box (xmin, xmax, ymin, ymax) of the moves selected by
+        the boolean mask array (all moves if None), arcs included"""
+        x = self.move_x if mask is None else self.move_x[mask]
+        y = self.move_y if mask is None else self.move_y[mask]
+        if len(self.arc_moves):
+            x0, y0, z0, x1, y1, z1, i, j, cw = self._arc_args()
+            bboxes = arc_bboxes(x0, y0, x1, y1, i, j, cw)
+            if mask is not None:
+                bboxes = bboxes[mask[self.arc_moves]]
+            x = numpy.concatenate((x, bboxes[:, 0], bboxes[:, 1]))
+            y = numpy.concatenate((y, bboxes[:, 2], bboxes[:, 3]))
+        if not len(x):
+            return (0, 0, 0, 0)
+        return (float(x.min()), float(x.max()), float(y.min()), float(y.max()))
+
+    def arc_polylines(self, tolerance):
+        """Points and offsets of all arcs split into segments (see
+        tessellate_arcs), computed once per tolerance"""
+        if tolerance not in self._arc_polylines:
+            self._arc_polylines[tolerance] = tessellate_arcs(*(self._arc_args() + (tolerance,)))
+        return self._arc_polylines[tolerance]
+
+    def move_arrays_current(self):
+        """Whether the per-move arrays still describe the lines, which stops
+        being the case once lines are edited or appended"""
+        return self.move_idxs is not None and \
+            self.move_arrays_revision == self.revision and \
+            self.move_arrays_lines == len(self.lines)
+
+    def move_layers(self):
+        """Layer index of each move"""
+        layer_idxs = numpy.frombuffer(self.layer_idxs, dtype = numpy.uint32)
+        return layer_idxs[self.move_idxs]
+
+    def move_distances(self):
+        """Length of each move (along the arc for arcs), the first straight
+        move being counted from where it ends"""
+        if not len(self.move_x):
+            return numpy.zeros(0)
+        dx = numpy.diff(self.move_x)
+        dy = numpy.diff(self.move_y)
+        dz = numpy.diff(self.move_z)
+        distances = numpy.concatenate(([0.], numpy.sqrt(dx * dx + dy * dy + dz * dz)))
+        if len(self.arc_moves):
+            distances[self.arc_moves] = arc_lengths(*self._arc_args())
+        return distances
+
+    def layer_bboxes(self):
+        """Per-layer XY bounding box of extruding moves, as an array of
+        (xmin, xmax, ymin, ymax) rows, filled with NaNs for layers without
+        any extrusion"""
+        bboxes = numpy.empty((len(self.all_layers), 4))
+        bboxes.fill(numpy.nan)
+        extruding = self.move_e > 0
+        if not extruding.any():
+            return bboxes
+        layers = self.move_layers()[extruding]
+        x = self.move_x[extruding]
+        y = self.move_y[extruding]
+        # Moves are sorted by layer, so each layer is a contiguous slice
+        starts = numpy.flatnonzero(numpy.concatenate(([True], layers[1:] != layers[:-1])))
+        layers = layers[starts]
+        bboxes[layers, 0] = numpy.minimum.reduceat(x, starts)
+        bboxes[layers, 1] = numpy.maximum.reduceat(x, starts)
+        bboxes[layers, 2] = numpy.minimum.reduceat(y, starts)
+        bboxes[layers, 3] = numpy.maximum.reduceat(y, starts)
+        return bboxes
+
+    def first_layer_bbox(self):
+        """(xmin, xmax, ymin, ymax) of the first layer with extrusions, or
+        None if nothing is extruded"""
+        bboxes = self.layer_bboxes()
+        printed = numpy.flatnonzero(~numpy.isnan(bboxes[:, 0]))
+        if not len(printed):
+            return None
+        return tuple(bboxes[printed[0]].tolist())
+
+    def tool_stats(self, filament_diameter = 1.75):
+        """Return a dictionary mapping each tool used for extrusion to its
+        filament length (mm), filament volume (mm^3) and XY bounding box"""
+        stats = {}
+        section = math.pi * (filament_diameter / 2.) ** 2
+        for tool in numpy.unique(self.move_tool):
+            in_tool = self.move_tool == tool
+            # Same as filament_length: the furthest the filament was pushed
+            length = float(numpy.cumsum(self.move_e[in_tool], dtype = numpy.float64).max())
+            if length <= 0:
+                continue
+            bbox = self._bbox(in_tool & (self.move_e > 0))
+            stats[int(tool)] = (length, length * section, bbox)
+        return stats
+
+    def feedrate_histogram(self, bins = 10, extruding = None):
+        """Histogram of the distance covered at each feedrate (mm/min), for
+        all moves or only extruding (or non extruding) ones. Returns the
+        distances and bin edges as numpy.histogram does."""
+        distances = self.move_distances()
+        feedrates = self.move_f
+        if extruding is not None:
+            mask = (self.move_e > 0) == extruding
+            distances = distances[mask]
+            feedrates = feedrates[mask]
+        return numpy.histogram(feedrates, bins = bins, weights = distances)
+
+    def layer_start_index(self, layer_idx):
+        """Index in the whole file of the first line of the given layer"""
+        return bisect_left(self.layer_idxs, layer_idx)
+
+    def layer_boundaries(self):
+        """Array of the index of the first line of each layer, followed by
+        the total number of lines"""
+        layer_idxs = numpy.frombuffer(self.layer_idxs, dtype = numpy.uint32)
+        return numpy.searchsorted(layer_idxs,
+                                  numpy.arange(len(self.all_layers) + 1))
+
+    def state_at(self, line_idx):
+        """Modal state right before the given line, replayed from the closest
+        preceding checkpoint"""
+        checkpoint = bisect_right(self.checkpoint_idxs, line_idx) - 1
+        state = self.checkpoints[checkpoint]
+        checkpoint_idx = self.checkpoint_idxs[checkpoint]
+        if checkpoint_idx == line_idx:
+            return state
+        replay = self.__class__(deferred = True)
+        replay.home_pos = self.home_pos
+        replay.state = state
+        replay._preprocess(self.lines[checkpoint_idx:line_idx])
+        return replay.state
+
+    def layer_at_z(self, z):
+        """Index of the first printed layer at or above the given height.
+        Layers which print nothing, such as the start code, are skipped.
+        Raises ValueError if nothing gets printed that high"""
+        printed_idx = bisect_left(self.printed_max_zs, z - z_epsilon)
+        if printed_idx == len(self.printed_layers):
+            raise ValueError("Nothing is printed at or above Z = %s" % z)
+        return self.printed_layers[printed_idx]
+
     def estimate_duration(self):
         return self.layers_count, self.duration
 
@@ -699,6 +1331,21 @@ def main():
     zdims = (gcode.zmin, gcode.zmax, gcode.height)
     print "\tZ: %0.02f - %0.02f (%0.02f)" % zdims
     print "Filament used: %0.02fmm" % gcode.filament_length
+    tool_stats = gcode.tool_stats()
+    for tool in sorted(tool_stats):
+        length, volume, bbox = tool_stats[tool]
+        print "\tT%d: %0.02fmm (%0.02fcm3)" % (tool, length, volume / 1000.)
+        print "\t\tX: %0.02f - %0.02f, Y: %0.02f - %0.02f" % bbox
+    print "Extrusion moves: %0.02fmm" % gcode.extrusion_distance
+    print "Travel moves: %0.02fmm" % gcode.travel_distance
+    distances, edges = gcode.feedrate_histogram()
+    print "Distance per feedrate:"
+    for i, distance in enumerate(distances):
+        if distance:
+            print "\t%d - %d mm/min: %0.02fmm" % (edges[i], edges[i + 1], distance)
+    first_layer = gcode.first_layer_bbox()
+    if first_layer is not None:
+        print "First layer: X: %0.02f - %0.02f, Y: %0.02f - %0.02f" % first_layer
     print "Number of layers: %d" % gcode.layers_count
     print "Estimated duration: %s" % gcode.estimate_duration()[1]
 
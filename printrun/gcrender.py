@@ -0,0 +1,354 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Headless rendering of G-Code previews to PNG images. The extrusion tubes
+# of the 3D viewer are rasterized with numpy, so that neither GL nor a
+# display is needed.
+
+import os
+import sys
+import math
+import zlib
+import struct
+import logging
+import argparse
+import traceback
+import multiprocessing
+
+import numpy
+
+from printrun import gcoder
+from printrun.gl.libtatlin.meshes import build_layer_mesh, LayerMoves
+from printrun.utils import install_locale, setup_logging
+install_locale('pronterface')
+
+# Tool colors of the 3D viewer
+tool_colors = numpy.array([(1.0, 0.0, 0.0),
+                           (0.67, 0.05, 0.9),
+                           (1.0, 0.8, 0.),
+                           (1.0, 0., 0.62),
+                           (0., 1.0, 0.58)])
+
+views = ("top", "iso", "layer")
+
+gcode_extensions = (".gcode", ".gco", ".g")
+
+class GcodeMesh(object):
+    """Triangles of the extrusion tubes of some G-Code"""
+
+    def __init__(self, gcode, path_halfwidth = 0.2, path_halfheight = 0.15,
+                 arc_tolerance = 0.02):
+        vertices = []
+        normals = []
+        triangles = []
+        colors = []
+        layers = []
+        state = (0, (0, 0, 0), False, 0.0, 0.0, 0.0)
+        layer_count = 0
+        moves = LayerMoves(gcode)
+        for layer_idx in range(len(gcode.all_layers)):
+            glines, extruding, next_extruding, positions, position_counts, \
+                tools = moves.layer(layer_idx, state[1], arc_tolerance)
+            if not glines:
+                continue
+            move_colors = tool_colors[numpy.minimum(tools, len(tool_colors) - 1)]
+            mesh = build_layer_mesh(positions, position_counts, extruding,
+                                    next_extruding, move_colors, state,
+                                    path_halfwidth, path_halfheight)
+            state = mesh[-1]
+            # Indices count from the first vertex of the first layer
+            vertices.append(mesh[1].reshape(-1, 3))
+            normals.append(mesh[2].reshape(-1, 3))
+            colors.append(mesh[3].reshape(-1, 3))
+            layer_triangles = mesh[4].reshape(-1, 3)
+            triangles.append(layer_triangles)
+            layers.append(numpy.repeat(layer_count, len(layer_triangles)))
+            layer_count += 1
+        self.layer_count = layer_count
+        if not vertices:
+            self.vertices = numpy.zeros((0, 3))
+            self.normals = numpy.zeros((0, 3))
+            self.triangles = numpy.zeros((0, 3), dtype = numpy.intp)
+            self.colors = numpy.zeros((0, 3))
+            self.layers = numpy.zeros(0, dtype = numpy.intp)
+            return
+        self.vertices = numpy.concatenate(vertices)
+        self.normals = numpy.concatenate(normals)
+        self.triangles = numpy.concatenate(triangles)
+        # Triangles joining a tube to the previous one use some of its
+        # vertices, their last vertex always belongs to their own tube
+        self.colors = numpy.concatenate(colors)[self.triangles.max(1)]
+        self.layers = numpy.concatenate(layers)
+
+def view_axes(view):
+    """Screen right and up directions and the direction towards the viewer"""
+    if view == "iso":
+        towards = numpy.array([1.0, -1.0, 1.0]) / math.sqrt(3)
+        right = numpy.array([1.0, 1.0, 0.0]) / math.sqrt(2)
+        return right, numpy.cross(towards, right), towards
+    return (numpy.array([1.0, 0.0, 0.0]), numpy.array([0.0, 1.0, 0.0]),
+            numpy.array([0.0, 0.0, 1.0]))
+
+def rasterize(points, depths, triangles, colors, width, height,
+              batch_triangles = 100000):
+    """Draw the triangles of the (N, 2) pixel coordinates points with a
+    depth buffer, nearer points having lower depths. Returns the (H, W, 3)
+    colors of pixels and the mask of those covered."""
+    depth_buffer = numpy.empty(width * height)
+    depth_buffer.fill(numpy.inf)
+    color_buffer = numpy.zeros((width * height, 3))
+    for first in range(0, len(triangles), batch_triangles):
+        batch = triangles[first:first + batch_triangles]
+        batch_colors = colors[first:first + batch_triangles]
+        x = points[batch, 0]
+        y = points[batch, 1]
+        z = depths[batch]
+        # Edge functions a * x + b * y + c, positive inside triangles
+        a = numpy.roll(y, -1, axis = 1) - y
+        b = x - numpy.roll(x, -1, axis = 1)
+        c = - a * x - b * y
+        area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - \
+            (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+        # Triangles seen edge-on cover nothing
+        kept = numpy.abs(area) > 1e-9
+        sign = numpy.where(area < 0, 1.0, -1.0)[:, None]
+        a, b, c = (a * sign)[kept], (b * sign)[kept], (c * sign)[kept]
+        x, y, z, area = x[kept], y[kept], z[kept], area[kept]
+        batch_colors = batch_colors[kept]
+        # Depth as a plane over the screen
+        dz1 = z[:, 1] - z[:, 0]
+        dz2 = z[:, 2] - z[:, 0]
+        dx1 = x[:, 1] - x[:, 0]
+        dx2 = x[:, 2] - x[:, 0]
+        dy1 = y[:, 1] - y[:, 0]
+        dy2 = y[:, 2] - y[:, 0]
+        z_x = (dz1 * dy2 - dz2 * dy1) / area
+        z_y = (dz2 * dx1 - dz1 * dx2) / area
+        z_0 = z[:, 0] - z_x * x[:, 0] - z_y * y[:, 0]
+
+        # Rows of pixels whose centers may be inside triangles
+        row_first = numpy.maximum(numpy.ceil(y.min(1) - 0.5), 0).astype(numpy.intp)
+        row_last = numpy.minimum(numpy.floor(y.max(1) - 0.5), height - 1).astype(numpy.intp)
+        nrows = numpy.maximum(row_last - row_first + 1, 0)
+        row_tri = numpy.repeat(numpy.arange(len(nrows)), nrows)
+        rows = numpy.arange(len(row_tri)) - \
+            numpy.repeat(numpy.cumsum(nrows) - nrows, nrows) + row_first[row_tri]
+        # Span of each row inside the three half planes
+        row_a = a[row_tri]
+        bounds = - (b[row_tri] * (rows[:, None] + 0.5) + c[row_tri])
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            limits = bounds / row_a
+        span_first = numpy.where(row_a > 0, limits, -numpy.inf).max(1)
+        span_last = numpy.where(row_a < 0, limits, numpy.inf).min(1)
+        # Rows parallel to an edge are outside if outside of its half plane
+        outside = ((row_a == 0) & (bounds > 0)).any(1)
+        col_first = numpy.maximum(numpy.ceil(span_first - 0.5), 0)
+        col_last = numpy.minimum(numpy.floor(span_last - 0.5), width - 1)
+        ncols = numpy.where(outside, 0, numpy.maximum(col_last - col_first + 1, 0)).astype(numpy.intp)
+        col_first = col_first.astype(numpy.intp)
+
+        # Fragments
+        frag_row = numpy.repeat(numpy.arange(len(ncols)), ncols)
+        if not len(frag_row):
+            continue
+        cols = numpy.arange(len(frag_row)) - \
+            numpy.repeat(numpy.cumsum(ncols) - ncols, ncols) + col_first[frag_row]
+        frag_tri = row_tri[frag_row]
+        frag_y = rows[frag_row]
+        frag_depth = z_0[frag_tri] + z_x[frag_tri] * (cols + 0.5) + \
+            z_y[frag_tri] * (frag_y + 0.5)
+        pixels = frag_y * width + cols
+        # Keep the nearest fragment of each pixel
+        order = numpy.lexsort((frag_depth, pixels))
+        pixels = pixels[order]
+        first_of_pixel = numpy.ones(len(pixels), dtype = bool)
+        first_of_pixel[1:] = pixels[1:] != pixels[:-1]
+        order = order[first_of_pixel]
+        pixels = pixels[first_of_pixel]
+        frag_depth = frag_depth[order]
+        nearer = frag_depth < depth_buffer[pixels]
+        pixels = pixels[nearer]
+        depth_buffer[pixels] = frag_depth[nearer]
+        color_buffer[pixels] = batch_colors[frag_tri[order[nearer]]]
+    covered = numpy.isfinite(depth_buffer)
+    return color_buffer.reshape(height, width, 3), covered.reshape(height, width)
+
+def render(mesh, view = "iso", size = 256, layer = None, supersampling = 2):
+    """Render mesh to an (H, W, 4) RGBA array with a transparent background.
+    The layer view shows the given layer from the top, by default the
+    middle one."""
+    right, up, towards = view_axes(view)
+    triangles = mesh.triangles
+    colors = mesh.colors
+    if view == "layer":
+        if layer is None:
+            layer = mesh.layer_count // 2
+        elif not 0 <= layer < mesh.layer_count:
+            raise ValueError("No layer %d to render, there are %d layers"
+                             % (layer + 1, mesh.layer_count))
+        in_layer = mesh.layers == layer
+        triangles = triangles[in_layer]
+        colors = colors[in_layer]
+
+    # Flat shading with the outward normals of the tube faces, lit from
+    # above the viewer
+    normals = mesh.normals[triangles].sum(1)
+    lengths = numpy.sqrt((normals ** 2).sum(1))
+    lengths[lengths == 0] = 1
+    light = towards + up
+    light /= math.sqrt((light ** 2).sum())
+    shade = 0.3 + 0.7 * numpy.maximum(normals.dot(light) / lengths, 0)
+    colors = colors * shade[:, None]
+
+    # Fit the whole model in the image, so that layer views line up
+    width = height = size * supersampling
+    screen_x = mesh.vertices.dot(right)
+    screen_y = mesh.vertices.dot(up)
+    left = screen_x.min() if len(screen_x) else 0
+    bottom = screen_y.min() if len(screen_y) else 0
+    extent_x = screen_x.max() - left if len(screen_x) else 0
+    extent_y = screen_y.max() - bottom if len(screen_y) else 0
+    scale = 0.9 * width / max(extent_x, extent_y, 1e-6)
+    points = numpy.empty((len(mesh.vertices), 2))
+    points[:, 0] = (width - extent_x * scale) / 2 + (screen_x - left) * scale
+    points[:, 1] = (height + extent_y * scale) / 2 - (screen_y - bottom) * scale
+    depths = - mesh.vertices.dot(towards)
+
+    image, covered = rasterize(points, depths, triangles, colors, width, height)
+    # Average blocks of supersampling x supersampling pixels
+    shape = (size, supersampling, size, supersampling)
+    alpha = covered.reshape(shape).mean(3).mean(1)
+    rgb = (image * covered[:, :, None]).reshape(shape + (3,)).sum(3).sum(1)
+    rgb /= numpy.maximum(alpha * supersampling ** 2, 1)[:, :, None]
+    rgba = numpy.empty((size, size, 4), dtype = numpy.uint8)
+    rgba[:, :, :3] = numpy.rint(numpy.clip(rgb, 0, 1) * 255)
+    rgba[:, :, 3] = numpy.rint(alpha * 255)
+    return rgba
+
+def write_png(filename, pixels):
+    """Write an (H, W, 4) uint8 RGBA array to a PNG file"""
+    height, width = pixels.shape[:2]
+    raw = numpy.zeros((height, 1 + 4 * width), dtype = numpy.uint8)
+    raw[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + \
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    with open(filename, "wb") as f:
+        f.write("\x89PNG\r\n\x1a\n")
+        f.write(chunk("IHDR", struct.pack(">IIBBBBB", width, height,
+                                          8, 6, 0, 0, 0)))
+        f.write(chunk("IDAT", zlib.compress(raw.tostring(), 6)))
+        f.write(chunk("IEND", ""))
+
+def output_path(filename, output_dir, view):
+    base = os.path.splitext(os.path.basename(filename))[0]
+    if output_dir is None:
+        output_dir = os.path.dirname(filename)
+    return os.path.join(output_dir, "%s_%s.png" % (base, view))
+
+def render_file(filename, output_dir = None, views = views, size = 256,
+                layer = None):
+    """Render views of a G-Code file to PNG files and return their paths.
+    Raises ValueError if the layer to render does not exist."""
+    with open(filename, "rU") as f:
+        gcode = gcoder.GCode(f)
+    mesh = GcodeMesh(gcode)
+    # Render every view before writing any, so that no image gets written
+    # if one of them can not be rendered
+    images = [render(mesh, view, size, layer) for view in views]
+    paths = []
+    for view, image in zip(views, images):
+        path = output_path(filename, output_dir, view)
+        write_png(path, image)
+        paths.append(path)
+    return paths
+
+def _render_job(job):
+    filename, output_dir, views, size, layer = job
+    try:
+        return filename, render_file(filename, output_dir, views, size, layer), None
+    except Exception:
+        return filename, [], traceback.format_exc()
+
+def find_gcode_files(paths):
+    """G-Code files among paths and in the directories among them"""
+    filenames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            filenames.append(path)
+            continue
+        for dirpath, dirnames, dirfiles in os.walk(path):
+            dirnames.sort()
+            filenames.extend(os.path.join(dirpath, name)
+                             for name in sorted(dirfiles)
+                             if os.path.splitext(name)[1].lower() in gcode_extensions)
+    return filenames
+
+def render_batch(filenames, output_dir = None, views = views, size = 256,
+                 layer = None, processes = None):
+    """Render files in a pool of processes, yielding the (file name, PNG
+    paths, error) of each file as they are done"""
+    jobs = [(filename, output_dir, views, size, layer) for filename in filenames]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield _render_job(job)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_render_job, jobs):
+            yield result
+    finally:
+        pool.terminate()
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = 'Render previews of G-Code files to PNG images, without display')
+    parser.add_argument('paths', nargs = '+', metavar = 'PATH',
+                        help = 'G-Code file or directory searched for G-Code files')
+    parser.add_argument('-o', '--output', default = None,
+                        help = 'Directory of the images, by default the one of each file')
+    parser.add_argument('-s', '--size', type = int, default = 256,
+                        help = 'Width and height of the images in pixels')
+    parser.add_argument('-v', '--views', default = ",".join(views),
+                        help = 'Comma separated views among %s' % ", ".join(views))
+    parser.add_argument('-l', '--layer', type = int, default = None,
+                        help = 'Layer shown by the layer view, counting from 1 as in the 3D viewer, by default the middle one')
+    parser.add_argument('-j', '--jobs', type = int, default = None,
+                        help = 'Number of processes, by default the number of CPUs')
+    args = parser.parse_args(args)
+    setup_logging(sys.stderr, reset_handlers = True)
+    selected = [view.strip() for view in args.views.split(",") if view.strip()]
+    for view in selected:
+        if view not in views:
+            parser.error("unknown view %s" % view)
+    if args.output is not None and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    layer = args.layer - 1 if args.layer is not None else None
+    failed = 0
+    for filename, paths, error in render_batch(find_gcode_files(args.paths),
+                                               args.output, selected,
+                                               args.size, layer,
+                                               args.jobs):
+        if error:
+            failed += 1
+            logging.error(_("Could not render %s:") % filename + "\n" + error)
+        else:
+            logging.info(_("Rendered %s to %s") % (filename, ", ".join(paths)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
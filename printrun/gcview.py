@@ -66,6 +66,14 @@ def set_gcview_params(self, path_width, path_height):
             has_changed = True
     return has_changed
 
+def set_gcview_lod(self, lod, detail_layers):
+    self.lod = lod
+    self.detail_layers = detail_layers
+    for obj in self.objects[1:]:
+        if isinstance(obj.model, actors.GcodeModel):
+            obj.model.set_lod(lod, detail_layers)
+    wx.CallAfter(self.Refresh)
+
 class GcodeViewPanel(wxGLPanel):
 
     def __init__(self, parent, id = wx.ID_ANY,
@@ -151,6 +159,9 @@ class GcodeViewPanel(wxGLPanel):
             glTranslatef(*(obj.centeroffset))
             glScalef(*obj.scale)
 
+            # Let models skip what is out of view
+            if hasattr(obj.model, "set_frustum"):
+                obj.model.set_frustum(actors.view_frustum())
             obj.model.display()
             glPopMatrix()
         glPopMatrix()
@@ -321,12 +332,16 @@ class GcodeViewLoader(object):
 
     path_halfwidth = 0.2
     path_halfheight = 0.15
+    lod = True
+    detail_layers = 0
 
     def addfile_perlayer(self, gcode = None, showall = False):
+        self.release_model()
         self.model = create_model(self.root.settings.light3d
                                   if self.root else False)
         if isinstance(self.model, actors.GcodeModel):
             self.model.set_path_size(self.path_halfwidth, self.path_halfheight)
+            self.model.set_lod(self.lod, self.detail_layers)
         self.objects[-1].model = self.model
         if self.root:
             set_model_colors(self.model, self.root)
@@ -344,9 +359,17 @@ class GcodeViewLoader(object):
         while generator.next() is not None:
             continue
 
+    def release_model(self):
+        # Let the cached mesh go once no viewer shows it
+        if self.objects[-1].model is not None:
+            self.objects[-1].model.release()
+
     def set_gcview_params(self, path_width, path_height):
         return set_gcview_params(self, path_width, path_height)
 
+    def set_gcview_lod(self, lod, detail_layers):
+        return set_gcview_lod(self, lod, detail_layers)
+
 class GcodeViewMainWrapper(GcodeViewLoader):
 
     def __init__(self, parent, build_dimensions, root, circular, antialias_samples):
@@ -370,7 +393,9 @@ class GcodeViewMainWrapper(GcodeViewLoader):
 
     def set_current_gline(self, gline):
         if gline.is_move and gline.gcview_end_vertex is not None \
-           and self.model and self.model.loaded:
+           and self.model and self.model.loaded \
+           and self.model.printed_until != gline.gcview_end_vertex:
+            # Drawing only depends on where printed moves end
             self.model.printed_until = gline.gcview_end_vertex
             if not self.refresh_timer.IsRunning():
                 self.refresh_timer.Start()
@@ -381,6 +406,9 @@ class GcodeViewMainWrapper(GcodeViewLoader):
     def addgcodehighlight(self, *a):
         pass
 
+    def addprinthighlight(self, *a):
+        pass
+
     def setlayer(self, layer):
         if layer in self.model.layer_idxs_map:
             viz_layer = self.model.layer_idxs_map[layer]
@@ -388,6 +416,7 @@ class GcodeViewMainWrapper(GcodeViewLoader):
             wx.CallAfter(self.Refresh)
 
     def clear(self):
+        self.release_model()
         self.model = None
         self.objects[-1].model = None
         wx.CallAfter(self.Refresh)
@@ -460,7 +489,9 @@ class GcodeViewFrame(GvizBaseFrame, GcodeViewLoader):
 
     def set_current_gline(self, gline):
         if gline.is_move and gline.gcview_end_vertex is not None \
-           and self.model and self.model.loaded:
+           and self.model and self.model.loaded \
+           and self.model.printed_until != gline.gcview_end_vertex:
+            # Drawing only depends on where printed moves end
             self.model.printed_until = gline.gcview_end_vertex
             if not self.refresh_timer.IsRunning():
                 self.refresh_timer.Start()
@@ -470,6 +501,7 @@ class GcodeViewFrame(GvizBaseFrame, GcodeViewLoader):
 
     def addfile(self, gcode = None):
         if self.clonefrom:
+            self.release_model()
             self.model = self.clonefrom[-1].model.copy()
             self.objects[-1].model = self.model
         else:
@@ -480,6 +512,7 @@ class GcodeViewFrame(GvizBaseFrame, GcodeViewLoader):
         wx.CallAfter(self.Refresh)
 
     def clear(self):
+        self.release_model()
         self.model = None
         self.objects[-1].model = None
         wx.CallAfter(self.Refresh)
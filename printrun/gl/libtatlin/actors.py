@@ -16,17 +16,23 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import os
 import time
 import numpy
 import array
 import math
 import logging
 import threading
+import bisect
+import collections
+import multiprocessing
 
 from ctypes import sizeof
 
 from pyglet.gl import glPushMatrix, glPopMatrix, glTranslatef, \
     glGenLists, glNewList, GL_COMPILE, glEndList, glCallList, \
+    glGetDoublev, glGetIntegerv, GL_MODELVIEW_MATRIX, GL_PROJECTION_MATRIX, \
+    GL_VIEWPORT, GLdouble, GLint, \
     GL_ELEMENT_ARRAY_BUFFER, GL_UNSIGNED_INT, GL_TRIANGLES, GL_LINE_LOOP, \
     GL_ARRAY_BUFFER, GL_STATIC_DRAW, glColor4f, glVertex3f, \
     glBegin, glEnd, GL_LINES, glEnable, glDisable, glGetFloatv, \
@@ -35,9 +41,19 @@ from pyglet.gl import glPushMatrix, glPopMatrix, glTranslatef, \
     glEnableClientState, glDisableClientState, GL_VERTEX_ARRAY, GL_COLOR_ARRAY, \
     GL_FRONT_AND_BACK, GL_FRONT, glMaterialfv, GL_SPECULAR, GL_EMISSION, \
     glColorMaterial, GL_AMBIENT_AND_DIFFUSE, glMaterialf, GL_SHININESS, \
-    GL_NORMAL_ARRAY, glNormalPointer, GL_LIGHTING, glColor3f
+    GL_NORMAL_ARRAY, glNormalPointer, GL_LIGHTING, glColor3f, \
+    GL_NORMALIZE, GL_SHORT, GL_BYTE, GL_UNSIGNED_BYTE, GL_UNSIGNED_SHORT, \
+    GLushort, GLubyte, glTranslated, glScaled, glUseProgram, \
+    glGetUniformLocation, glGetAttribLocation, glUniform1f, glUniform4f, \
+    glVertexAttribPointer, glEnableVertexAttribArray, \
+    glDisableVertexAttribArray, GL_FALSE
 from pyglet.graphics.vertexbuffer import create_buffer, VertexBufferObject
 
+from printrun import gcoder
+from .meshes import build_layers_mesh, layer_end_state, PackedMesh, \
+    packed_vertex, layer_moves, move_positions, LayerMoves
+from .meshcache import MeshCache
+from .shaders import shaders_available, compile_program, ShaderError
 from printrun.utils import install_locale
 install_locale('pronterface')
 
@@ -57,14 +73,6 @@ def numpy2vbo(nparray, target = GL_ARRAY_BUFFER, usage = GL_STATIC_DRAW, use_vbo
     vbo.set_data(nparray.ctypes.data)
     return vbo
 
-def triangulate_rectangle(i1, i2, i3, i4):
-    return [i1, i4, i3, i3, i2, i1]
-
-def triangulate_box(i1, i2, i3, i4,
-                    j1, j2, j3, j4):
-    return [i1, i2, j2, j2, j1, i1, i2, i3, j3, j3, j2, i2,
-            i3, i4, j4, j4, j3, i3, i4, i1, j1, j1, j4, i4]
-
 class BoundingBox(object):
     """
     A rectangular box (cuboid) enclosing a 3D model, defined by lower and upper corners.
@@ -245,6 +253,13 @@ class Model(object):
     def invalidate_bounding_box(self):
         self._bounding_box = None
 
+    def release(self):
+        """
+        Release data shared with other models, once the model is not shown
+        anymore.
+        """
+        pass
+
     @property
     def bounding_box(self):
         """
@@ -296,24 +311,127 @@ class Model(object):
 
         return self.color_travel
 
+    def movement_colors(self, glines, extruding, tools = None):
+        """
+        Return the colors of a list of moves as an array, assuming colors
+        only depend on the tool and on whether moves are extruding.
+        """
+        if tools is None:
+            tools = numpy.fromiter([gline.current_tool for gline in glines],
+                                   dtype = numpy.intp, count = len(glines))
+        keys = 2 * tools + extruding
+        unique_keys, first_moves = numpy.unique(keys, return_index = True)
+        palette = numpy.zeros((unique_keys[-1] + 1, 4))
+        for key, move_k in zip(unique_keys.tolist(), first_moves.tolist()):
+            palette[key] = self.movement_color(glines[move_k])
+        return palette[keys]
+
 def movement_angle(src, dst, precision=0):
     x = dst[0] - src[0]
     y = dst[1] - src[1]
     angle = math.degrees(math.atan2(y, -x))  # negate x for clockwise rotation angle
     return round(angle, precision)
 
-def get_next_move(gcode, layer_idx, gline_idx):
-    gline_idx += 1
-    while layer_idx < len(gcode.all_layers):
-        layer = gcode.all_layers[layer_idx]
-        while gline_idx < len(layer):
-            gline = layer[gline_idx]
-            if gline.is_move:
-                return gline
-            gline_idx += 1
-        layer_idx += 1
-        gline_idx = 0
-    return None
+def default_build_processes():
+    # Leave a core to the interface, which has to gather the moves anyway
+    try:
+        return multiprocessing.cpu_count() - 1
+    except NotImplementedError:
+        return 0
+
+mesh_pool = None
+mesh_pool_lock = threading.Lock()
+
+def get_mesh_pool(processes):
+    """Return the pool of processes building meshes, shared by all models,
+    or None if meshes are to be built by the calling thread."""
+    global mesh_pool
+    if not processes:
+        return None
+    with mesh_pool_lock:
+        if mesh_pool is None:
+            try:
+                mesh_pool = multiprocessing.Pool(processes)
+            except (OSError, ImportError) as e:
+                logging.warning(_("Could not start processes building the 3D view, building it in the loading thread: %s") % e)
+                mesh_pool = False
+    return mesh_pool or None
+
+# Meshes of G-Code models, shared by the models showing the same G-Code
+mesh_cache = MeshCache(os.path.join(os.path.expanduser("~"), ".printrun", "cache"))
+
+def empty_boxes(count):
+    boxes = numpy.empty((count, 6))
+    boxes[:, :3] = numpy.inf
+    boxes[:, 3:] = -numpy.inf
+    return boxes
+
+def extend_runs(stops, values, move_values, first_move):
+    """Extend runs of consecutive moves sharing a value with the values of
+    moves starting at first_move, stops holding the last move of each run
+    after a leading 0"""
+    if not len(move_values):
+        return
+    ends = numpy.flatnonzero(move_values[1:] != move_values[:-1]).tolist()
+    ends.append(len(move_values) - 1)
+    for end in ends:
+        value = int(move_values[end])
+        if values and values[-1] == value:
+            stops[-1] = first_move + end
+        else:
+            stops.append(first_move + end)
+            values.append(value)
+
+def view_frustum():
+    """Planes bounding the current view, as (a, b, c, d) rows such that
+    points in view verify a * x + b * y + c * z + d >= 0"""
+    modelview = (GLdouble * 16)()
+    projection = (GLdouble * 16)()
+    glGetDoublev(GL_MODELVIEW_MATRIX, modelview)
+    glGetDoublev(GL_PROJECTION_MATRIX, projection)
+    # GL matrices are column-major
+    clip = numpy.dot(numpy.array(projection).reshape(4, 4).T,
+                     numpy.array(modelview).reshape(4, 4).T)
+    return numpy.array([clip[3] + clip[0], clip[3] - clip[0],
+                        clip[3] + clip[1], clip[3] - clip[1],
+                        clip[3] + clip[2], clip[3] - clip[2]])
+
+def boxes_in_frustum(boxes, frustum):
+    """Tell which boxes are at least partly inside the frustum planes.
+    Boxes crossing the frustum edges without entering it may be kept."""
+    normals = frustum[:, :3]
+    # Corners of the boxes the farthest along each plane normal
+    corners = numpy.where(normals > 0, boxes[:, None, 3:], boxes[:, None, :3])
+    # Empty boxes give NaN distances and are never in view
+    with numpy.errstate(invalid = 'ignore'):
+        distances = (corners * normals).sum(2) + frustum[:, 3]
+        return (distances >= 0).all(1)
+
+def visible_runs(visible, first, last):
+    """Runs of consecutive visible items between first and last, as
+    (first, last) pairs"""
+    if visible is None:
+        if first <= last:
+            yield first, last
+        return
+    window = numpy.zeros(last - first + 3, dtype = bool)
+    window[1:-1] = visible[first:last + 1]
+    changes = numpy.flatnonzero(window[1:] != window[:-1]) + first
+    for run_start, run_end in zip(changes[::2].tolist(), changes[1::2].tolist()):
+        yield run_start, run_end - 1
+
+class BuiltMeshes(object):
+    """Meshes built in the loading thread, standing for the results of
+    the mesh building pool."""
+
+    def __init__(self, meshes):
+        self.meshes = meshes
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.meshes
 
 class GcodeModel(Model):
     """
@@ -342,12 +460,159 @@ class GcodeModel(Model):
     path_halfwidth = 0.2
     path_halfheight = 0.2
 
+    # Maximum distance between arcs and the segments used to draw them
+    arc_tolerance = 0.02
+
+    # Number of processes building layer meshes, 0 to build them in the
+    # loading thread, and bounds of the number of positions per chunk of
+    # layers handed to them
+    build_processes = default_build_processes()
+    chunk_min_positions = 2000
+    chunk_max_positions = 50000
+
+    # Level of detail: extrusions narrower than lod_min_pixels on screen are
+    # drawn as lines simplified within lod_tolerance, and when detail_layers
+    # is not 0 only this many top visible layers are drawn as extrusions
+    lod = True
+    lod_tolerance = 0.1
+    lod_min_pixels = 2.0
+    detail_layers = 0
+
+    # Number of moves per chunk culled as a whole
+    cull_chunk_moves = 256
+
+    # First move drawn as extrusions by _draw_elements
+    _detail_start = 1
+
+    # View frustum planes, in the coordinates of the model, set before each
+    # display to skip the parts out of view
+    frustum = None
+    _visible_chunks = None
+    _visible_layers = None
+
+    # Whether meshes are shared with other models through mesh_cache, and
+    # the key of the cached mesh in use
+    use_mesh_cache = True
+    mesh_key = None
+
+    # Attributes making up the meshes of models
+    mesh_attributes = ("vertices", "travels", "indices",
+                       "block_starts", "block_origins", "block_steps",
+                       "block_stops", "color_stops", "color_tools",
+                       "layer_stops", "dims", "layer_idxs_map",
+                       "count_travel_indices", "count_print_indices",
+                       "count_print_vertices",
+                       "lod_vertices", "lod_colors", "lod_layer_stops",
+                       "chunk_stops", "chunk_boxes", "layer_boxes")
+    # Attributes uploaded to buffers by init, dropped once fully loaded
+    buffer_attributes = ("travels", "indices", "vertices",
+                         "lod_vertices", "lod_colors")
+
     def set_path_size(self, path_halfwidth, path_halfheight):
         with self.lock:
             self.path_halfwidth = path_halfwidth
             self.path_halfheight = path_halfheight
 
+    def set_lod(self, lod, detail_layers):
+        with self.lock:
+            self.lod = lod
+            self.detail_layers = detail_layers
+
+    def set_frustum(self, frustum):
+        self.frustum = frustum
+
+    def release(self):
+        if self.mesh_key is not None:
+            mesh_cache.release(self.mesh_key)
+            self.mesh_key = None
+
+    def mesh_params(self, model_data):
+        """Parameters and settings the meshes of model_data depend on"""
+        return (self.path_halfwidth, self.path_halfheight,
+                self.arc_tolerance, self.lod_tolerance, self.cull_chunk_moves,
+                self.color_travel, self.color_tool0, self.color_tool1,
+                self.color_tool2, self.color_tool3, self.color_tool4,
+                model_data.home_pos)
+
     def load_data(self, model_data, callback=None):
+        self.release()
+        mesh = None
+        if self.use_mesh_cache:
+            params = self.mesh_params(model_data)
+            # G-Code edited in memory does not match its file anymore
+            revision = getattr(model_data, "revision", 0)
+            key = (model_data, revision, params)
+            mesh = mesh_cache.acquire(key)
+            path = None
+            if not revision:
+                path = mesh_cache.file_path(getattr(model_data, "filename", None), params)
+            if mesh is None:
+                mesh = mesh_cache.load(path)
+                if mesh is not None:
+                    mesh = mesh_cache.store(key, mesh, path)
+            if mesh is not None:
+                self.mesh_key = key
+
+        if mesh is not None:
+            loader = self._load_mesh(model_data, mesh, callback)
+        else:
+            loader = self._build_mesh(model_data, callback)
+        layer_idx = loader.next()
+        while layer_idx is not None:
+            yield layer_idx
+            layer_idx = loader.next()
+
+        if mesh is None and self.use_mesh_cache:
+            mesh = self.get_mesh()
+            mesh_cache.save(path, mesh)
+            mesh_cache.store(key, mesh, path)
+            self.mesh_key = key
+        yield None
+
+    def get_mesh(self):
+        """Return the mesh of the fully loaded model as a dict"""
+        mesh = dict((var, getattr(self, var)) for var in self.mesh_attributes)
+        # Vertex counts at the end of each line, to tell printed moves
+        end_vertices = [gline.gcview_end_vertex or 0
+                        for layer in self.gcode.all_layers for gline in layer]
+        mesh["line_end_vertices"] = numpy.array(end_vertices, dtype = numpy.uint32)
+        return mesh
+
+    def _load_mesh(self, model_data, mesh, callback):
+        t_start = time.time()
+        self.gcode = model_data
+        with self.lock:
+            for var in self.mesh_attributes:
+                setattr(self, var, mesh[var])
+            self.printed_until = 0
+            self.only_current = False
+            self.max_layers = len(self.layer_stops) - 1
+            self.num_layers_to_draw = self.max_layers + 1
+            self.initialized = False
+            self.loaded = True
+            self.fully_loaded = True
+
+        # Lines may still be being parsed, they are handled as their layers
+        # come in
+        end_vertices = mesh["line_end_vertices"]
+        line_k = 0
+        layer_idx = 0
+        while layer_idx < len(model_data.all_layers):
+            layer = model_data.all_layers[layer_idx]
+            layer_end_vertices = end_vertices[line_k:line_k + len(layer)].tolist()
+            for gline, end_vertex in zip(layer, layer_end_vertices):
+                if end_vertex:
+                    gline.gcview_end_vertex = end_vertex
+            line_k += len(layer)
+            if callback:
+                callback(layer_idx + 1)
+            yield layer_idx
+            layer_idx += 1
+
+        logging.debug(_('Loaded cached 3D visualization in %.2f seconds') % (time.time() - t_start))
+        yield None
+
+    def _build_mesh(self, model_data, callback):
         t_start = time.time()
         self.gcode = model_data
 
@@ -364,8 +629,7 @@ class GcodeModel(Model):
         # Nicely enough we have 3 per kind of thing for all kinds.
         coordspervertex = 3
         verticesperline = 8
-        coordsperline = coordspervertex * verticesperline
-        coords_count = lambda nlines: nlines * coordsperline
+        vertices_count = lambda nlines: nlines * verticesperline
 
         travelverticesperline = 2
         travelcoordsperline = coordspervertex * travelverticesperline
@@ -382,246 +646,185 @@ class GcodeModel(Model):
 
         nlines = len(model_data)
         ntravelcoords = travel_coords_count(nlines)
-        ncoords = coords_count(nlines)
+        nvertices = vertices_count(nlines)
         nindices = indices_count(nlines)
         travel_vertices = self.travels = numpy.zeros(ntravelcoords, dtype = GLfloat)
         travel_vertex_k = 0
-        vertices = self.vertices = numpy.zeros(ncoords, dtype = GLfloat)
-        vertex_k = 0
-        colors = self.colors = numpy.zeros(ncoords, dtype = GLfloat)
-        color_k = 0
-        normals = self.normals = numpy.zeros(ncoords, dtype = GLfloat)
-        normal_k = 0
-        indices = self.indices = numpy.zeros(nindices, dtype = GLuint)
-        index_k = 0
+        # Tubes use packed vertices and 16 bits indices, split in blocks
+        # with their own origins, and colors from the tool palette
+        mesh = PackedMesh(nvertices, nindices)
+        self.vertices = mesh.vertices
+        self.indices = mesh.indices
+        self.block_starts = mesh.block_starts
+        self.block_origins = mesh.block_origins
+        self.block_steps = mesh.block_steps
+        self.block_stops = [0]
+        block_runs = []
+        self.color_stops = [0]
+        self.color_tools = []
+        lod_vertices = self.lod_vertices = numpy.zeros(nvertices, dtype = GLfloat)
+        lod_colors = self.lod_colors = numpy.zeros(nvertices, dtype = GLubyte)
+        lod_vertex_k = 0
         self.layer_idxs_map = {}
         self.layer_stops = [0]
-
-        prev_is_extruding = False
-        prev_move_normal_x = None
-        prev_move_normal_y = None
-        prev_move_angle = None
-
-        prev_pos = (0, 0, 0)
+        self.lod_layer_stops = [0]
+        # Bounding boxes of layers and of chunks of moves within them, the
+        # chunks ending at the moves of chunk_stops
+        self.chunk_stops = [0]
+        self.chunk_boxes = empty_boxes(0)
+        self.layer_boxes = empty_boxes(1)
+
+        # Mesh state carried from one layer to the next, the vertex count
+        # being relative to the start of the chunk being gathered
+        state = (0, (0, 0, 0), False, 0.0, 0.0, 0.0)
         layer_idx = 0
 
         self.printed_until = 0
         self.only_current = False
 
-        twopi = 2 * math.pi
-
+        # Layers are gathered into chunks whose meshes are built by worker
+        # processes, starting small so that the first layers show up early.
+        # Built chunks are merged in order into the buffers.
+        pool = get_mesh_pool(self.build_processes)
+        chunk = []
+        chunk_layers = []
+        chunk_state = state
+        chunk_lines = 0
+        chunk_positions = 0
+        chunk_limit = self.chunk_min_positions
+        pending = collections.deque()
         processed_lines = 0
-
-        while layer_idx < len(model_data.all_layers):
-            with self.lock:
-                nlines = len(model_data)
-                remaining_lines = nlines - processed_lines
-                # Only reallocate memory which might be needed, not memory
-                # for everything
-                ntravelcoords = coords_count(remaining_lines) + travel_vertex_k
-                ncoords = coords_count(remaining_lines) + vertex_k
-                nindices = indices_count(remaining_lines) + index_k
-                if ncoords > vertices.size:
-                    self.travels.resize(ntravelcoords, refcheck = False)
-                    self.vertices.resize(ncoords, refcheck = False)
-                    self.colors.resize(ncoords, refcheck = False)
-                    self.normals.resize(ncoords, refcheck = False)
-                    self.indices.resize(nindices, refcheck = False)
+        # Moves of fully parsed G-Code are read from its per-move arrays
+        # rather than from its lines
+        layer_moves_arrays = LayerMoves(model_data) \
+            if model_data.move_arrays_current() else None
+
+        while True:
+            more_layers = layer_idx < len(model_data.all_layers)
+            if more_layers:
                 layer = model_data.all_layers[layer_idx]
-                has_movement = False
-                for gline_idx, gline in enumerate(layer):
-                    if not gline.is_move:
-                        continue
-                    if gline.x is None and gline.y is None and gline.z is None:
-                        continue
-                    has_movement = True
-                    current_pos = (gline.current_x, gline.current_y, gline.current_z)
-                    if not gline.extruding:
-                        travel_vertices[travel_vertex_k] = prev_pos[0]
-                        travel_vertices[travel_vertex_k + 1] = prev_pos[1]
-                        travel_vertices[travel_vertex_k + 2] = prev_pos[2]
-                        travel_vertices[travel_vertex_k + 3] = current_pos[0]
-                        travel_vertices[travel_vertex_k + 4] = current_pos[1]
-                        travel_vertices[travel_vertex_k + 5] = current_pos[2]
-                        travel_vertex_k += 6
-                        prev_is_extruding = False
-                    else:
-                        gline_color = self.movement_color(gline)
-
-                        next_move = get_next_move(model_data, layer_idx, gline_idx)
-                        next_is_extruding = (next_move.extruding
-                                             if next_move is not None else False)
-
-                        delta_x = current_pos[0] - prev_pos[0]
-                        delta_y = current_pos[1] - prev_pos[1]
-                        norm = delta_x * delta_x + delta_y * delta_y
-                        if norm == 0:  # Don't draw anything if this move is Z+E only
-                            continue
-                        norm = math.sqrt(norm)
-                        move_normal_x = - delta_y / norm
-                        move_normal_y = delta_x / norm
-                        move_angle = math.atan2(delta_y, delta_x)
-
-                        # FIXME: compute these dynamically
-                        path_halfwidth = self.path_halfwidth * 1.2
-                        path_halfheight = self.path_halfheight * 1.2
-
-                        new_indices = []
-                        new_vertices = []
-                        new_normals = []
-                        if prev_is_extruding:
-                            # Store previous vertices indices
-                            prev_id = vertex_k / 3 - 4
-                            avg_move_normal_x = (prev_move_normal_x + move_normal_x) / 2
-                            avg_move_normal_y = (prev_move_normal_y + move_normal_y) / 2
-                            norm = avg_move_normal_x * avg_move_normal_x + avg_move_normal_y * avg_move_normal_y
-                            if norm == 0:
-                                avg_move_normal_x = move_normal_x
-                                avg_move_normal_y = move_normal_y
-                            else:
-                                norm = math.sqrt(norm)
-                                avg_move_normal_x /= norm
-                                avg_move_normal_y /= norm
-                            delta_angle = move_angle - prev_move_angle
-                            delta_angle = (delta_angle + twopi) % twopi
-                            fact = abs(math.cos(delta_angle / 2))
-                            # If move is turning too much, avoid creating a big peak
-                            # by adding an intermediate box
-                            if fact < 0.5:
-                                # FIXME: It looks like there's some heavy code duplication here...
-                                hw = path_halfwidth
-                                p1x = prev_pos[0] - hw * prev_move_normal_x
-                                p2x = prev_pos[0] + hw * prev_move_normal_x
-                                p1y = prev_pos[1] - hw * prev_move_normal_y
-                                p2y = prev_pos[1] + hw * prev_move_normal_y
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] + path_halfheight))
-                                new_vertices.extend((p1x, p1y, prev_pos[2]))
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] - path_halfheight))
-                                new_vertices.extend((p2x, p2y, prev_pos[2]))
-                                new_normals.extend((0, 0, 1))
-                                new_normals.extend((-prev_move_normal_x, -prev_move_normal_y, 0))
-                                new_normals.extend((0, 0, -1))
-                                new_normals.extend((prev_move_normal_x, prev_move_normal_y, 0))
-                                first = vertex_k / 3
-                                # Link to previous
-                                new_indices += triangulate_box(prev_id, prev_id + 1,
-                                                               prev_id + 2, prev_id + 3,
-                                                               first, first + 1,
-                                                               first + 2, first + 3)
-                                p1x = prev_pos[0] - hw * move_normal_x
-                                p2x = prev_pos[0] + hw * move_normal_x
-                                p1y = prev_pos[1] - hw * move_normal_y
-                                p2y = prev_pos[1] + hw * move_normal_y
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] + path_halfheight))
-                                new_vertices.extend((p1x, p1y, prev_pos[2]))
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] - path_halfheight))
-                                new_vertices.extend((p2x, p2y, prev_pos[2]))
-                                new_normals.extend((0, 0, 1))
-                                new_normals.extend((-move_normal_x, -move_normal_y, 0))
-                                new_normals.extend((0, 0, -1))
-                                new_normals.extend((move_normal_x, move_normal_y, 0))
-                                prev_id += 4
-                                first += 4
-                                # Link to previous
-                                new_indices += triangulate_box(prev_id, prev_id + 1,
-                                                               prev_id + 2, prev_id + 3,
-                                                               first, first + 1,
-                                                               first + 2, first + 3)
-                            else:
-                                hw = path_halfwidth / fact
-                                # Compute vertices
-                                p1x = prev_pos[0] - hw * avg_move_normal_x
-                                p2x = prev_pos[0] + hw * avg_move_normal_x
-                                p1y = prev_pos[1] - hw * avg_move_normal_y
-                                p2y = prev_pos[1] + hw * avg_move_normal_y
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] + path_halfheight))
-                                new_vertices.extend((p1x, p1y, prev_pos[2]))
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] - path_halfheight))
-                                new_vertices.extend((p2x, p2y, prev_pos[2]))
-                                new_normals.extend((0, 0, 1))
-                                new_normals.extend((-avg_move_normal_x, -avg_move_normal_y, 0))
-                                new_normals.extend((0, 0, -1))
-                                new_normals.extend((avg_move_normal_x, avg_move_normal_y, 0))
-                                first = vertex_k / 3
-                                # Link to previous
-                                new_indices += triangulate_box(prev_id, prev_id + 1,
-                                                               prev_id + 2, prev_id + 3,
-                                                               first, first + 1,
-                                                               first + 2, first + 3)
-                        else:
-                            # Compute vertices normal to the current move and cap it
-                            p1x = prev_pos[0] - path_halfwidth * move_normal_x
-                            p2x = prev_pos[0] + path_halfwidth * move_normal_x
-                            p1y = prev_pos[1] - path_halfwidth * move_normal_y
-                            p2y = prev_pos[1] + path_halfwidth * move_normal_y
-                            new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] + path_halfheight))
-                            new_vertices.extend((p1x, p1y, prev_pos[2]))
-                            new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] - path_halfheight))
-                            new_vertices.extend((p2x, p2y, prev_pos[2]))
-                            new_normals.extend((0, 0, 1))
-                            new_normals.extend((-move_normal_x, -move_normal_y, 0))
-                            new_normals.extend((0, 0, -1))
-                            new_normals.extend((move_normal_x, move_normal_y, 0))
-                            first = vertex_k / 3
-                            new_indices = triangulate_rectangle(first, first + 1,
-                                                                first + 2, first + 3)
-
-                        if not next_is_extruding:
-                            # Compute caps and link everything
-                            p1x = current_pos[0] - path_halfwidth * move_normal_x
-                            p2x = current_pos[0] + path_halfwidth * move_normal_x
-                            p1y = current_pos[1] - path_halfwidth * move_normal_y
-                            p2y = current_pos[1] + path_halfwidth * move_normal_y
-                            new_vertices.extend((current_pos[0], current_pos[1], current_pos[2] + path_halfheight))
-                            new_vertices.extend((p1x, p1y, current_pos[2]))
-                            new_vertices.extend((current_pos[0], current_pos[1], current_pos[2] - path_halfheight))
-                            new_vertices.extend((p2x, p2y, current_pos[2]))
-                            new_normals.extend((0, 0, 1))
-                            new_normals.extend((-move_normal_x, -move_normal_y, 0))
-                            new_normals.extend((0, 0, -1))
-                            new_normals.extend((move_normal_x, move_normal_y, 0))
-                            end_first = vertex_k / 3 + len(new_vertices) / 3 - 4
-                            new_indices += triangulate_rectangle(end_first + 3, end_first + 2,
-                                                                 end_first + 1, end_first)
-                            new_indices += triangulate_box(first, first + 1,
-                                                           first + 2, first + 3,
-                                                           end_first, end_first + 1,
-                                                           end_first + 2, end_first + 3)
-
-                        for new_i, item in enumerate(new_indices):
-                            indices[index_k + new_i] = item
-                        index_k += len(new_indices)
-                        for new_i, item in enumerate(new_vertices):
-                            vertices[vertex_k + new_i] = item
-                        vertex_k += len(new_vertices)
-                        for new_i, item in enumerate(new_normals):
-                            normals[normal_k + new_i] = item
-                        normal_k += len(new_normals)
-                        new_colors = list(gline_color)[:-1] * (len(new_vertices) / 3)
-                        for new_i, item in enumerate(new_colors):
-                            colors[color_k + new_i] = item
-                        color_k += len(new_colors)
-
-                        prev_is_extruding = True
-                        prev_move_normal_x = move_normal_x
-                        prev_move_normal_y = move_normal_y
-                        prev_move_angle = move_angle
-
-                    prev_pos = current_pos
-                    count_travel_indices.append(travel_vertex_k / 3)
-                    count_print_indices.append(index_k)
-                    count_print_vertices.append(vertex_k / 3)
-                    gline.gcview_end_vertex = len(count_print_indices) - 1
-
-                if has_movement:
-                    self.layer_stops.append(len(count_print_indices) - 1)
-                    self.layer_idxs_map[layer_idx] = len(self.layer_stops) - 1
-                    self.max_layers = len(self.layer_stops) - 1
-                    self.num_layers_to_draw = self.max_layers + 1
-                    self.initialized = False
-                    self.loaded = True
-
-            processed_lines += len(layer)
+                if layer_moves_arrays is not None:
+                    (glines, gline_extruding, gline_next_extruding,
+                     positions, position_counts, tools) = \
+                        layer_moves_arrays.layer(layer_idx, state[1],
+                                                 self.arc_tolerance)
+                else:
+                    glines, gline_extruding, gline_next_extruding = \
+                        layer_moves(model_data, layer_idx)
+                    if glines:
+                        positions, position_counts = move_positions(
+                            glines, state[1], self.arc_tolerance)
+                        tools = numpy.fromiter([gline.current_tool for gline in glines],
+                                               dtype = numpy.intp, count = len(glines))
+
+                if glines:
+                    gline_colors = self.movement_colors(glines, gline_extruding,
+                                                        tools)
+                    chunk.append((positions, position_counts, gline_extruding,
+                                  gline_next_extruding, gline_colors[:, :3]))
+                    chunk_layers.append((layer_idx, glines, tools))
+                    chunk_positions += len(positions)
+                    state = layer_end_state(positions, position_counts,
+                                            gline_extruding, state)
+                chunk_lines += len(layer)
+
+            if chunk and (chunk_positions >= chunk_limit or not more_layers):
+                args = (chunk, chunk_state,
+                        self.path_halfwidth * 1.2, self.path_halfheight * 1.2,
+                        self.lod_tolerance, self.cull_chunk_moves)
+                if pool is not None:
+                    result = pool.apply_async(build_layers_mesh, args)
+                else:
+                    result = BuiltMeshes(build_layers_mesh(*args))
+                pending.append((result, chunk_layers, chunk_lines))
+                chunk = []
+                chunk_layers = []
+                chunk_state = state
+                chunk_lines = 0
+                chunk_positions = 0
+                chunk_limit = min(2 * chunk_limit, self.chunk_max_positions)
+
+            while pending and (not more_layers or pending[0][0].ready()):
+                result, built_layers, built_lines = pending.popleft()
+                layer_meshes = result.get()
+                # Indices were computed relative to the chunk start
+                chunk_vertex_base = mesh.appended
+                with self.lock:
+                    new_chunk_boxes = [self.chunk_boxes]
+                    new_layer_boxes = [self.layer_boxes]
+                    for (built_layer_idx, glines, tools), layer_mesh in zip(built_layers, layer_meshes):
+                        (layer_travels, layer_vertices, layer_normals,
+                         layer_indices, drawn,
+                         gline_travel_ends, gline_index_ends,
+                         gline_vertex_ends, layer_lod_vertices,
+                         layer_lod_colors, layer_chunk_ends,
+                         layer_chunk_boxes) = layer_mesh
+
+                        nlines = len(model_data)
+                        remaining_lines = nlines - processed_lines
+                        # Only reallocate memory which might be needed, not memory
+                        # for everything
+                        ntravelcoords = max(travel_coords_count(remaining_lines),
+                                            len(layer_travels)) + travel_vertex_k
+                        if ntravelcoords > travel_vertices.size:
+                            self.travels.resize(ntravelcoords, refcheck = False)
+                        mesh.reserve(max(vertices_count(remaining_lines),
+                                         len(layer_vertices) // coordspervertex),
+                                     max(indices_count(remaining_lines),
+                                         len(layer_indices)))
+                        nlodcoords = lod_vertex_k + len(layer_lod_vertices)
+                        if nlodcoords > lod_vertices.size:
+                            nlodcoords = max(nlodcoords, 2 * lod_vertices.size)
+                            self.lod_vertices.resize(nlodcoords, refcheck = False)
+                            self.lod_colors.resize(nlodcoords, refcheck = False)
+
+                        travel_vertices[travel_vertex_k:travel_vertex_k + len(layer_travels)] = layer_travels
+                        index_k = mesh.index_count
+                        packed_ends, blocks = mesh.append(
+                            layer_vertices.reshape(-1, 3),
+                            layer_normals.reshape(-1, 3),
+                            layer_indices.astype(numpy.intp) + chunk_vertex_base,
+                            gline_vertex_ends[drawn] // coordspervertex,
+                            gline_index_ends[drawn])
+                        lod_vertices[lod_vertex_k:lod_vertex_k + len(layer_lod_vertices)] = layer_lod_vertices
+                        lod_colors[lod_vertex_k:lod_vertex_k + len(layer_lod_colors)] = layer_lod_colors
+
+                        # Moves which did not produce anything are not counted
+                        count_k = len(count_print_indices)
+                        first_count = count_k
+                        self.chunk_stops.extend((layer_chunk_ends + count_k - 1).tolist())
+                        new_chunk_boxes.append(layer_chunk_boxes)
+                        layer_box = empty_boxes(1)
+                        if len(layer_chunk_boxes):
+                            layer_box[0, :3] = layer_chunk_boxes[:, :3].min(0)
+                            layer_box[0, 3:] = layer_chunk_boxes[:, 3:].max(0)
+                        new_layer_boxes.append(layer_box)
+                        for move_k in numpy.flatnonzero(drawn).tolist():
+                            glines[move_k].gcview_end_vertex = count_k
+                            count_k += 1
+                        extend_runs(self.block_stops, block_runs, blocks, first_count)
+                        extend_runs(self.color_stops, self.color_tools,
+                                    tools[drawn], first_count)
+                        count_travel_indices.extend(((gline_travel_ends[drawn] + travel_vertex_k) // 3).tolist())
+                        count_print_indices.extend((gline_index_ends[drawn] + index_k).tolist())
+                        count_print_vertices.extend(packed_ends.tolist())
+
+                        travel_vertex_k += len(layer_travels)
+                        lod_vertex_k += len(layer_lod_vertices)
+
+                        self.layer_stops.append(len(count_print_indices) - 1)
+                        self.lod_layer_stops.append(lod_vertex_k // 3)
+                        self.layer_idxs_map[built_layer_idx] = len(self.layer_stops) - 1
+                        self.max_layers = len(self.layer_stops) - 1
+                        self.num_layers_to_draw = self.max_layers + 1
+                        self.initialized = False
+                        self.loaded = True
+                    self.chunk_boxes = numpy.concatenate(new_chunk_boxes)
+                    self.layer_boxes = numpy.concatenate(new_layer_boxes)
+                processed_lines += built_lines
+
+            if not more_layers:
+                break
 
             if callback:
                 callback(layer_idx + 1)
@@ -635,12 +838,15 @@ class GcodeModel(Model):
                          (model_data.zmin, model_data.zmax, model_data.height))
 
             self.travels.resize(travel_vertex_k, refcheck = False)
-            self.vertices.resize(vertex_k, refcheck = False)
-            self.colors.resize(color_k, refcheck = False)
-            self.normals.resize(normal_k, refcheck = False)
-            self.indices.resize(index_k, refcheck = False)
+            mesh.trim()
+            self.lod_vertices.resize(lod_vertex_k, refcheck = False)
+            self.lod_colors.resize(lod_vertex_k, refcheck = False)
 
             self.layer_stops = array.array('L', self.layer_stops)
+            self.lod_layer_stops = array.array('L', self.lod_layer_stops)
+            self.chunk_stops = array.array('L', self.chunk_stops)
+            self.block_stops = array.array('L', self.block_stops)
+            self.color_stops = array.array('L', self.color_stops)
             self.count_travel_indices = array.array('L', count_travel_indices)
             self.count_print_indices = array.array('L', count_print_indices)
             self.count_print_vertices = array.array('L', count_print_vertices)
@@ -655,19 +861,33 @@ class GcodeModel(Model):
         t_end = time.time()
 
         logging.debug(_('Initialized 3D visualization in %.2f seconds') % (t_end - t_start))
-        logging.debug(_('Vertex count: %d') % ((len(self.vertices) + len(self.travels)) / 3))
+        logging.debug(_('Vertex count: %d') % (len(self.vertices) + len(self.travels) / 3))
         yield None
 
+    def _reload_buffer_arrays(self):
+        """Read the arrays dropped by init back from the mesh cache.
+        Returns False if they are gone."""
+        if self.vertices is not None:
+            return True
+        mesh = mesh_cache.get(self.mesh_key) if self.mesh_key is not None else None
+        if mesh is None:
+            return False
+        for var in self.buffer_attributes:
+            setattr(self, var, mesh[var])
+        return True
+
     def copy(self):
+        with self.lock:
+            self._reload_buffer_arrays()
         copy = GcodeModel()
-        for var in ["vertices", "colors", "travels", "indices", "normals",
-                    "max_layers", "num_layers_to_draw", "printed_until",
-                    "layer_stops", "dims", "only_current",
-                    "layer_idxs_map", "count_travel_indices",
-                    "count_print_indices", "count_print_vertices",
-                    "path_halfwidth", "path_halfheight",
-                    "gcode"]:
+        for var in self.mesh_attributes + (
+                "max_layers", "num_layers_to_draw", "printed_until",
+                "only_current", "path_halfwidth", "path_halfheight",
+                "lod", "detail_layers", "gcode"):
             setattr(copy, var, getattr(self, var))
+        # Share the cached mesh rather than letting the arrays go
+        if self.mesh_key is not None and mesh_cache.acquire(self.mesh_key) is not None:
+            copy.mesh_key = self.mesh_key
         copy.loaded = True
         copy.fully_loaded = True
         copy.initialized = False
@@ -679,27 +899,32 @@ class GcodeModel(Model):
 
     def init(self):
         with self.lock:
+            if not self._reload_buffer_arrays():
+                logging.error(_("Could not read the 3D view of %s back from the cache, please reload it") % getattr(self.gcode, "filename", None))
+                self.loaded = False
+                return
             self.layers_loaded = self.max_layers
             self.initialized = True
             if self.buffers_created:
                 self.travel_buffer.delete()
                 self.index_buffer.delete()
                 self.vertex_buffer.delete()
-                self.vertex_color_buffer.delete()
-                self.vertex_normal_buffer.delete()
+                self.lod_vertex_buffer.delete()
+                self.lod_color_buffer.delete()
             self.travel_buffer = numpy2vbo(self.travels, use_vbos = self.use_vbos)
             self.index_buffer = numpy2vbo(self.indices, use_vbos = self.use_vbos,
                                           target = GL_ELEMENT_ARRAY_BUFFER)
             self.vertex_buffer = numpy2vbo(self.vertices, use_vbos = self.use_vbos)
-            self.vertex_color_buffer = numpy2vbo(self.colors, use_vbos = self.use_vbos)
-            self.vertex_normal_buffer = numpy2vbo(self.normals, use_vbos = self.use_vbos)
-            if self.fully_loaded:
-                # Delete numpy arrays after creating VBOs after full load
-                self.travels = None
-                self.indices = None
-                self.vertices = None
-                self.colors = None
-                self.normals = None
+            self.lod_vertex_buffer = numpy2vbo(self.lod_vertices, use_vbos = self.use_vbos)
+            self.lod_color_buffer = numpy2vbo(self.lod_colors, use_vbos = self.use_vbos)
+            # Delete numpy arrays after creating VBOs after full load. Meshes
+            # shared with other models are only dropped if saved to disk,
+            # init and copy reading them back when needed.
+            if self.fully_loaded and \
+               (not self.use_mesh_cache and self.mesh_key is None or
+                self.mesh_key is not None and mesh_cache.unload(self.mesh_key)):
+                for var in self.buffer_attributes:
+                    setattr(self, var, None)
             self.buffers_created = True
 
     def display(self, mode_2d=False):
@@ -712,9 +937,18 @@ class GcodeModel(Model):
             if self.display_travels:
                 self._display_travels(has_vbo)
 
+            self._cull()
+            lod_layers = self._lod_layers(self.layers_loaded)
+            self._detail_start = self.layer_stops[lod_layers] + 1
+            if lod_layers:
+                glEnableClientState(GL_COLOR_ARRAY)
+                self._display_lod(lod_layers)
+
+            glDisableClientState(GL_COLOR_ARRAY)
             glEnable(GL_LIGHTING)
+            # Normals are scaled with the quantized positions of blocks
+            glEnable(GL_NORMALIZE)
             glEnableClientState(GL_NORMAL_ARRAY)
-            glEnableClientState(GL_COLOR_ARRAY)
             glMaterialfv(GL_FRONT, GL_SPECULAR, vec(1, 1, 1, 1))
             glMaterialfv(GL_FRONT_AND_BACK, GL_EMISSION, vec(0, 0, 0, 0))
             glMaterialf(GL_FRONT_AND_BACK, GL_SHININESS, 50)
@@ -722,6 +956,7 @@ class GcodeModel(Model):
             glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
             self._display_movements(has_vbo)
 
+            glDisable(GL_NORMALIZE)
             glDisable(GL_LIGHTING)
 
             glDisableClientState(GL_COLOR_ARRAY)
@@ -750,27 +985,145 @@ class GcodeModel(Model):
 
         self.travel_buffer.unbind()
 
-    def _draw_elements(self, start, end, draw_type = GL_TRIANGLES):
+    def _pixels_per_unit(self):
+        """Size on screen in pixels of a unit of length at the center of the
+        model, which depends on both the zoom and the distance to it"""
+        modelview = (GLdouble * 16)()
+        projection = (GLdouble * 16)()
+        viewport = (GLint * 4)()
+        glGetDoublev(GL_MODELVIEW_MATRIX, modelview)
+        glGetDoublev(GL_PROJECTION_MATRIX, projection)
+        glGetIntegerv(GL_VIEWPORT, viewport)
+        if hasattr(self, "dims"):
+            center = [(dim[0] + dim[1]) / 2 for dim in self.dims]
+        else:
+            center = (0, 0, 0)
+        eye = [modelview[i] * center[0] + modelview[4 + i] * center[1] +
+               modelview[8 + i] * center[2] + modelview[12 + i]
+               for i in range(3)]
+        w = projection[3] * eye[0] + projection[7] * eye[1] + \
+            projection[11] * eye[2] + projection[15]
+        if w <= 0:
+            return 0
+        scale = math.sqrt(modelview[0] ** 2 + modelview[1] ** 2 + modelview[2] ** 2)
+        return scale * projection[5] * viewport[3] / (2 * w)
+
+    def _cull(self):
+        """Tell which chunks and layers are in view"""
+        if self.frustum is None:
+            self._visible_chunks = None
+            self._visible_layers = None
+            return
+        frustum = self.frustum.copy()
+        # Moving the model by its offset moves the planes the other way
+        frustum[:, 3] += frustum[:, 0] * self.offset_x + frustum[:, 1] * self.offset_y
+        self._visible_chunks = boxes_in_frustum(self.chunk_boxes, frustum)
+        self._visible_layers = boxes_in_frustum(self.layer_boxes, frustum)
+
+    def _lod_layers(self, max_layers):
+        """Number of layers, from the bottom, to draw as simplified lines"""
+        if not self.lod or self.only_current:
+            return 0
+        top = min(self.num_layers_to_draw, max_layers)
+        if 2 * self.path_halfwidth * self._pixels_per_unit() < self.lod_min_pixels:
+            # Keep the selected layer as it is highlighted
+            if self.num_layers_to_draw <= max_layers:
+                return top - 1
+            return top
+        if self.detail_layers:
+            return max(top - self.detail_layers, 0)
+        return 0
+
+    def _display_lod(self, lod_layers):
+        self.lod_vertex_buffer.bind()
+        glVertexPointer(3, GL_FLOAT, 0, self.lod_vertex_buffer.ptr)
+
+        self.lod_color_buffer.bind()
+        glColorPointer(3, GL_UNSIGNED_BYTE, 0, self.lod_color_buffer.ptr)
+
+        # Simplified layers are shown as printed once fully printed
+        printed_layers = bisect.bisect_right(self.layer_stops, self.printed_until) - 1
+        printed_end = self.lod_layer_stops[min(printed_layers, lod_layers)]
+
+        for first, last in visible_runs(self._visible_layers, 1, lod_layers):
+            start = self.lod_layer_stops[first - 1]
+            end = self.lod_layer_stops[last]
+            if printed_end > start:
+                glDisableClientState(GL_COLOR_ARRAY)
+                glColor3f(*self.color_printed[:-1])
+                glDrawArrays(GL_LINES, start, min(end, printed_end) - start)
+                glEnableClientState(GL_COLOR_ARRAY)
+                start = printed_end
+            if end > start:
+                glDrawArrays(GL_LINES, start, end - start)
+
+        self.lod_vertex_buffer.unbind()
+        self.lod_color_buffer.unbind()
+
+    def tool_color(self, tool):
+        return getattr(self, "color_tool%d" % min(tool, 4))
+
+    def _draw_elements(self, start, end, colored = False):
+        # Layers drawn as simplified lines are skipped
+        start = max(start, self._detail_start)
+        if start > end:
+            return
+        if self._visible_chunks is None:
+            self._draw_range(start, end, colored)
+            return
+        # Only draw the chunks in view, merging consecutive ones
+        first = bisect.bisect_left(self.chunk_stops, start) - 1
+        last = bisect.bisect_left(self.chunk_stops, end) - 1
+        for first, last in visible_runs(self._visible_chunks, first, last):
+            self._draw_range(max(start, self.chunk_stops[first] + 1),
+                             min(end, self.chunk_stops[last + 1]), colored)
+
+    def _draw_range(self, start, end, colored):
+        """Draw moves from start to end, block by block, in their tool
+        colors if colored and in the current color otherwise"""
+        block = bisect.bisect_left(self.block_stops, start) - 1
+        while start <= end:
+            block_end = min(end, self.block_stops[block + 1])
+            block_start = self.block_starts[block]
+            # Vertices are relative to the origin of their block, and so
+            # are indices to its first vertex
+            offset = self.vertex_buffer.ptr + block_start * packed_vertex.itemsize
+            glVertexPointer(3, GL_SHORT, packed_vertex.itemsize, offset)
+            glNormalPointer(GL_BYTE, packed_vertex.itemsize,
+                            offset + packed_vertex.fields["normal"][1])
+            glPushMatrix()
+            glTranslated(*self.block_origins[block])
+            step = self.block_steps[block]
+            glScaled(step, step, step)
+            if colored:
+                run = bisect.bisect_left(self.color_stops, start) - 1
+                run_start = start
+                while run_start <= block_end:
+                    run_end = min(block_end, self.color_stops[run + 1])
+                    glColor3f(*self.tool_color(self.color_tools[run])[:-1])
+                    self._draw_block_range(block_start, run_start, run_end)
+                    run_start = run_end + 1
+                    run += 1
+            else:
+                self._draw_block_range(block_start, start, block_end)
+            glPopMatrix()
+            start = block_end + 1
+            block += 1
+
+    def _draw_block_range(self, block_start, start, end):
         # Don't attempt printing empty layer
         if self.count_print_indices[end] == self.count_print_indices[start - 1]:
             return
-        glDrawRangeElements(draw_type,
-                            self.count_print_vertices[start - 1],
-                            self.count_print_vertices[end] - 1,
+        # Tubes may be joined to the last ring of the previous move
+        glDrawRangeElements(GL_TRIANGLES,
+                            max(self.count_print_vertices[start - 1] - 4, block_start) - block_start,
+                            self.count_print_vertices[end] - 1 - block_start,
                             self.count_print_indices[end] - self.count_print_indices[start - 1],
-                            GL_UNSIGNED_INT,
-                            sizeof(GLuint) * self.count_print_indices[start - 1])
+                            GL_UNSIGNED_SHORT,
+                            self.index_buffer.ptr + sizeof(GLushort) * self.count_print_indices[start - 1])
 
     def _display_movements(self, has_vbo):
         self.vertex_buffer.bind()
-        glVertexPointer(3, GL_FLOAT, 0, self.vertex_buffer.ptr)
-
-        self.vertex_color_buffer.bind()
-        glColorPointer(3, GL_FLOAT, 0, self.vertex_color_buffer.ptr)
-
-        self.vertex_normal_buffer.bind()
-        glNormalPointer(GL_FLOAT, 0, self.vertex_normal_buffer.ptr)
-
         self.index_buffer.bind()
 
         # Prevent race condition by using the number of currently loaded layers
@@ -784,8 +1137,6 @@ class GcodeModel(Model):
             end_prev_layer = 0
         end = self.layer_stops[min(self.num_layers_to_draw, max_layers)]
 
-        glDisableClientState(GL_COLOR_ARRAY)
-
         glColor3f(*self.color_printed[:-1])
 
         # Draw printed stuff until end or end_prev_layer
@@ -796,19 +1147,15 @@ class GcodeModel(Model):
             elif cur_end >= 1:
                 self._draw_elements(1, cur_end)
 
-        glEnableClientState(GL_COLOR_ARRAY)
-
         # Draw nonprinted stuff until end_prev_layer
         start = max(cur_end, 1)
         if end_prev_layer >= start:
             if not self.only_current:
-                self._draw_elements(start, end_prev_layer)
+                self._draw_elements(start, end_prev_layer, colored = True)
             cur_end = end_prev_layer
 
         # Draw current layer
         if layer_selected:
-            glDisableClientState(GL_COLOR_ARRAY)
-
             glColor3f(*self.color_current_printed[:-1])
 
             if cur_end > end_prev_layer:
@@ -819,17 +1166,13 @@ class GcodeModel(Model):
             if end > cur_end:
                 self._draw_elements(cur_end + 1, end)
 
-            glEnableClientState(GL_COLOR_ARRAY)
-
         # Draw non printed stuff until end (if not ending at a given layer)
         start = max(self.printed_until, 1)
         if not layer_selected and end >= start:
-            self._draw_elements(start, end)
+            self._draw_elements(start, end, colored = True)
 
         self.index_buffer.unbind()
         self.vertex_buffer.unbind()
-        self.vertex_color_buffer.unbind()
-        self.vertex_normal_buffer.unbind()
 
 class GcodeModelLight(Model):
     """
@@ -847,12 +1190,52 @@ class GcodeModelLight(Model):
     color_current_printed = (0.1, 0.4, 0, 0.8)
 
     buffers_created = False
+    vertex_index_buffer = None
     use_vbos = True
     loaded = False
     fully_loaded = False
 
     gcode = None
 
+    # Maximum distance between arcs and the segments used to draw them
+    arc_tolerance = 0.02
+
+    # Color the printed and current parts in a GLSL program, drawing the
+    # model in one call, when the GL context supports it
+    use_shaders = True
+    program = None
+
+    # Vertex indices are passed as floats, exact up to 2 ** 24
+    max_shader_vertices = 2 ** 24
+
+    vertex_shader = """
+        attribute float vertex_index;
+        uniform float printed_until;
+        uniform float current_start;
+        uniform float current_end;
+        uniform vec4 color_printed;
+        uniform vec4 color_current;
+        uniform vec4 color_current_printed;
+        varying vec4 color;
+
+        void main() {
+            gl_Position = ftransform();
+            bool printed = vertex_index < printed_until;
+            if (vertex_index >= current_start && vertex_index < current_end)
+                color = printed ? color_current_printed : color_current;
+            else
+                color = printed ? color_printed : gl_Color;
+        }
+    """
+
+    fragment_shader = """
+        varying vec4 color;
+
+        void main() {
+            gl_FragColor = color;
+        }
+    """
+
     def load_data(self, model_data, callback=None):
         t_start = time.time()
         self.gcode = model_data
@@ -869,42 +1252,45 @@ class GcodeModelLight(Model):
         color_k = 0
         self.printed_until = -1
         self.only_current = False
+        # Number of segments added by arcs on top of one per line
+        arc_lines = 0
         while layer_idx < len(model_data.all_layers):
             with self.lock:
-                nlines = len(model_data)
+                layer = model_data.all_layers[layer_idx]
+                glines = [gline for gline in layer
+                          if gline.is_move and
+                          (gline.x is not None or gline.y is not None
+                           or gline.z is not None
+                           or gline.command == "G2" or gline.command == "G3")]
+                has_movement = bool(glines)
+                if has_movement:
+                    positions, position_counts = move_positions(
+                        glines, prev_pos, self.arc_tolerance)
+                    arc_lines += len(positions) - len(glines)
+                nlines = len(model_data) + arc_lines
                 if nlines * 6 != vertices.size:
                     self.vertices.resize(nlines * 6, refcheck = False)
                     self.colors.resize(nlines * 8, refcheck = False)
-                layer = model_data.all_layers[layer_idx]
-                has_movement = False
-                for gline in layer:
-                    if not gline.is_move:
-                        continue
-                    if gline.x is None and gline.y is None and gline.z is None:
-                        continue
-                    has_movement = True
-                    vertices[vertex_k] = prev_pos[0]
-                    vertices[vertex_k + 1] = prev_pos[1]
-                    vertices[vertex_k + 2] = prev_pos[2]
-                    current_pos = (gline.current_x, gline.current_y, gline.current_z)
-                    vertices[vertex_k + 3] = current_pos[0]
-                    vertices[vertex_k + 4] = current_pos[1]
-                    vertices[vertex_k + 5] = current_pos[2]
-                    vertex_k += 6
-
-                    vertex_color = self.movement_color(gline)
-                    colors[color_k] = vertex_color[0]
-                    colors[color_k + 1] = vertex_color[1]
-                    colors[color_k + 2] = vertex_color[2]
-                    colors[color_k + 3] = vertex_color[3]
-                    colors[color_k + 4] = vertex_color[0]
-                    colors[color_k + 5] = vertex_color[1]
-                    colors[color_k + 6] = vertex_color[2]
-                    colors[color_k + 7] = vertex_color[3]
-                    color_k += 8
-
-                    prev_pos = current_pos
-                    gline.gcview_end_vertex = vertex_k / 3
+                if has_movement:
+                    # Lines from each position to the next one
+                    layer_vertices = numpy.empty((len(positions), 2, 3))
+                    layer_vertices[0, 0] = prev_pos
+                    layer_vertices[1:, 0] = positions[:-1]
+                    layer_vertices[:, 1] = positions
+                    extruding = numpy.fromiter([gline.extruding for gline in glines],
+                                               dtype = bool, count = len(glines))
+                    layer_colors = self.movement_colors(glines, extruding)
+                    layer_colors = numpy.repeat(numpy.tile(layer_colors, 2),
+                                                position_counts, axis = 0)
+                    vertices[vertex_k:vertex_k + layer_vertices.size] = layer_vertices.ravel()
+                    colors[color_k:color_k + layer_colors.size] = layer_colors.ravel()
+                    end_vertices = vertex_k / 3 + 2 * numpy.cumsum(position_counts)
+                    end_vertices = end_vertices.tolist()
+                    for move_k, gline in enumerate(glines):
+                        gline.gcview_end_vertex = end_vertices[move_k]
+                    vertex_k += layer_vertices.size
+                    color_k += layer_colors.size
+                    prev_pos = tuple(positions[-1].tolist())
 
                 if has_movement:
                     self.layer_stops.append(vertex_k / 3)
@@ -962,14 +1348,49 @@ class GcodeModelLight(Model):
             if self.buffers_created:
                 self.vertex_buffer.delete()
                 self.vertex_color_buffer.delete()
+                if self.vertex_index_buffer is not None:
+                    self.vertex_index_buffer.delete()
             self.vertex_buffer = numpy2vbo(self.vertices, use_vbos = self.use_vbos)
             self.vertex_color_buffer = numpy2vbo(self.colors, use_vbos = self.use_vbos)  # each pair of vertices shares the color
+            self.vertex_index_buffer = None
+            if self.init_program():
+                vertex_indices = numpy.arange(len(self.vertices) / 3,
+                                              dtype = GLfloat)
+                self.vertex_index_buffer = numpy2vbo(vertex_indices,
+                                                     use_vbos = self.use_vbos)
             if self.fully_loaded:
                 # Delete numpy arrays after creating VBOs after full load
                 self.vertices = None
                 self.colors = None
             self.buffers_created = True
 
+    def init_program(self):
+        """Compile the GLSL program on first use, returning whether it can
+        be used to draw the model"""
+        if not self.use_shaders \
+           or len(self.vertices) / 3 > self.max_shader_vertices:
+            return False
+        if self.program is not None:
+            return True
+        if not shaders_available():
+            self.use_shaders = False
+            return False
+        try:
+            self.program = compile_program(self.vertex_shader,
+                                           self.fragment_shader)
+        except ShaderError as e:
+            logging.warning(_("Could not compile 3D viewer shaders, falling back to the slower drawing: %s") % e)
+            self.use_shaders = False
+            return False
+        self.uniforms = dict((name, glGetUniformLocation(self.program, name))
+                             for name in ["printed_until", "current_start",
+                                          "current_end", "color_printed",
+                                          "color_current",
+                                          "color_current_printed"])
+        self.vertex_index_location = glGetAttribLocation(self.program,
+                                                         "vertex_index")
+        return True
+
     def display(self, mode_2d=False):
         with self.lock:
             glPushMatrix()
@@ -977,7 +1398,10 @@ class GcodeModelLight(Model):
             glEnableClientState(GL_VERTEX_ARRAY)
             glEnableClientState(GL_COLOR_ARRAY)
 
-            self._display_movements(mode_2d)
+            if self.vertex_index_buffer is not None:
+                self._display_movements_program(mode_2d)
+            else:
+                self._display_movements(mode_2d)
 
             glDisableClientState(GL_COLOR_ARRAY)
             glDisableClientState(GL_VERTEX_ARRAY)
@@ -1060,3 +1484,65 @@ class GcodeModelLight(Model):
 
         self.vertex_buffer.unbind()
         self.vertex_color_buffer.unbind()
+
+    def _display_movements_program(self, mode_2d=False):
+        self.vertex_buffer.bind()
+        has_vbo = isinstance(self.vertex_buffer, VertexBufferObject)
+        if has_vbo:
+            glVertexPointer(3, GL_FLOAT, 0, None)
+        else:
+            glVertexPointer(3, GL_FLOAT, 0, self.vertex_buffer.ptr)
+
+        self.vertex_color_buffer.bind()
+        if has_vbo:
+            glColorPointer(4, GL_FLOAT, 0, None)
+        else:
+            glColorPointer(4, GL_FLOAT, 0, self.vertex_color_buffer.ptr)
+
+        self.vertex_index_buffer.bind()
+        glEnableVertexAttribArray(self.vertex_index_location)
+        if has_vbo:
+            glVertexAttribPointer(self.vertex_index_location, 1, GL_FLOAT,
+                                  GL_FALSE, 0, None)
+        else:
+            glVertexAttribPointer(self.vertex_index_location, 1, GL_FLOAT,
+                                  GL_FALSE, 0, self.vertex_index_buffer.ptr)
+
+        # Prevent race condition by using the number of currently loaded layers
+        max_layers = self.layers_loaded
+
+        if self.num_layers_to_draw <= max_layers:
+            end_prev_layer = self.layer_stops[self.num_layers_to_draw - 1]
+        else:
+            end_prev_layer = -1
+        end = self.layer_stops[min(self.num_layers_to_draw, max_layers)]
+
+        glUseProgram(self.program)
+        uniforms = self.uniforms
+        glUniform1f(uniforms["printed_until"], self.printed_until)
+        glUniform1f(uniforms["current_start"], end_prev_layer)
+        glUniform1f(uniforms["current_end"], end if end_prev_layer >= 0 else -1)
+        glUniform4f(uniforms["color_printed"], *self.color_printed)
+        glUniform4f(uniforms["color_current"], *self.color_current)
+        glUniform4f(uniforms["color_current_printed"],
+                    *self.color_current_printed)
+
+        if end_prev_layer < 0:
+            if not self.only_current and end > 0:
+                glDrawArrays(GL_LINES, 0, end)
+        else:
+            if not self.only_current and end_prev_layer > 0:
+                glDrawArrays(GL_LINES, 0, end_prev_layer)
+            # The current layer only needs its own call for its wider lines
+            orig_linewidth = (GLfloat)()
+            glGetFloatv(GL_LINE_WIDTH, orig_linewidth)
+            glLineWidth(2.0)
+            if end > end_prev_layer:
+                glDrawArrays(GL_LINES, end_prev_layer, end - end_prev_layer)
+            glLineWidth(orig_linewidth)
+
+        glUseProgram(0)
+        glDisableVertexAttribArray(self.vertex_index_location)
+        self.vertex_index_buffer.unbind()
+        self.vertex_buffer.unbind()
+        self.vertex_color_buffer.unbind()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Cache of the meshes of the 3D G-Code viewer. Meshes are shared by every
+# model showing the same G-Code with the same parameters, and saved to disk
+# so that opening a file again skips meshing.
+
+import os
+import glob
+import hashlib
+import logging
+import tempfile
+import threading
+import cPickle as pickle
+
+from printrun.utils import install_locale
+install_locale('pronterface')
+
+class MeshCache(object):
+    """Reference counted meshes, as dicts of model attributes, kept in
+    memory while some model uses them. When a directory is set, meshes of
+    G-Code read from files are also saved there, keyed by the path, size
+    and modification time of the file. Saved meshes can be dropped from
+    memory once uploaded to the GPU, and are read again when needed."""
+
+    # Bumped whenever the layout of saved meshes changes
+    version = 1
+    # Number of meshes kept on disk, the least recently used being removed
+    max_files = 16
+
+    def __init__(self, directory = None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def acquire(self, key):
+        """Return the mesh stored under key, adding a reference to it, or
+        None if there is none"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            mesh = self._entry_mesh(entry)
+            if mesh is None:
+                return None
+            entry[1] += 1
+            return mesh
+
+    def get(self, key):
+        """Return the mesh stored under key without adding a reference to
+        it, reading it again if it was unloaded, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            return self._entry_mesh(entry)
+
+    def _entry_mesh(self, entry):
+        if entry[0] is None:
+            # Kept for the next models rather than read for each of them
+            entry[0] = self.load(entry[2])
+        return entry[0]
+
+    def store(self, key, mesh, path = None):
+        """Store mesh under key with a first reference to it, path being
+        where it is saved, if it is. If another model stored a mesh under
+        key meanwhile, a reference to that one is added and it is returned
+        instead."""
+        with self.lock:
+            entry = self.entries.setdefault(key, [mesh, 0, path])
+            if entry[0] is None:
+                entry[0] = mesh
+            entry[1] += 1
+            return entry[0]
+
+    def unload(self, key):
+        """Drop the mesh stored under key from memory if it is saved to
+        disk, keeping its references. Returns whether it was dropped."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] is None \
+               or not os.path.exists(entry[2]):
+                return False
+            entry[0] = None
+            return True
+
+    def release(self, key):
+        """Drop a reference to the mesh stored under key, forgetting it
+        once no model uses it anymore"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.entries[key]
+
+    def file_path(self, filename, params):
+        """Path of the saved mesh of G-Code read from filename, or None
+        when it cannot be saved"""
+        if self.directory is None or not filename:
+            return None
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        key = repr((self.version, os.path.abspath(filename), stat.st_size,
+                    stat.st_mtime, params))
+        return os.path.join(self.directory,
+                            hashlib.md5(key).hexdigest() + ".mesh")
+
+    def load(self, path):
+        """Return the mesh saved at path, or None"""
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                mesh = pickle.load(f)
+            # Mark the file as recently used
+            os.utime(path, None)
+            return mesh
+        except Exception as e:
+            logging.warning(_("Could not load cached 3D mesh %s: %s") % (path, e))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def save(self, path, mesh):
+        if path is None:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file first so that readers never see
+            # partial meshes
+            fd, temp_path = tempfile.mkstemp(dir = self.directory,
+                                             suffix = ".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(mesh, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, path)
+            self._trim()
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logging.warning(_("Could not cache 3D mesh to %s: %s") % (path, e))
+
+    def _trim(self):
+        paths = glob.glob(os.path.join(self.directory, "*.mesh"))
+        if len(paths) <= self.max_files:
+            return
+        paths.sort(key = os.path.getmtime)
+        # Meshes only kept on disk are still in use
+        with self.lock:
+            unloaded = set(entry[2] for entry in self.entries.values()
+                           if entry[0] is None)
+        for path in paths[:-self.max_files]:
+            if path in unloaded:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
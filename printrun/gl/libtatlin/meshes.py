@@ -0,0 +1,722 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013 Guillaume Seguin
+# Copyright (C) 2011 Denis Kobozev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Extrusion meshes of the 3D G-Code viewer. This module does not depend on
+# GL so that meshes can be built in worker processes.
+
+import math
+import numpy
+
+from printrun import gcoder
+
+def get_next_move(gcode, layer_idx, gline_idx):
+    gline_idx += 1
+    while layer_idx < len(gcode.all_layers):
+        layer = gcode.all_layers[layer_idx]
+        while gline_idx < len(layer):
+            gline = layer[gline_idx]
+            if gline.is_move:
+                return gline
+            gline_idx += 1
+        layer_idx += 1
+        gline_idx = 0
+    return None
+
+def move_positions(glines, start_pos, tolerance):
+    """Positions moves go through, arcs being split into segments at most
+    tolerance away from the true arcs. Returns the (N, 3) array of the
+    positions and the number of them for each move."""
+    count = len(glines)
+    positions = numpy.empty((count, 3))
+    positions[:, 0] = numpy.fromiter([gline.current_x for gline in glines],
+                                     dtype = numpy.float64, count = count)
+    positions[:, 1] = numpy.fromiter([gline.current_y for gline in glines],
+                                     dtype = numpy.float64, count = count)
+    positions[:, 2] = numpy.fromiter([gline.current_z for gline in glines],
+                                     dtype = numpy.float64, count = count)
+    commands = [gline.command for gline in glines]
+    if "G2" not in commands and "G3" not in commands:
+        return positions, numpy.ones(count, dtype = numpy.intp)
+    arcs = [move_k for move_k, command in enumerate(commands)
+            if command == "G2" or command == "G3"]
+    arc_glines = [glines[move_k] for move_k in arcs]
+    return split_arcs(
+        positions, numpy.array(arcs), start_pos,
+        numpy.array([gline.i or 0 for gline in arc_glines], dtype = numpy.float64),
+        numpy.array([gline.j or 0 for gline in arc_glines], dtype = numpy.float64),
+        numpy.array([gline.command == "G2" for gline in arc_glines]),
+        tolerance)
+
+def split_arcs(positions, arcs, start_pos, arc_i, arc_j, arc_cw, tolerance):
+    """Insert the points of the arc moves arcs, of center offsets arc_i and
+    arc_j, into the (N, 3) positions of moves, as move_positions does"""
+    counts = numpy.ones(len(positions), dtype = numpy.intp)
+    if not len(arcs):
+        return positions, counts
+    starts = positions[arcs - 1]
+    if arcs[0] == 0:
+        starts[0] = start_pos
+    ends = positions[arcs]
+    points, offsets = gcoder.tessellate_arcs(
+        starts[:, 0], starts[:, 1], starts[:, 2],
+        ends[:, 0], ends[:, 1], ends[:, 2],
+        arc_i, arc_j, arc_cw, tolerance)
+    counts[arcs] = numpy.diff(offsets)
+    move_offsets = numpy.cumsum(counts) - counts
+    positions = numpy.repeat(positions, counts, axis = 0)
+    positions[numpy.repeat(move_offsets[arcs] - offsets[:-1], counts[arcs]) +
+              numpy.arange(offsets[-1])] = points
+    return positions, counts
+
+def layer_moves(gcode, layer_idx):
+    """Moves of a layer which go somewhere, whether they extrude and
+    whether the moves following them extrude"""
+    layer = gcode.all_layers[layer_idx]
+    moves = [gline for gline in layer if gline.is_move]
+    extruding = numpy.fromiter([gline.extruding for gline in moves],
+                               dtype = bool, count = len(moves))
+    # Extrusion tubes are capped unless the next move extrudes
+    next_move = get_next_move(gcode, layer_idx + 1, -1)
+    next_extruding = numpy.empty(len(moves), dtype = bool)
+    next_extruding[:-1] = extruding[1:]
+    next_extruding[-1:] = bool(next_move.extruding) \
+        if next_move is not None else False
+    kept = [move_k for move_k, gline in enumerate(moves)
+            if gline.x is not None or gline.y is not None
+            or gline.z is not None
+            or gline.command == "G2" or gline.command == "G3"]
+    kept_idxs = numpy.array(kept, dtype = numpy.intp)
+    return ([moves[move_k] for move_k in kept], extruding[kept_idxs],
+            next_extruding[kept_idxs])
+
+class LayerMoves(object):
+    """Same results as layer_moves and move_positions, plus the tools of
+    the moves, read from the per-move arrays of a GCode instead of its
+    lines. Only valid while gcode.move_arrays_current() holds."""
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+        self.starts = numpy.searchsorted(
+            gcode.move_layers(), numpy.arange(len(gcode.all_layers) + 1))
+        self.extruding = gcode.move_e > 0
+        self.is_arc = numpy.zeros(len(gcode.move_idxs), dtype = bool)
+        self.is_arc[gcode.arc_moves] = True
+        self.kept = gcode.move_xyz | self.is_arc
+
+    def layer(self, layer_idx, start_pos, tolerance):
+        """Moves of a layer which go somewhere, whether they extrude and
+        whether the moves following them extrude, their positions and
+        number of positions as move_positions gives them, starting from
+        start_pos, and their tools"""
+        gcode = self.gcode
+        first = self.starts[layer_idx]
+        last = self.starts[layer_idx + 1]
+        extruding = self.extruding[first:last]
+        # Extrusion tubes are capped unless the next move extrudes
+        next_extruding = numpy.empty(len(extruding), dtype = bool)
+        next_extruding[:-1] = extruding[1:]
+        next_extruding[-1:] = last < len(self.extruding) and self.extruding[last]
+        kept = first + numpy.flatnonzero(self.kept[first:last])
+        lines = gcode.lines
+        glines = [lines[line_idx] for line_idx in gcode.move_idxs[kept].tolist()]
+        positions = numpy.column_stack((gcode.move_x[kept], gcode.move_y[kept],
+                                        gcode.move_z[kept]))
+        arcs = numpy.flatnonzero(self.is_arc[kept])
+        arc_idxs = numpy.searchsorted(gcode.arc_moves, kept[arcs])
+        positions, counts = split_arcs(positions, arcs, start_pos,
+                                       gcode.arc_i[arc_idxs],
+                                       gcode.arc_j[arc_idxs],
+                                       gcode.arc_cw[arc_idxs], tolerance)
+        return (glines, extruding[kept - first], next_extruding[kept - first],
+                positions, counts, gcode.move_tool[kept].astype(numpy.intp))
+
+def triangulate_rectangle(i1, i2, i3, i4):
+    return [i1, i4, i3, i3, i2, i1]
+
+def triangulate_box(i1, i2, i3, i4,
+                    j1, j2, j3, j4):
+    return [i1, i2, j2, j2, j1, i1, i2, i3, j3, j3, j2, i2,
+            i3, i4, j4, j4, j3, i3, i4, i1, j1, j1, j4, i4]
+
+# Vertex indices of the triangles of the rings of 4 vertices making up
+# extrusion tubes, relative to the first vertex of the ring: tubes start
+# with a capped ring, rings are then linked to the previous ones and the
+# last ring also gets a cap
+RING_START = 0
+RING_JOIN = 1
+RING_END = 2
+ring_box = triangulate_box(-4, -3, -2, -1, 0, 1, 2, 3)
+ring_triangles = numpy.array([triangulate_rectangle(0, 1, 2, 3) + [0] * 24,
+                              ring_box + [0] * 6,
+                              triangulate_rectangle(3, 2, 1, 0) + ring_box])
+ring_triangles_counts = numpy.array([6, 24, 30])
+
+def _layer_paths(positions, position_counts, extruding, prev_pos):
+    """Tell which positions of a layer are reached by travels and by drawn
+    extrusions, and where the segments ending at them start."""
+    npositions = len(positions)
+    move_of = numpy.repeat(numpy.arange(len(position_counts)), position_counts)
+    move_ends = numpy.cumsum(position_counts)
+    travel = ~extruding[move_of]
+
+    # Extrusion segments which do not move in XY are skipped and do not
+    # become the start of the next segment. As their XY position is the
+    # one of their start, this can be told from the previous position.
+    prev_xy = numpy.empty((npositions, 2))
+    prev_xy[0] = prev_pos[:2]
+    prev_xy[1:] = positions[:-1, :2]
+    delta_x = positions[:, 0] - prev_xy[:, 0]
+    delta_y = positions[:, 1] - prev_xy[:, 1]
+    drawn = ~travel & (delta_x * delta_x + delta_y * delta_y != 0)
+    used = travel | drawn
+    # Last used position before each one, -1 if in a previous layer
+    last_used = numpy.where(used, numpy.arange(npositions), -1)
+    numpy.maximum.accumulate(last_used, out = last_used)
+    before = numpy.empty(npositions, dtype = numpy.intp)
+    before[0] = -1
+    before[1:] = last_used[:-1]
+    starts = positions[before]
+    starts[before < 0] = prev_pos
+    return move_of, move_ends, travel, drawn, used, before, starts
+
+def layer_end_state(positions, position_counts, extruding, state):
+    """Compute the state build_layer_mesh returns for a layer without
+    building its mesh, leaving the vertex count of state unchanged."""
+    (vertex_base, prev_pos, prev_is_extruding,
+     prev_normal_x, prev_normal_y, prev_angle) = state
+    paths = _layer_paths(positions, position_counts, extruding, prev_pos)
+    drawn, used, starts = paths[3], paths[4], paths[6]
+    used_idxs = numpy.flatnonzero(used)
+    if len(used_idxs):
+        prev_pos = tuple(positions[used_idxs[-1]].tolist())
+        prev_is_extruding = bool(drawn[used_idxs[-1]])
+    segments = numpy.flatnonzero(drawn)[-1:]
+    if len(segments):
+        # Same computation as in build_layer_mesh, for the last segment
+        delta_x = positions[segments, 0] - starts[segments, 0]
+        delta_y = positions[segments, 1] - starts[segments, 1]
+        norm = numpy.sqrt(delta_x * delta_x + delta_y * delta_y)
+        prev_normal_x = (- delta_y / norm)[0]
+        prev_normal_y = (delta_x / norm)[0]
+        prev_angle = numpy.arctan2(delta_y, delta_x)[0]
+    return (vertex_base, prev_pos, prev_is_extruding,
+            prev_normal_x, prev_normal_y, prev_angle)
+
+def build_layer_mesh(positions, position_counts, extruding, next_extruding,
+                     colors, state, path_halfwidth, path_halfheight):
+    """Compute the travel lines and extrusion tubes of a layer at once.
+
+    Moves go through position_counts[k] of the positions each, extruding,
+    next_extruding and colors tell whether each move extrudes, whether the
+    move following it extrudes and the RGB color of its tube. state is the
+    (vertex count, position, whether the last move was extruding, its
+    normal and angle) tuple returned for the previous layer.
+
+    Returns the travel vertices, tube vertices, normals, colors and indices
+    as flat arrays, whether each move produced anything, the cumulated
+    travel coordinates, indices and tube coordinates counts at the end of
+    each move and the new state."""
+    (vertex_base, prev_pos, prev_is_extruding,
+     prev_normal_x, prev_normal_y, prev_angle) = state
+    npositions = len(positions)
+    move_of, move_ends, travel, drawn, used, before, starts = \
+        _layer_paths(positions, position_counts, extruding, prev_pos)
+    is_last = numpy.zeros(npositions, dtype = bool)
+    is_last[move_ends - 1] = True
+
+    travel_idxs = numpy.flatnonzero(travel)
+    travels = numpy.empty((len(travel_idxs), 2, 3))
+    travels[:, 0] = starts[travel_idxs]
+    travels[:, 1] = positions[travel_idxs]
+
+    segments = numpy.flatnonzero(drawn)
+    nsegments = len(segments)
+    start_x, start_y, start_z = starts[segments].T
+    end_x, end_y, end_z = positions[segments].T
+    delta_x = end_x - start_x
+    delta_y = end_y - start_y
+    norm = numpy.sqrt(delta_x * delta_x + delta_y * delta_y)
+    move_normal_x = - delta_y / norm
+    move_normal_y = delta_x / norm
+    move_angle = numpy.arctan2(delta_y, delta_x)
+
+    # Segments following an extruding one are joined to it
+    segment_before = before[segments]
+    after_first = segment_before >= 0
+    all_normal_x = numpy.zeros(npositions)
+    all_normal_y = numpy.zeros(npositions)
+    all_angle = numpy.zeros(npositions)
+    all_normal_x[segments] = move_normal_x
+    all_normal_y[segments] = move_normal_y
+    all_angle[segments] = move_angle
+    joined = numpy.where(after_first, drawn[segment_before], prev_is_extruding)
+    prev_move_normal_x = numpy.where(after_first, all_normal_x[segment_before], prev_normal_x)
+    prev_move_normal_y = numpy.where(after_first, all_normal_y[segment_before], prev_normal_y)
+    prev_move_angle = numpy.where(after_first, all_angle[segment_before], prev_angle)
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        avg_move_normal_x = (prev_move_normal_x + move_normal_x) / 2
+        avg_move_normal_y = (prev_move_normal_y + move_normal_y) / 2
+        norm = avg_move_normal_x * avg_move_normal_x + avg_move_normal_y * avg_move_normal_y
+        flat = norm == 0
+        norm = numpy.sqrt(norm)
+        avg_move_normal_x = numpy.where(flat, move_normal_x, avg_move_normal_x / norm)
+        avg_move_normal_y = numpy.where(flat, move_normal_y, avg_move_normal_y / norm)
+        twopi = 2 * math.pi
+        delta_angle = move_angle - prev_move_angle
+        delta_angle = (delta_angle + twopi) % twopi
+        fact = numpy.abs(numpy.cos(delta_angle / 2))
+        miter_halfwidth = path_halfwidth / fact
+    # If move is turning too much, avoid creating a big peak by adding an
+    # intermediate box
+    sharp = joined & (fact < 0.5)
+    mitered = joined & ~sharp
+    capped = is_last[segments] & \
+        ~next_extruding[move_of[segments]]
+
+    # Up to 3 rings per segment: start or join ring, second ring of sharp
+    # joins and end ring
+    used_rings = numpy.column_stack((numpy.ones(nsegments, dtype = bool),
+                                     sharp, capped))
+    halfwidths = numpy.empty(nsegments)
+    halfwidths.fill(path_halfwidth)
+
+    def rings(first, second, third):
+        return numpy.column_stack((first, second, third))[used_rings]
+    ring_x = rings(start_x, start_x, end_x)
+    ring_y = rings(start_y, start_y, end_y)
+    ring_z = rings(start_z, start_z, end_z)
+    ring_normal_x = rings(numpy.where(sharp, prev_move_normal_x,
+                                      numpy.where(mitered, avg_move_normal_x,
+                                                  move_normal_x)),
+                          move_normal_x, move_normal_x)
+    ring_normal_y = rings(numpy.where(sharp, prev_move_normal_y,
+                                      numpy.where(mitered, avg_move_normal_y,
+                                                  move_normal_y)),
+                          move_normal_y, move_normal_y)
+    ring_halfwidth = rings(numpy.where(mitered, miter_halfwidth, path_halfwidth),
+                           halfwidths, halfwidths)
+    ring_kind = rings(numpy.where(joined, RING_JOIN, RING_START),
+                      numpy.repeat(RING_JOIN, nsegments),
+                      numpy.repeat(RING_END, nsegments))
+    segment_moves = move_of[segments]
+    ring_move = rings(segment_moves, segment_moves, segment_moves)
+    nrings = len(ring_x)
+
+    vertices = numpy.empty((nrings, 4, 3))
+    vertices[:, 0, 0] = ring_x
+    vertices[:, 0, 1] = ring_y
+    vertices[:, 0, 2] = ring_z + path_halfheight
+    vertices[:, 1, 0] = ring_x - ring_halfwidth * ring_normal_x
+    vertices[:, 1, 1] = ring_y - ring_halfwidth * ring_normal_y
+    vertices[:, 1, 2] = ring_z
+    vertices[:, 2, 0] = ring_x
+    vertices[:, 2, 1] = ring_y
+    vertices[:, 2, 2] = ring_z - path_halfheight
+    vertices[:, 3, 0] = ring_x + ring_halfwidth * ring_normal_x
+    vertices[:, 3, 1] = ring_y + ring_halfwidth * ring_normal_y
+    vertices[:, 3, 2] = ring_z
+    normals = numpy.zeros((nrings, 4, 3))
+    normals[:, 0, 2] = 1
+    normals[:, 1, 0] = - ring_normal_x
+    normals[:, 1, 1] = - ring_normal_y
+    normals[:, 2, 2] = -1
+    normals[:, 3, 0] = ring_normal_x
+    normals[:, 3, 1] = ring_normal_y
+    vertex_colors = numpy.repeat(colors[ring_move], 4, axis = 0)
+    ring_first = vertex_base + 4 * numpy.arange(nrings)
+    indices = (ring_first[:, None] + ring_triangles[ring_kind])[
+        numpy.arange(30) < ring_triangles_counts[ring_kind][:, None]]
+
+    # Cumulated counts at the end of each move
+    position_rings = numpy.zeros(npositions, dtype = numpy.intp)
+    position_rings[segments] = used_rings.sum(1)
+    position_indices = numpy.zeros(npositions, dtype = numpy.intp)
+    position_indices[segments] = numpy.where(joined, 24, 6) + 24 * sharp + 30 * capped
+    travel_ends = numpy.cumsum(travel * 6)[move_ends - 1]
+    index_ends = numpy.cumsum(position_indices)[move_ends - 1]
+    vertex_ends = numpy.cumsum(position_rings * 12)[move_ends - 1]
+    moved = numpy.logical_or.reduceat(used, move_ends - position_counts)
+
+    used_idxs = numpy.flatnonzero(used)
+    if len(used_idxs):
+        prev_pos = tuple(positions[used_idxs[-1]].tolist())
+        prev_is_extruding = bool(drawn[used_idxs[-1]])
+    if nsegments:
+        prev_normal_x = move_normal_x[-1]
+        prev_normal_y = move_normal_y[-1]
+        prev_angle = move_angle[-1]
+    state = (vertex_base + 4 * nrings, prev_pos, prev_is_extruding,
+             prev_normal_x, prev_normal_y, prev_angle)
+    return (travels.ravel(), vertices.ravel(), normals.ravel(),
+            vertex_colors.ravel(), indices, moved,
+            travel_ends, index_ends, vertex_ends, state)
+
+def simplify_polylines(points, firsts, lasts, tolerance, farthest_levels = 8):
+    """Douglas-Peucker simplification of the polylines going through
+    points[firsts[k]:lasts[k] + 1], all of them being split at once, one
+    level of recursion at a time. Past farthest_levels levels, sections are
+    split at their middle rather than at their farthest point, so that
+    paths like zigzag infill, which only lose one point per level, still
+    take a logarithmic number of levels. Returns whether each point is
+    kept."""
+    keep = numpy.zeros(len(points), dtype = bool)
+    keep[firsts] = True
+    keep[lasts] = True
+    squared_tolerance = tolerance * tolerance
+    los = numpy.asarray(firsts)
+    his = numpy.asarray(lasts)
+    level = 0
+    while True:
+        sections = his - los > 1
+        los = los[sections]
+        his = his[sections]
+        if not len(los):
+            break
+        # Distances of the inner points of each section to the segment
+        # joining its ends
+        counts = his - los - 1
+        offsets = numpy.cumsum(counts) - counts
+        section_of = numpy.repeat(numpy.arange(len(los)), counts)
+        idxs = numpy.arange(counts.sum()) - offsets[section_of] + \
+            los[section_of] + 1
+        starts = points[los][section_of]
+        directions = points[his][section_of] - starts
+        relative = points[idxs] - starts
+        lengths = (directions * directions).sum(1)
+        lengths[lengths == 0] = 1
+        along = numpy.clip((relative * directions).sum(1) / lengths, 0, 1)
+        relative -= along[:, None] * directions
+        distances = (relative * relative).sum(1)
+        # Split sections at their farthest point if it is too far
+        max_distances = numpy.maximum.reduceat(distances, offsets)
+        split = max_distances > squared_tolerance
+        if level < farthest_levels:
+            farthest = numpy.flatnonzero(distances == max_distances[section_of])
+            farthest = farthest[numpy.searchsorted(section_of[farthest],
+                                                   numpy.arange(len(los)))]
+            splits = idxs[farthest[split]]
+        else:
+            splits = (los[split] + his[split]) // 2
+        level += 1
+        keep[splits] = True
+        los, his = (numpy.concatenate((los[split], splits)),
+                    numpy.concatenate((splits, his[split])))
+    return keep
+
+def layers_polylines(positions, position_counts, extruding, colors, prev_pos,
+                     layer_moves):
+    """Split the extrusions of consecutive layers, whose first moves are
+    layer_moves, into polylines of a single color. Returns the points of
+    the polylines, their colors, the indices of the first and last point
+    of each polyline and the index of the first point of each layer."""
+    move_of, move_ends, travel, drawn, used, before, starts = \
+        _layer_paths(positions, position_counts, extruding, prev_pos)
+    segments = numpy.flatnonzero(drawn)
+    if not len(segments):
+        empty = numpy.zeros(0, dtype = numpy.intp)
+        return numpy.zeros((0, 3)), numpy.zeros((0, 3)), empty, empty, \
+            numpy.zeros(len(layer_moves), dtype = numpy.intp)
+    segment_moves = move_of[segments]
+    segment_colors = colors[segment_moves]
+    # Polylines go on while extrusions follow each other with one color,
+    # within a layer
+    segment_before = before[segments]
+    segment_layers = numpy.searchsorted(layer_moves, segment_moves, "right")
+    new_polyline = numpy.ones(len(segments), dtype = bool)
+    new_polyline[1:] = (segment_before[1:] != segments[:-1]) | \
+        (segment_colors[1:] != segment_colors[:-1]).any(1) | \
+        (segment_layers[1:] != segment_layers[:-1])
+    # Points are the ends of the segments, plus the starts of polylines
+    end_points = numpy.arange(len(segments)) + numpy.cumsum(new_polyline)
+    firsts = end_points[new_polyline] - 1
+    lasts = numpy.empty(len(firsts), dtype = numpy.intp)
+    lasts[:-1] = firsts[1:] - 1
+    lasts[-1] = end_points[-1]
+    points = numpy.empty((end_points[-1] + 1, 3))
+    points[end_points] = positions[segments]
+    points[firsts] = starts[segments[new_polyline]]
+    point_colors = numpy.empty((len(points), 3))
+    point_colors[end_points] = segment_colors
+    point_colors[firsts] = segment_colors[new_polyline]
+    # Layers start with a polyline, or are empty
+    layer_segments = numpy.searchsorted(segment_moves, layer_moves)
+    layer_points = numpy.append(end_points - 1, len(points))[layer_segments]
+    return points, point_colors, firsts, lasts, layer_points
+
+def build_layers_lines(points, point_colors, firsts, lasts, layer_starts,
+                       tolerance):
+    """Compute simplified lines standing for the extrusion tubes of layers
+    when they are too small on screen to be told apart, from the
+    layers_polylines of consecutive layers, which are simplified together
+    within tolerance. Returns the vertices and colors of the lines of each
+    layer as flat arrays."""
+    polyline_of = numpy.zeros(len(points), dtype = numpy.intp)
+    polyline_of[firsts] = 1
+    polyline_of = numpy.cumsum(polyline_of)
+
+    kept = numpy.flatnonzero(simplify_polylines(points, firsts, lasts,
+                                                tolerance))
+    lines = numpy.column_stack((kept[:-1], kept[1:]))
+    lines = lines[polyline_of[kept[:-1]] == polyline_of[kept[1:]]]
+    # Lines never span two polylines, hence two layers
+    line_ends = numpy.searchsorted(lines[:, 0], layer_starts[1:])
+    return [(points[layer_lines].ravel(), point_colors[layer_lines].ravel())
+            for layer_lines in numpy.split(lines, line_ends)]
+
+def chunk_boxes(vertices, vertex_ends, moved, chunk_moves):
+    """Bounding boxes of the tubes of groups of chunk_moves consecutive
+    moves among the ones which produced anything, as (min x, min y, min z,
+    max x, max y, max z) rows. Groups without tubes get empty boxes.
+    Returns the number of such moves at the end of each group and the
+    boxes."""
+    move_vertex_ends = vertex_ends[moved] // 3
+    nmoves = len(move_vertex_ends)
+    ends = numpy.arange(chunk_moves, nmoves + chunk_moves, chunk_moves)
+    ends[-1:] = nmoves
+    stops = numpy.zeros(len(ends) + 1, dtype = numpy.intp)
+    stops[1:] = move_vertex_ends[ends - 1]
+    boxes = numpy.empty((len(ends), 6))
+    boxes[:, :3] = numpy.inf
+    boxes[:, 3:] = -numpy.inf
+    nonempty = stops[1:] > stops[:-1]
+    if nonempty.any():
+        points = vertices.reshape(-1, 3)
+        starts = stops[:-1][nonempty]
+        boxes[nonempty, :3] = numpy.minimum.reduceat(points, starts)
+        boxes[nonempty, 3:] = numpy.maximum.reduceat(points, starts)
+    return ends, boxes
+
+# Vertices of extrusion tubes, positions being quantized relative to the
+# origin of their block and normals scaled to bytes, 12 bytes in all
+packed_vertex = numpy.dtype([("position", numpy.int16, 4),
+                             ("normal", numpy.int8, 4)])
+BLOCK_VERTICES = 65536
+
+class PackedMesh(object):
+    """Extrusion tubes stored as packed vertices and 16 bits indices.
+
+    Vertices are split into blocks of at most BLOCK_VERTICES, each block
+    having its own origin and quantization step, and indices count from
+    the first vertex of their block. Moves are never split across blocks,
+    and blocks start with a copy of the last ring of the previous block
+    so that tubes can be joined across them."""
+
+    # Finest quantization step, steps being powers of two
+    min_step = 2.0 ** -10
+
+    def __init__(self, nvertices, nindices):
+        self.vertices = numpy.zeros(nvertices, dtype = packed_vertex)
+        self.indices = numpy.zeros(nindices, dtype = numpy.uint16)
+        self.vertex_count = 0
+        self.index_count = 0
+        self.block_starts = []
+        self.block_origins = []
+        self.block_steps = []
+        # Number of vertices appended, not counting copies, and index of
+        # the first vertex of the last block among them
+        self.appended = 0
+        self.block_base = 0
+        self.block_centered = False
+        # Unpacked vertices of the last block, as lists of arrays only
+        # concatenated when the block has to be quantized again
+        self.block_positions = []
+        self.block_normals = []
+        self.block_size = 0
+
+    def reserve(self, nvertices, nindices):
+        """Make room for nvertices more vertices and nindices more
+        indices, leaving room for copies made when starting blocks"""
+        nvertices += self.vertex_count + 4 * (nvertices // (BLOCK_VERTICES - 4) + 2)
+        nindices += self.index_count
+        if nvertices > self.vertices.size:
+            self.vertices.resize(nvertices, refcheck = False)
+        if nindices > self.indices.size:
+            self.indices.resize(nindices, refcheck = False)
+
+    def trim(self):
+        self.vertices.resize(self.vertex_count, refcheck = False)
+        self.indices.resize(self.index_count, refcheck = False)
+        self.block_positions = None
+        self.block_normals = None
+        self.block_size = 0
+
+    def append(self, positions, normals, indices, vertex_ends, index_ends):
+        """Append the (N, 3) positions and normals of the tube vertices of
+        moves and the indices of their triangles, counting from the first
+        vertex ever appended. vertex_ends and index_ends are the numbers of
+        vertices and indices at the end of each move.
+
+        Returns the number of packed vertices at the end of each move and
+        the block of each move."""
+        nmoves = len(vertex_ends)
+        packed_ends = numpy.empty(nmoves, dtype = numpy.intp)
+        blocks = numpy.empty(nmoves, dtype = numpy.intp)
+        if not self.block_starts:
+            self._start_block(copy_ring = False)
+        move_k = vertex_k = index_k = 0
+        while move_k < nmoves:
+            room = self.block_base + BLOCK_VERTICES - self.appended
+            fit = numpy.searchsorted(vertex_ends, vertex_k + room, "right")
+            if fit == move_k:
+                if self.block_size > 4:
+                    self._start_block(copy_ring = True)
+                    continue
+                # Moves larger than blocks cannot happen with sane files
+                fit = move_k + 1
+            vertex_end = vertex_ends[fit - 1]
+            index_end = index_ends[fit - 1]
+            packed_ends[move_k:fit] = self.block_starts[-1] + self.appended - \
+                self.block_base + vertex_ends[move_k:fit] - vertex_k
+            self._add(positions[vertex_k:vertex_end], normals[vertex_k:vertex_end],
+                      indices[index_k:index_end])
+            blocks[move_k:fit] = len(self.block_starts) - 1
+            self.appended += vertex_end - vertex_k
+            move_k, vertex_k, index_k = fit, vertex_end, index_end
+            if move_k < nmoves:
+                self._start_block(copy_ring = True)
+        self.appended += len(positions) - vertex_k
+        return packed_ends, blocks
+
+    def _start_block(self, copy_ring):
+        self.block_starts.append(self.vertex_count)
+        # The origin is the center of the first tubes added to the block
+        self.block_origins.append((0.0, 0.0, 0.0))
+        self.block_centered = False
+        self.block_steps.append(self.min_step)
+        if copy_ring and self.block_size:
+            ring_positions = self._block_array(self.block_positions)[-4:]
+            ring_normals = self._block_array(self.block_normals)[-4:]
+            self.block_positions = [ring_positions]
+            self.block_normals = [ring_normals]
+            self.block_size = len(ring_positions)
+        else:
+            self.block_positions = []
+            self.block_normals = []
+            self.block_size = 0
+        self.block_base = self.appended - self.block_size
+        self.vertex_count += self.block_size
+
+    def _block_array(self, arrays):
+        """Concatenate the arrays of the last block, keeping the result"""
+        if len(arrays) > 1:
+            arrays[:] = [numpy.concatenate(arrays)]
+        return arrays[0]
+
+    def _add(self, positions, normals, indices):
+        block_start = self.block_starts[-1]
+        first = self.block_size
+        self.block_positions.append(positions.astype(numpy.float64))
+        self.block_normals.append(normals.astype(numpy.float64))
+        self.block_size += len(positions)
+        if not self.block_size:
+            # Nothing to quantize before the first tube of the block
+            return
+        if not self.block_centered:
+            self.block_centered = True
+            block_positions = self._block_array(self.block_positions)
+            lower = block_positions.min(0)
+            upper = block_positions.max(0)
+            self.block_origins[-1] = tuple(((lower + upper) / 2).tolist())
+            first = 0
+        # Coarsen the step until the block fits, then quantize everything
+        origin = numpy.array(self.block_origins[-1])
+        new_positions = self.block_positions[-1] if first else \
+            self._block_array(self.block_positions)
+        new_normals = self.block_normals[-1] if first else \
+            self._block_array(self.block_normals)
+        extent = numpy.abs(new_positions - origin).max() \
+            if len(new_positions) else 0
+        step = self.block_steps[-1]
+        if extent > 32767 * step:
+            while extent > 32767 * step:
+                step *= 2
+            self.block_steps[-1] = step
+            first = 0
+            new_positions = self._block_array(self.block_positions)
+            new_normals = self._block_array(self.block_normals)
+        end = block_start + self.block_size
+        packed = self.vertices[block_start + first:end]
+        packed["position"][:, :3] = numpy.rint((new_positions - origin) / step)
+        packed["normal"][:, :3] = numpy.rint(new_normals * 127)
+        self.vertex_count = end
+        self.indices[self.index_count:self.index_count + len(indices)] = \
+            indices - self.block_base
+        self.index_count += len(indices)
+
+def build_layers_mesh(layers, state, path_halfwidth, path_halfheight,
+                      lod_tolerance, chunk_moves):
+    """Build the meshes, simplified lines and bounding boxes of consecutive
+    layers, given as (positions, position_counts, extruding, next_extruding,
+    colors) tuples, starting from state. Used by worker processes, the results are
+    converted to the types of the model buffers to keep them small.
+
+    As meshes only depend on the state left by the previous moves, all the
+    layers are built at once and the results split by layer afterwards."""
+    if not layers:
+        return []
+    layer_moves = numpy.array([len(layer[2]) for layer in layers])
+    move_ends = numpy.cumsum(layer_moves)
+    move_starts = move_ends - layer_moves
+    positions, position_counts, extruding, next_extruding, colors = \
+        [numpy.concatenate(arrays) for arrays in zip(*layers)]
+    (points, point_colors, firsts, lasts,
+     layer_points) = layers_polylines(positions, position_counts, extruding,
+                                      colors, state[1], move_starts)
+    lines = build_layers_lines(points, point_colors, firsts, lasts,
+                               layer_points, lod_tolerance)
+    mesh = build_layer_mesh(positions, position_counts, extruding,
+                            next_extruding, colors, state,
+                            path_halfwidth, path_halfheight)
+    (travels, vertices, normals, vertex_colors, indices, moved,
+     travel_ends, index_ends, vertex_ends) = mesh[:-1]
+    # Tube colors are drawn from the tool palette
+    travels = travels.astype(numpy.float32)
+    vertices32 = vertices.astype(numpy.float32)
+    normals = normals.astype(numpy.float32)
+    indices = indices.astype(numpy.uint32)
+
+    def bounds(ends):
+        """Bounds of the slices of each layer in arrays of cumulated ends"""
+        layer_bounds = numpy.zeros(len(layers) + 1, dtype = numpy.intp)
+        layer_bounds[1:] = ends[move_ends - 1]
+        return layer_bounds.tolist()
+    travel_bounds = bounds(travel_ends)
+    index_bounds = bounds(index_ends)
+    vertex_bounds = bounds(vertex_ends)
+    meshes = []
+    for layer_k, (lod_vertices, lod_colors) in enumerate(lines):
+        first = move_starts[layer_k]
+        last = move_ends[layer_k]
+        travel_first, travel_last = travel_bounds[layer_k:layer_k + 2]
+        index_first, index_last = index_bounds[layer_k:layer_k + 2]
+        vertex_first, vertex_last = vertex_bounds[layer_k:layer_k + 2]
+        layer_vertex_ends = vertex_ends[first:last] - vertex_first
+        box_ends, boxes = chunk_boxes(vertices[vertex_first:vertex_last],
+                                      layer_vertex_ends, moved[first:last],
+                                      chunk_moves)
+        meshes.append((travels[travel_first:travel_last],
+                       vertices32[vertex_first:vertex_last],
+                       normals[vertex_first:vertex_last],
+                       indices[index_first:index_last], moved[first:last],
+                       travel_ends[first:last] - travel_first,
+                       index_ends[first:last] - index_first,
+                       layer_vertex_ends,
+                       lod_vertices.astype(numpy.float32),
+                       numpy.rint(lod_colors * 255).astype(numpy.uint8),
+                       box_ends, boxes))
+    return meshes
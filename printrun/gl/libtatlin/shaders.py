@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Compilation of the GLSL programs of the 3D viewers
+
+import ctypes
+
+from pyglet.gl import gl_info, GLint, GLchar, GL_TRUE, \
+    GL_VERTEX_SHADER, GL_FRAGMENT_SHADER, GL_COMPILE_STATUS, GL_LINK_STATUS, \
+    GL_INFO_LOG_LENGTH, glCreateShader, glShaderSource, glCompileShader, \
+    glGetShaderiv, glGetShaderInfoLog, glDeleteShader, glCreateProgram, \
+    glAttachShader, glLinkProgram, glGetProgramiv, glGetProgramInfoLog, \
+    glDeleteProgram
+
+class ShaderError(Exception):
+    pass
+
+def shaders_available():
+    """Whether the current GL context runs GLSL programs"""
+    try:
+        return gl_info.have_version(2, 0)
+    except Exception:
+        return False
+
+def _info_log(obj, get_iv, get_log):
+    length = GLint(0)
+    get_iv(obj, GL_INFO_LOG_LENGTH, ctypes.byref(length))
+    log = ctypes.create_string_buffer(max(length.value, 1))
+    get_log(obj, length, None, log)
+    return log.value
+
+def compile_shader(shader_type, source):
+    shader = glCreateShader(shader_type)
+    source_buffer = ctypes.create_string_buffer(source)
+    source_ptr = ctypes.cast(ctypes.pointer(ctypes.pointer(source_buffer)),
+                             ctypes.POINTER(ctypes.POINTER(GLchar)))
+    glShaderSource(shader, 1, source_ptr, None)
+    glCompileShader(shader)
+    status = GLint(0)
+    glGetShaderiv(shader, GL_COMPILE_STATUS, ctypes.byref(status))
+    if status.value != GL_TRUE:
+        log = _info_log(shader, glGetShaderiv, glGetShaderInfoLog)
+        glDeleteShader(shader)
+        raise ShaderError(log)
+    return shader
+
+def compile_program(vertex_source, fragment_source):
+    """Compile and link a GLSL program in the current GL context, raising
+    ShaderError with the compiler log when it fails"""
+    vertex_shader = compile_shader(GL_VERTEX_SHADER, vertex_source)
+    try:
+        fragment_shader = compile_shader(GL_FRAGMENT_SHADER, fragment_source)
+    except ShaderError:
+        glDeleteShader(vertex_shader)
+        raise
+    program = glCreateProgram()
+    glAttachShader(program, vertex_shader)
+    glAttachShader(program, fragment_shader)
+    glLinkProgram(program)
+    # The shaders are freed along with the program
+    glDeleteShader(vertex_shader)
+    glDeleteShader(fragment_shader)
+    status = GLint(0)
+    glGetProgramiv(program, GL_LINK_STATUS, ctypes.byref(status))
+    if status.value != GL_TRUE:
+        log = _info_log(program, glGetProgramiv, glGetProgramInfoLog)
+        glDeleteProgram(program)
+        raise ShaderError(log)
+    return program
@@ -41,6 +41,9 @@ class NoViz(object):
     def addgcodehighlight(self, *a, **kw):
         pass
 
+    def addprinthighlight(self, *a, **kw):
+        pass
+
     def Refresh(self, *a):
         pass
 
@@ -13,8 +13,8 @@
 # You should have received a copy of the GNU General Public License
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
-from Queue import Queue
-from collections import deque
+from collections import OrderedDict
+import math
 import numpy
 import wx
 import time
@@ -107,7 +107,6 @@ class GvizWindow(GvizBaseFrame):
         self.p.layerindex = self.layerslider.GetValue()
         z = self.p.get_currentz()
         wx.CallAfter(self.SetStatusText, _("Layer %d - Z = %.03f mm") % (self.p.layerindex + 1, z), 0)
-        self.p.dirty = True
         wx.CallAfter(self.p.Refresh)
 
     def resetview(self, event):
@@ -126,7 +125,6 @@ class GvizWindow(GvizBaseFrame):
                 self.basetrans = self.p.translate
             self.p.translate = [self.basetrans[0] + (e[0] - self.initpos[0]),
                                 self.basetrans[1] + (e[1] - self.initpos[1])]
-            self.p.dirty = True
             wx.CallAfter(self.p.Refresh)
         else:
             event.Skip()
@@ -157,8 +155,87 @@ class GvizWindow(GvizBaseFrame):
             if z > 0: self.p.zoom(event.GetX(), event.GetY(), 1.2)
             elif z < 0: self.p.zoom(event.GetX(), event.GetY(), 1 / 1.2)
 
+def lookup(sorted_values, values):
+    """Index of each of values in sorted_values, or -1 where missing"""
+    idxs = numpy.searchsorted(sorted_values, values)
+    found = idxs < len(sorted_values)
+    found[found] = sorted_values[idxs[found]] == values[found]
+    return numpy.where(found, idxs, -1)
+
+def append_rows(array, count, rows):
+    """Append rows after the first count rows of array, growing it
+    geometrically, and return it with its new count of rows"""
+    rows = numpy.asarray(rows, dtype = array.dtype).reshape((-1,) + array.shape[1:])
+    total = count + len(rows)
+    if total > len(array):
+        grown = numpy.empty((max(total, 2 * len(array), 64),) + array.shape[1:],
+                            dtype = array.dtype)
+        grown[:count] = array[:count]
+        array = grown
+    array[count:total] = rows
+    return array, total
+
+class HighlightRing(object):
+    """Ring buffer passing the line indices of the moves sent while printing
+    from the print thread to the viewer without locks: the print thread
+    pushes indices one at a time and the viewer pops all of them at once.
+    When the viewer falls more than capacity indices behind, the oldest ones
+    are dropped."""
+
+    def __init__(self, capacity = 65536):
+        self.capacity = capacity
+        self.indices = numpy.zeros(capacity, dtype = numpy.int64)
+        self.pushed = 0
+        self.popped = 0
+
+    def push(self, index):
+        self.indices[self.pushed % self.capacity] = index
+        self.pushed += 1
+
+    def pop(self):
+        """Indices pushed since the last pop, and whether some were
+        dropped"""
+        pushed = self.pushed
+        start = max(self.popped, pushed - self.capacity)
+        indices = self.indices[numpy.arange(start, pushed) % self.capacity]
+        # Drop the indices which were overwritten while being copied,
+        # including the one of a push in progress
+        overwritten = self.pushed + 1 - self.capacity
+        if overwritten > start:
+            indices = indices[overwritten - start:]
+            start = overwritten
+        dropped = start > self.popped
+        self.popped = pushed
+        return indices, dropped
+
+    def skip(self):
+        self.popped = self.pushed
+
+class GvizTile(object):
+    """Rendering of a square of the bed, with the number of layers (or, when
+    showing all of them, of the first layers) and of highlighted moves it
+    shows"""
+
+    __slots__ = ("bitmap", "layers", "hilights", "hilightarcs")
+
+    def __init__(self, bitmap):
+        self.bitmap = bitmap
+        self.layers = None
+        self.hilights = 0
+        self.hilightarcs = 0
+
 class Gviz(wx.Panel):
 
+    # The bed is drawn from square tiles of tile_size pixels, rendered when
+    # first shown and kept for each layer and zoom level until they take
+    # more than tile_cache_size bytes, the least recently shown ones being
+    # dropped first. Setting dirty drops them all.
+    tile_size = 256
+    tile_cache_size = 64 * 1024 * 1024
+
+    # Maximum distance in pixels between arcs and the segments drawing them
+    arc_tolerance = 0.3
+
     # Mark canvas as dirty when setting showall
     _showall = 0
 
@@ -183,10 +260,10 @@ class Gviz(wx.Panel):
         self.grid = grid
         self.Bind(wx.EVT_PAINT, self.paint)
         self.Bind(wx.EVT_SIZE, self.resize)
-        self.hilight = deque()
-        self.hilightarcs = deque()
-        self.hilightqueue = Queue(0)
-        self.hilightarcsqueue = Queue(0)
+        self.hilight = numpy.empty((0, 4), dtype = numpy.float32)
+        self.hilightarcs = numpy.empty((0, 6), dtype = numpy.float32)
+        self.hilightring = HighlightRing()
+        self.tiles = OrderedDict()
         self.clear()
         self.filament_width = extrusion_width  # set it to 0 to disable scaling lines with zoom
         self.update_basescale()
@@ -201,7 +278,6 @@ class Gviz(wx.Panel):
         self.penslist = [self.mainpen, self.travelpen, self.hlpen] + self.fades
         self.bgcolor = wx.Colour()
         self.bgcolor.SetFromName(bgcolor)
-        self.blitmap = wx.EmptyBitmap(self.GetClientSize()[0], self.GetClientSize()[1], -1)
         self.paint_overlay = None
 
     def inject(self):
@@ -213,12 +289,14 @@ class Gviz(wx.Panel):
         injector_edit(self.gcode, self.layerindex, layer)
 
     def clearhilights(self):
-        self.hilight.clear()
-        self.hilightarcs.clear()
-        while not self.hilightqueue.empty():
-            self.hilightqueue.get_nowait()
-        while not self.hilightarcsqueue.empty():
-            self.hilightarcsqueue.get_nowait()
+        self.nhilights = 0
+        self.nhilightarcs = 0
+        # Moves before hilight_start are not highlighted anymore
+        self.hilight_start = 0
+        # Tiles showing the cleared highlights are rendered again
+        for tile in self.tiles.itervalues():
+            if tile.hilights or tile.hilightarcs:
+                tile.layers = None
 
     def clear(self):
         self.gcode = None
@@ -228,14 +306,22 @@ class Gviz(wx.Panel):
         self.pens = {}
         self.arcs = {}
         self.arcpens = {}
+        self.arc_lines = {}
         self.layers = {}
         self.layersz = []
+        # Line index, and line or arc of each move, to look highlighted
+        # moves up
+        self.move_idxs = None
+        self.move_lines = None
+        self.move_arcs = None
+        self.all_lines = None
+        self.all_arcs = None
+        self.last_hilight = None
+        self.hilightring.skip()
         self.clearhilights()
         self.layerindex = 0
         self.showall = 0
         self.dirty = True
-        self.partial = False
-        self.painted_layers = set()
         wx.CallAfter(self.Refresh)
 
     def get_currentz(self):
@@ -248,7 +334,6 @@ class Gviz(wx.Panel):
             self.layerindex += 1
             z = self.get_currentz()
             wx.CallAfter(self.parent.SetStatusText, _("Layer %d - Going Up - Z = %.03f mm") % (self.layerindex + 1, z), 0)
-            self.dirty = True
             self.parent.setlayercb(self.layerindex)
             wx.CallAfter(self.Refresh)
 
@@ -257,15 +342,15 @@ class Gviz(wx.Panel):
             self.layerindex -= 1
             z = self.get_currentz()
             wx.CallAfter(self.parent.SetStatusText, _("Layer %d - Going Down - Z = %.03f mm") % (self.layerindex + 1, z), 0)
-            self.dirty = True
             self.parent.setlayercb(self.layerindex)
             wx.CallAfter(self.Refresh)
 
     def setlayer(self, layer):
         if layer in self.layers:
             self.clearhilights()
+            layer_idxs = numpy.frombuffer(self.gcode.layer_idxs, dtype = numpy.uint32)
+            self.hilight_start = numpy.searchsorted(layer_idxs, layer)
             self.layerindex = self.layers[layer]
-            self.dirty = True
             self.showall = 0
             wx.CallAfter(self.Refresh)
 
@@ -294,42 +379,145 @@ class Gviz(wx.Panel):
         penwidth = max(1.0, self.filament_width * ((self.scale[0] + self.scale[1]) / 2.0))
         for pen in self.penslist:
             pen.SetWidth(penwidth)
-        self.dirty = True
         wx.CallAfter(self.Refresh)
 
-    def _line_scaler(self, x):
-        return (self.scale[0] * x[0],
-                self.scale[1] * x[1],
-                self.scale[0] * x[2],
-                self.scale[1] * x[3],)
-
-    def _arc_scaler(self, x):
-        return (self.scale[0] * x[0],
-                self.scale[1] * x[1],
-                self.scale[0] * x[2],
-                self.scale[1] * x[3],
-                self.scale[0] * x[4],
-                self.scale[1] * x[5],)
-
-    def _drawlines(self, dc, lines, pens):
-        scaled_lines = map(self._line_scaler, lines)
-        dc.DrawLineList(scaled_lines, pens)
-
-    def _drawarcs(self, dc, arcs, pens):
-        scaled_arcs = map(self._arc_scaler, arcs)
-        dc.SetBrush(wx.TRANSPARENT_BRUSH)
-        for i in range(len(scaled_arcs)):
-            dc.SetPen(pens[i] if type(pens) == list else pens)
-            dc.DrawArc(*scaled_arcs[i])
-
-    def repaint_everything(self):
-        width = self.scale[0] * self.build_dimensions[0]
-        height = self.scale[1] * self.build_dimensions[1]
-        self.blitmap = wx.EmptyBitmap(width + 1, height + 1, -1)
+    def _scale_factors(self, columns):
+        return numpy.array(self.scale * (columns / 2), dtype = numpy.float32)
+
+    def _clip_mask(self, xmin, ymin, xmax, ymax, clip):
+        """Which of the shapes with the given bounds may be seen in the
+        clip rectangle, given as (left, top, right, bottom)"""
+        margin = self.mainpen.GetWidth() + 1
+        return (xmax >= clip[0] - margin) & (xmin <= clip[2] + margin) \
+            & (ymax >= clip[1] - margin) & (ymin <= clip[3] + margin)
+
+    def _drawlines(self, dc, lines, pens, clip = None):
+        lines = numpy.asarray(lines, dtype = numpy.float32).reshape(-1, 4)
+        scaled_lines = lines * self._scale_factors(4)
+        if clip is not None:
+            x = scaled_lines[:, 0::2]
+            y = scaled_lines[:, 1::2]
+            visible = self._clip_mask(x.min(1), y.min(1), x.max(1), y.max(1), clip)
+            scaled_lines = scaled_lines[visible]
+            if not isinstance(pens, wx.Pen):
+                pens = pens[visible]
+        if len(scaled_lines):
+            dc.DrawLineList(scaled_lines.tolist(), pens)
+
+    def _zoom_bucket(self):
+        return int(math.floor(math.log(max(self.scale), 2)))
+
+    def _arc_lines(self, arcs):
+        """Segments drawing arcs given as rows of start, end and center, going
+        counterclockwise on screen like DC.DrawArc, and the number of
+        segments of each arc"""
+        arcs = numpy.asarray(arcs, dtype = numpy.float64).reshape(-1, 6)
+        x0 = arcs[:, 0]
+        y0 = arcs[:, 1]
+        zeros = numpy.zeros(len(arcs))
+        # Y goes down on screen, so these arcs turn clockwise in bed
+        # coordinates, and they are split finely enough for the largest
+        # scale of the zoom bucket
+        points, offsets = gcoder.tessellate_arcs(
+            x0, y0, zeros, arcs[:, 2], arcs[:, 3], zeros,
+            arcs[:, 4] - x0, arcs[:, 5] - y0, numpy.ones(len(arcs), dtype = bool),
+            self.arc_tolerance / 2.0 ** (self._zoom_bucket() + 1))
+        lines = numpy.empty((len(points), 4), dtype = numpy.float32)
+        lines[1:, :2] = points[:-1, :2]
+        lines[offsets[:-1], 0] = x0
+        lines[offsets[:-1], 1] = y0
+        lines[:, 2:] = points[:, :2]
+        return lines, numpy.diff(offsets)
+
+    def _layer_arc_lines(self, layer_i):
+        """Segments drawing the arcs of a layer and their pens, kept until
+        the zoom bucket changes"""
+        bucket = self._zoom_bucket()
+        cached = self.arc_lines.get(layer_i)
+        if cached is None or cached[0] != bucket:
+            lines, counts = self._arc_lines(self.arcs[layer_i])
+            pens = numpy.repeat(numpy.asarray(self.arcpens[layer_i], dtype = object), counts)
+            cached = self.arc_lines[layer_i] = (bucket, lines, pens)
+        return cached[1], cached[2]
+
+    def _drawarcs(self, dc, arcs, pens, clip = None):
+        lines, counts = self._arc_lines(arcs)
+        if not isinstance(pens, wx.Pen):
+            pens = numpy.repeat(numpy.asarray(pens, dtype = object), counts)
+        self._drawlines(dc, lines, pens, clip)
+
+    def _bed_size(self):
+        return (int(self.scale[0] * self.build_dimensions[0]) + 1,
+                int(self.scale[1] * self.build_dimensions[1]) + 1)
+
+    def _get_tile(self, tile_x, tile_y):
+        """Bitmap of the tile at tile_x, tile_y for the current layer and
+        zoom level, rendering what it lacks"""
+        key = (None if self.showall else self.layerindex,
+               tuple(float("%.6g" % scale) for scale in self.scale),
+               tile_x, tile_y)
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            max_tiles = max(1, self.tile_cache_size // (4 * self.tile_size ** 2))
+            while len(self.tiles) >= max_tiles:
+                self.tiles.popitem(last = False)
+            tile = GvizTile(wx.EmptyBitmap(self.tile_size, self.tile_size, -1))
+        # Most recently shown tiles go last
+        self.tiles[key] = tile
+        self._update_tile(tile, tile_x, tile_y)
+        return tile.bitmap
+
+    def _update_tile(self, tile, tile_x, tile_y):
+        nlayers = len(self.layersz)
+        redraw = tile.layers is None \
+            or (not self.showall and tile.layers <= self.layerindex < nlayers)
+        new_layers = self.showall and (redraw or tile.layers < nlayers)
+        if not (redraw or new_layers
+                or tile.hilights < self.nhilights
+                or tile.hilightarcs < self.nhilightarcs):
+            return
+        size = self.tile_size
+        clip = (tile_x * size, tile_y * size,
+                (tile_x + 1) * size, (tile_y + 1) * size)
         dc = wx.MemoryDC()
-        dc.SelectObject(self.blitmap)
-        dc.SetBackground(wx.Brush((250, 250, 200)))
+        dc.SelectObject(tile.bitmap)
+        # Draw in bed coordinates
+        dc.SetDeviceOrigin(-clip[0], -clip[1])
+        if redraw:
+            self._draw_background(dc)
+            tile.layers = 0 if self.showall else nlayers
+            tile.hilights = tile.hilightarcs = 0
+            if not self.showall and self.layerindex < len(self.layers) \
+               and self.layerindex in self.lines:
+                for layer_i in range(max(0, self.layerindex - 6), self.layerindex):
+                    self._drawlines(dc, self.lines[layer_i], self.fades[self.layerindex - layer_i - 1], clip)
+                    self._drawlines(dc, self._layer_arc_lines(layer_i)[0], self.fades[self.layerindex - layer_i - 1], clip)
+                self._drawlines(dc, self.lines[self.layerindex], self.pens[self.layerindex], clip)
+                arc_lines, arc_pens = self._layer_arc_lines(self.layerindex)
+                self._drawlines(dc, arc_lines, arc_pens, clip)
+        if self.showall:
+            for i in range(tile.layers, nlayers):
+                self._drawlines(dc, self.lines[i], self.pens[i], clip)
+                arc_lines, arc_pens = self._layer_arc_lines(i)
+                self._drawlines(dc, arc_lines, arc_pens, clip)
+            tile.layers = nlayers
+        if tile.hilights < self.nhilights:
+            self._drawlines(dc, self.hilight[tile.hilights:self.nhilights], self.hlpen, clip)
+            tile.hilights = self.nhilights
+        if tile.hilightarcs < self.nhilightarcs:
+            self._drawarcs(dc, self.hilightarcs[tile.hilightarcs:self.nhilightarcs], self.hlpen, clip)
+            tile.hilightarcs = self.nhilightarcs
+        dc.SelectObject(wx.NullBitmap)
+
+    def _draw_background(self, dc):
+        width, height = self._bed_size()
+        dc.SetBackground(wx.Brush(self.bgcolor))
         dc.Clear()
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.Brush((250, 250, 200)))
+        dc.DrawRectangle(0, 0, width, height)
+        width -= 1
+        height -= 1
         dc.SetPen(wx.Pen(wx.Colour(180, 180, 150)))
         for grid_unit in self.grid:
             if grid_unit > 0:
@@ -341,75 +529,39 @@ class Gviz(wx.Panel):
                     dc.DrawLine(0, draw_y, width, draw_y)
             dc.SetPen(wx.Pen(wx.Colour(0, 0, 0)))
 
-        if not self.showall:
-            # Draw layer gauge
-            dc.SetBrush(wx.Brush((43, 144, 255)))
-            dc.DrawRectangle(width - 15, 0, 15, height)
-            dc.SetBrush(wx.Brush((0, 255, 0)))
-            if self.layers:
-                dc.DrawRectangle(width - 14, (1.0 - (1.0 * (self.layerindex + 1)) / len(self.layers)) * height, 13, height - 1)
-
-        if self.showall:
-            for i in range(len(self.layersz)):
-                self.painted_layers.add(i)
-                self._drawlines(dc, self.lines[i], self.pens[i])
-                self._drawarcs(dc, self.arcs[i], self.arcpens[i])
-            dc.SelectObject(wx.NullBitmap)
-            return
-
-        if self.layerindex < len(self.layers) and self.layerindex in self.lines:
-            for layer_i in range(max(0, self.layerindex - 6), self.layerindex):
-                self._drawlines(dc, self.lines[layer_i], self.fades[self.layerindex - layer_i - 1])
-                self._drawarcs(dc, self.arcs[layer_i], self.fades[self.layerindex - layer_i - 1])
-            self._drawlines(dc, self.lines[self.layerindex], self.pens[self.layerindex])
-            self._drawarcs(dc, self.arcs[self.layerindex], self.arcpens[self.layerindex])
-
-        self._drawlines(dc, self.hilight, self.hlpen)
-        self._drawarcs(dc, self.hilightarcs, self.hlpen)
-
-        self.paint_hilights(dc)
-
-        dc.SelectObject(wx.NullBitmap)
-
-    def repaint_partial(self):
-        if self.showall:
-            dc = wx.MemoryDC()
-            dc.SelectObject(self.blitmap)
-            for i in set(range(len(self.layersz))).difference(self.painted_layers):
-                self.painted_layers.add(i)
-                self._drawlines(dc, self.lines[i], self.pens[i])
-                self._drawarcs(dc, self.arcs[i], self.arcpens[i])
-            dc.SelectObject(wx.NullBitmap)
-
-    def paint_hilights(self, dc = None):
-        if self.hilightqueue.empty() and self.hilightarcsqueue.empty():
-            return
-        hl = []
-        if not dc:
-            dc = wx.MemoryDC()
-            dc.SelectObject(self.blitmap)
-        while not self.hilightqueue.empty():
-            hl.append(self.hilightqueue.get_nowait())
-        self._drawlines(dc, hl, self.hlpen)
-        hlarcs = []
-        while not self.hilightarcsqueue.empty():
-            hlarcs.append(self.hilightarcsqueue.get_nowait())
-        self._drawarcs(dc, hlarcs, self.hlpen)
-        dc.SelectObject(wx.NullBitmap)
+    def _draw_gauge(self, dc, x, y):
+        width, height = self._bed_size()
+        width -= 1
+        height -= 1
+        dc.SetPen(wx.Pen(wx.Colour(0, 0, 0)))
+        dc.SetBrush(wx.Brush((43, 144, 255)))
+        dc.DrawRectangle(x + width - 15, y, 15, height)
+        dc.SetBrush(wx.Brush((0, 255, 0)))
+        if self.layers:
+            dc.DrawRectangle(x + width - 14, y + (1.0 - (1.0 * (self.layerindex + 1)) / len(self.layers)) * height, 13, height - 1)
 
     def paint(self, event):
         if self.dirty:
             self.dirty = False
-            self.partial = False
-            self.repaint_everything()
-        elif self.partial:
-            self.partial = False
-            self.repaint_partial()
-        self.paint_hilights()
+            self.tiles.clear()
+        self._pop_print_hilights()
         dc = wx.PaintDC(self)
         dc.SetBackground(wx.Brush(self.bgcolor))
         dc.Clear()
-        dc.DrawBitmap(self.blitmap, self.translate[0], self.translate[1])
+        # Composite the tiles of the visible part of the bed
+        x, y = int(round(self.translate[0])), int(round(self.translate[1]))
+        client_width, client_height = self.GetClientSizeTuple()
+        width, height = self._bed_size()
+        size = self.tile_size
+        left, top = max(0, -x), max(0, -y)
+        right, bottom = min(width, client_width - x), min(height, client_height - y)
+        if left < right and top < bottom:
+            for tile_y in xrange(top // size, (bottom - 1) // size + 1):
+                for tile_x in xrange(left // size, (right - 1) // size + 1):
+                    dc.DrawBitmap(self._get_tile(tile_x, tile_y),
+                                  x + tile_x * size, y + tile_y * size)
+        if not self.showall:
+            self._draw_gauge(dc, x, y)
         if self.paint_overlay:
             self.paint_overlay(dc)
 
@@ -473,79 +625,197 @@ class Gviz(wx.Panel):
     def _x(self, x):
         return x - self.build_dimensions[3]
 
+    def _move_arrays(self, gcode, first_layer, last_layer, line_idx):
+        """Line indices and positions of the moves of layers first_layer to
+        last_layer of gcode, whether they move the extruder, and the bounds
+        of the moves of each of these layers. They are taken from the
+        per-move arrays of gcode or, when it is still being parsed or was
+        edited since they were built, from its lines, line_idx being the
+        index of the first line of first_layer. Arcs are returned as the
+        indices of their moves, center offsets and directions."""
+        if gcode.move_arrays_current():
+            move_layers = gcode.move_layers()
+            first, last = numpy.searchsorted(move_layers,
+                                             [first_layer, last_layer])
+            arc_first, arc_last = numpy.searchsorted(gcode.arc_moves,
+                                                     [first, last])
+            arcs = slice(arc_first, arc_last)
+            return (gcode.move_idxs[first:last], gcode.move_x[first:last],
+                    gcode.move_y[first:last], gcode.move_e[first:last] != 0,
+                    numpy.asarray(gcode.arc_moves[arcs], dtype = numpy.intp) - first,
+                    gcode.arc_i[arcs], gcode.arc_j[arcs], gcode.arc_cw[arcs],
+                    numpy.searchsorted(move_layers[first:last],
+                                       numpy.arange(first_layer, last_layer + 1)))
+        moves = []
+        arcs = []
+        layer_bounds = [0]
+        last_e = self.lastpos[3]
+        line_idx -= 1
+        for layer in gcode.all_layers[first_layer:last_layer]:
+            for gline in layer:
+                line_idx += 1
+                if not gline.is_move:
+                    continue
+                if gline.command == "G2" or gline.command == "G3":
+                    arcs.append((len(moves), gline.i or 0, gline.j or 0,
+                                 gline.command == "G2"))
+                e = last_e
+                if gline.e is not None:
+                    e = last_e + gline.e if gline.relative_e else gline.e
+                moves.append((line_idx, gline.current_x, gline.current_y,
+                              e != last_e))
+                last_e = e
+            layer_bounds.append(len(moves))
+        self.lastpos[3] = last_e
+        moves = numpy.array(moves, dtype = numpy.float64).reshape(-1, 4)
+        arcs = numpy.array(arcs, dtype = numpy.float64).reshape(-1, 4)
+        return (moves[:, 0].astype(numpy.intp), moves[:, 1], moves[:, 2],
+                moves[:, 3] > 0,
+                arcs[:, 0].astype(numpy.intp), arcs[:, 1], arcs[:, 2],
+                arcs[:, 3] > 0, numpy.array(layer_bounds))
+
+    def _add_moves(self, gcode, first_layer, last_layer, line_idx):
+        """Build the lines and arcs of the moves of layers first_layer to
+        last_layer at once, each starting where the previous move ended.
+        Returns the lines, their pens and the arcs, and the bounds of the
+        lines and arcs of each layer."""
+        move_idxs, x, y, extruding, arc_moves, arc_i, arc_j, arc_cw, \
+            layer_bounds = self._move_arrays(gcode, first_layer, last_layer,
+                                             line_idx)
+        nmoves = len(x)
+        starts = numpy.empty((nmoves, 2))
+        starts[:1] = self.lastpos[:2]
+        starts[1:, 0] = x[:-1]
+        starts[1:, 1] = y[:-1]
+        segments = numpy.empty((nmoves, 4))
+        segments[:, 0] = self._x(starts[:, 0])
+        segments[:, 1] = self._y(starts[:, 1])
+        segments[:, 2] = self._x(x)
+        segments[:, 3] = self._y(y)
+        is_line = numpy.ones(nmoves, dtype = bool)
+        is_line[arc_moves] = False
+        line_moves = numpy.flatnonzero(is_line)
+        lines = segments[line_moves].astype(numpy.float32)
+        pens = numpy.array([self.travelpen, self.mainpen],
+                           dtype = object)[extruding[line_moves].astype(numpy.intp)]
+        arcs = numpy.empty((len(arc_moves), 6), dtype = numpy.float32)
+        # Arcs from start to end around their center, drawn counterclockwise
+        # so that clockwise ones have their endpoints reversed
+        arcs[:, :4] = segments[arc_moves]
+        arcs[arc_cw, :2] = segments[arc_moves[arc_cw], 2:]
+        arcs[arc_cw, 2:4] = segments[arc_moves[arc_cw], :2]
+        arcs[:, 4] = self._x(starts[arc_moves, 0] + arc_i)
+        arcs[:, 5] = self._y(starts[arc_moves, 1] + arc_j)
+        # Moves are numbered from the first move of the whole file
+        moves_before = len(self.move_idxs)
+        self.move_idxs = numpy.concatenate(
+            (self.move_idxs, numpy.asarray(move_idxs, dtype = numpy.intp)))
+        self.move_lines = numpy.concatenate((self.move_lines,
+                                             line_moves + moves_before))
+        self.move_arcs = numpy.concatenate((self.move_arcs,
+                                            arc_moves + moves_before))
+        self.all_lines = numpy.concatenate((self.all_lines, lines))
+        self.all_arcs = numpy.concatenate((self.all_arcs, arcs))
+        if nmoves:
+            self.lastpos = [x[-1], y[-1]] + self.lastpos[2:]
+        line_bounds = numpy.searchsorted(line_moves, layer_bounds).tolist()
+        arc_bounds = numpy.searchsorted(arc_moves, layer_bounds).tolist()
+        return lines, pens, arcs, layer_bounds.tolist(), line_bounds, arc_bounds
+
     def add_parsed_gcodes(self, gcode):
         start_time = time.time()
+        self.move_idxs = numpy.zeros(0, dtype = numpy.intp)
+        self.move_lines = numpy.zeros(0, dtype = numpy.intp)
+        self.move_arcs = numpy.zeros(0, dtype = numpy.intp)
+        self.all_lines = numpy.zeros((0, 4), dtype = numpy.float32)
+        self.all_arcs = numpy.zeros((0, 6), dtype = numpy.float32)
+        self.gcode_revision = gcode.revision
 
         layer_idx = 0
+        line_idx = 0
         while layer_idx < len(gcode.all_layers):
-            layer = gcode.all_layers[layer_idx]
-            has_move = False
-            for gline in layer:
-                if gline.is_move:
-                    has_move = True
-                    break
-            if not has_move:
-                yield layer_idx
-                layer_idx += 1
-                continue
-            viz_layer = len(self.layers)
-            self.lines[viz_layer] = []
-            self.pens[viz_layer] = []
-            self.arcs[viz_layer] = []
-            self.arcpens[viz_layer] = []
-            for gline in layer:
-                if not gline.is_move:
+            # Layers of G-Code which is fully parsed are built all at once,
+            # while layers still being parsed are built one at a time
+            first_layer = layer_idx
+            if gcode.move_idxs is not None:
+                last_layer = len(gcode.all_layers)
+            else:
+                last_layer = layer_idx + 1
+            lines, pens, arcs, layer_bounds, line_bounds, arc_bounds = \
+                self._add_moves(gcode, first_layer, last_layer, line_idx)
+            while layer_idx < last_layer:
+                layer = gcode.all_layers[layer_idx]
+                line_idx += len(layer)
+                k = layer_idx - first_layer
+                if layer_bounds[k] == layer_bounds[k + 1]:
+                    yield layer_idx
+                    layer_idx += 1
                     continue
+                viz_layer = len(self.layers)
+                line_start, line_end = line_bounds[k:k + 2]
+                arc_start, arc_end = arc_bounds[k:k + 2]
+                self.lines[viz_layer] = lines[line_start:line_end]
+                self.pens[viz_layer] = pens[line_start:line_end]
+                self.arcs[viz_layer] = arcs[arc_start:arc_end]
+                self.arcpens[viz_layer] = numpy.array([self.arcpen] * (arc_end - arc_start))
+                # Only add layer to self.layers now to prevent the display of an
+                # unfinished layer
+                self.layers[layer_idx] = viz_layer
+                self.layersz.append(layer.z)
+
+                # Refresh display if more than 0.2s have passed
+                if time.time() - start_time > 0.2:
+                    start_time = time.time()
+                    wx.CallAfter(self.Refresh)
 
-                target, line, arc = self._get_movement(self.lastpos[:], gline)
-
-                if line is not None:
-                    self.lines[viz_layer].append(line)
-                    self.pens[viz_layer].append(self.mainpen if target[3] != self.lastpos[3] else self.travelpen)
-                elif arc is not None:
-                    self.arcs[viz_layer].append(arc)
-                    self.arcpens[viz_layer].append(self.arcpen)
-
-                self.lastpos = target
-            # Transform into a numpy array for memory efficiency
-            self.lines[viz_layer] = numpy.asarray(self.lines[viz_layer], dtype = numpy.float32)
-            self.pens[viz_layer] = numpy.asarray(self.pens[viz_layer])
-            self.arcs[viz_layer] = numpy.asarray(self.arcs[viz_layer], dtype = numpy.float32)
-            self.arcpens[viz_layer] = numpy.asarray(self.arcpens[viz_layer])
-            # Only add layer to self.layers now to prevent the display of an
-            # unfinished layer
-            self.layers[layer_idx] = viz_layer
-            self.layersz.append(layer.z)
-
-            # Refresh display if more than 0.2s have passed
-            if time.time() - start_time > 0.2:
-                start_time = time.time()
-                self.partial = True
-                wx.CallAfter(self.Refresh)
-
-            yield layer_idx
-            layer_idx += 1
+                yield layer_idx
+                layer_idx += 1
 
-        self.dirty = True
         wx.CallAfter(self.Refresh)
         yield None
 
+    def _add_hilights(self, lines, arcs):
+        self.hilight, self.nhilights = \
+            append_rows(self.hilight, self.nhilights, lines)
+        self.hilightarcs, self.nhilightarcs = \
+            append_rows(self.hilightarcs, self.nhilightarcs, arcs)
+
     def addgcodehighlight(self, gline):
         if gline.command not in ["G0", "G1", "G2", "G3"]:
             return
 
         target, line, arc = self._get_movement(self.hilightpos[:], gline)
 
-        if line is not None:
-            self.hilight.append(line)
-            self.hilightqueue.put_nowait(line)
-        elif arc is not None:
-            self.hilightarcs.append(arc)
-            self.hilightarcsqueue.put_nowait(arc)
+        self._add_hilights([line] if line is not None else [],
+                           [arc] if arc is not None else [])
 
         self.hilightpos = target
         wx.CallAfter(self.Refresh)
 
+    def addprinthighlight(self, line_idx):
+        """Highlight the move at line_idx in the shown G-Code. Safe to call
+        from the print thread, the move is drawn at the next repaint."""
+        self.hilightring.push(line_idx)
+
+    def _pop_print_hilights(self):
+        indices, dropped = self.hilightring.pop()
+        if not len(indices) or self.move_idxs is None \
+           or self.gcode.revision != self.gcode_revision:
+            return
+        # Moves are sent in order, so those dropped by the ring are the ones
+        # between the last highlighted move and the first popped one
+        if dropped and self.last_hilight is not None:
+            indices = numpy.concatenate((numpy.arange(self.last_hilight + 1,
+                                                      indices[0]), indices))
+        self.last_hilight = indices[-1]
+        indices = indices[indices >= self.hilight_start]
+        moves = lookup(self.move_idxs, indices)
+        moves = moves[moves >= 0]
+        lines = lookup(self.move_lines, moves)
+        arcs = lookup(self.move_arcs, moves)
+        self._add_hilights(self.all_lines[lines[lines >= 0]],
+                           self.all_arcs[arcs[arcs >= 0]])
+
 if __name__ == '__main__':
     import sys
     app = wx.App(False)
@@ -29,6 +29,9 @@ import re
 from collections import OrderedDict
 import itertools
 import math
+import threading
+
+from printrun import stltool, stlslicer
 
 class DisplayFrame(wx.Frame):
     def __init__(self, parent, title, res = (1024, 768), printer = None, scale = 1.0, offset = (0, 0)):
@@ -249,10 +252,10 @@ class SettingsFrame(wx.Frame):
         vbox = wx.BoxSizer(wx.VERTICAL)
         buttonbox = wx.StaticBoxSizer(wx.StaticBox(self.panel, label = "Controls"), wx.HORIZONTAL)
 
-        load_button = wx.Button(self.panel, -1, "Load")
-        load_button.Bind(wx.EVT_BUTTON, self.load_file)
-        load_button.SetHelpText("Choose an SVG file created from Slic3r or Skeinforge, or a zip file of bitmap images (with extension: .3dlp.zip).")
-        buttonbox.Add(load_button, flag = wx.LEFT | wx.RIGHT | wx.BOTTOM, border = 5)
+        self.load_button = wx.Button(self.panel, -1, "Load")
+        self.load_button.Bind(wx.EVT_BUTTON, self.load_file)
+        self.load_button.SetHelpText("Choose an SVG file created from Slic3r or Skeinforge, a zip file of bitmap images (with extension: .3dlp.zip), or an STL file to slice at the set thickness.")
+        buttonbox.Add(self.load_button, flag = wx.LEFT | wx.RIGHT | wx.BOTTOM, border = 5)
 
         present_button = wx.Button(self.panel, -1, "Present")
         present_button.Bind(wx.EVT_BUTTON, self.start_present)
@@ -569,9 +572,29 @@ class SettingsFrame(wx.Frame):
 
         return ol, -1, "bitmap"
 
+    def slice_stl(self, name, thickness):
+        """Slice an STL file in layers of thickness, as if read from a
+        Slic3r svg file, then load the layers. Runs in its own thread as
+        large meshes take a while."""
+        try:
+            mesh = stltool.stl(name)
+            if not len(mesh.data):
+                raise ValueError("no facets found")
+            bounds = stlslicer.mesh_bounds(mesh.data)
+            ol = [stlslicer.layer_svg(z, polygons, bounds)
+                  for z, polygons in stlslicer.slice_mesh(mesh.data, thickness)]
+        except Exception as e:
+            wx.CallAfter(self.slice_stl_failed, name, e)
+            return
+        wx.CallAfter(self.set_layers, name, (ol, thickness, "Slic3r"), thickness)
+
+    def slice_stl_failed(self, name, error):
+        self.load_button.Enable()
+        self.status.SetStatusText("Could not slice %s: %s" % (os.path.basename(name), error))
+
     def load_file(self, event):
         dlg = wx.FileDialog(self, ("Open file to print"), style = wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
-        dlg.SetWildcard(("Slic3r or Skeinforge svg files (;*.svg;*.SVG;);3DLP Zip (;*.3dlp.zip;)"))
+        dlg.SetWildcard(("Slic3r or Skeinforge svg files (;*.svg;*.SVG;);3DLP Zip (;*.3dlp.zip;);STL files (;*.stl;*.STL;)"))
         if dlg.ShowModal() == wx.ID_OK:
             name = dlg.GetPath()
             if not(os.path.exists(name)):
@@ -579,22 +602,38 @@ class SettingsFrame(wx.Frame):
                 return
             if name.endswith(".3dlp.zip"):
                 layers = self.parse_3DLP_zip(name)
-                layerHeight = float(self.thickness.GetValue())
+                self.set_layers(name, layers, float(self.thickness.GetValue()))
+            elif name.lower().endswith(".stl"):
+                try:
+                    thickness = float(self.thickness.GetValue())
+                except ValueError:
+                    thickness = 0
+                if thickness > 0:
+                    self.load_button.Disable()
+                    self.status.SetStatusText("Slicing %s..." % os.path.basename(name))
+                    thread = threading.Thread(target = self.slice_stl, args = (name, thickness))
+                    thread.daemon = True
+                    thread.start()
+                else:
+                    self.status.SetStatusText("Set a positive layer thickness to slice STL files")
             else:
                 layers = self.parse_svg(name)
-                layerHeight = layers[1]
                 self.thickness.SetValue(str(layers[1]))
-                print "Layer thickness detected:", layerHeight, "mm"
-            print len(layers[0]), "layers found, total height", layerHeight * len(layers[0]), "mm"
-            self.layers = layers
-            self.set_total_layers(len(layers[0]))
-            self.set_current_layer(0)
-            self.current_filename = os.path.basename(name)
-            self.display_filename(self.current_filename)
-            self.slicer = layers[2]
-            self.display_frame.slicer = self.slicer
+                print "Layer thickness detected:", layers[1], "mm"
+                self.set_layers(name, layers, layers[1])
         dlg.Destroy()
 
+    def set_layers(self, name, layers, layerHeight):
+        print len(layers[0]), "layers found, total height", layerHeight * len(layers[0]), "mm"
+        self.load_button.Enable()
+        self.layers = layers
+        self.set_total_layers(len(layers[0]))
+        self.set_current_layer(0)
+        self.current_filename = os.path.basename(name)
+        self.display_filename(self.current_filename)
+        self.slicer = layers[2]
+        self.display_frame.slicer = self.slicer
+
     def show_calibrate(self, event):
         if self.calibrate.IsChecked():
             self.present_calibrate(event)
@@ -1064,6 +1064,53 @@ class pronsole(cmd.Cmd):
     def help_resume(self):
         self.log(_("Resumes a paused print."))
 
+    def do_resume_from(self, l):
+        if not self.fgcode:
+            self.logError(_("No file loaded. Please use load first."))
+            return
+        if not self.p.online:
+            self.logError(_("Not connected to printer."))
+            return
+        if self.p.printing:
+            self.logError(_("Printer is currently printing. Please pause the print before you issue manual commands."))
+            return
+        args = l.lower().split()
+        if len(args) != 2 or args[0] not in ("layer", "z"):
+            self.logError(_("You must specify either a layer number or a Z height."))
+            return
+        try:
+            value = int(args[1]) if args[0] == "layer" else float(args[1])
+        except ValueError:
+            self.logError(_("Invalid value: %s") % args[1])
+            return
+        if args[0] == "layer":
+            layer = value
+        else:
+            try:
+                layer = self.fgcode.layer_at_z(value)
+            except ValueError:
+                self.logError(_("Nothing is printed at or above Z = %s in %s.")
+                              % (args[1], self.filename))
+                return
+        if not 0 <= layer < len(self.fgcode.all_layers) - 1:
+            self.logError(_("No such layer in %s.") % self.filename)
+            return
+        startindex = self.fgcode.layer_start_index(layer)
+        state = self.fgcode.state_at(startindex)
+        z = self.fgcode.all_layers[layer].z
+        z = z if z is not None else 0
+        self.log(_("Resuming %s from layer %d (Z = %.03f), line %d") %
+                 (self.filename, layer, z, startindex))
+        for command in gcoder.resume_preamble(state):
+            self.p.send_now(command)
+        self.sdprinting = False
+        self.p.startprint(self.fgcode, startindex)
+
+    def help_resume_from(self):
+        self.log(_("Restarts the loaded print from a given layer after a failure: heats up, homes X and Y, restores the Z, E, feedrate, fan and coordinate modes in use at that point, then sends the rest of the file."))
+        self.log(_("resume_from layer 12 - resume from the 13th layer of the file: layers are counted from 0, and the start code may take up the first layers"))
+        self.log(_("resume_from z 3.2 - resume from the first printed layer at or above Z = 3.2mm"))
+
     def listfiles(self, line):
         if "Begin file list" in line:
             self.sdlisting = 1
@@ -17,7 +17,6 @@
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import Queue
 import sys
 import time
 import threading
@@ -116,6 +115,10 @@ class PronterWindow(MainWindow, pronsole.pronsole):
 
     _fgcode = None
 
+    # Print progress is shown in viewers at most once per this many
+    # milliseconds, the refresh period of the 3D viewer
+    progress_refresh_interval = 100
+
     def _get_fgcode(self):
         return self._fgcode
 
@@ -161,7 +164,10 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         self.current_pos = [0, 0, 0]
         self.paused = False
         self.uploading = False
-        self.sentglines = Queue.Queue(0)
+        # Last move sent while printing, and whether showing it is pending
+        self.sent_gline = None
+        self.shown_gline = None
+        self.sent_gline_pending = False
         self.cpbuttons = {
             "motorsoff": SpecialButton(_("Motors off"), ("M84"), (250, 250, 250), _("Switch all motors off")),
             "extrude": SpecialButton(_("Extrude"), ("pront_extrude"), (225, 200, 200), _("Advance extruder by set length")),
@@ -296,6 +302,7 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         # Set gcview parameters here as they don't get set when viewers are
         # created
         self.update_gcview_params()
+        self.update_gcview_lod()
 
         # Finalize
         if self.online:
@@ -840,6 +847,7 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         self.settings._add(StringSetting("simarrange_path", "", _("Simarrange command"), _("Path to the simarrange binary to use in the STL plater"), "External"))
         self.settings._add(BooleanSetting("circular_bed", False, _("Circular build platform"), _("Draw a circular (or oval) build platform instead of a rectangular one"), "Printer"), self.update_bed_viz)
         self.settings._add(SpinSetting("extruders", 0, 1, 5, _("Extruders count"), _("Number of extruders"), "Printer"))
+        self.settings._add(FloatSpinSetting("filament_diameter", 1.75, 0.1, 5, _("Filament diameter"), _("Diameter of the filament (mm), used to compute the volume of filament used by each tool"), "Printer", increment = 0.05))
         self.settings._add(BooleanSetting("clamp_jogging", False, _("Clamp manual moves"), _("Prevent manual moves from leaving the specified build dimensions"), "Printer"))
         self.settings._add(ComboSetting("uimode", _("Standard"), [_("Standard"), _("Compact"), _("Tabbed"), _("Tabbed with platers"), _("QC")], _("Interface mode"), _("Standard interface is a one-page, three columns layout with controls/visualization/log\nCompact mode is a one-page, two columns layout with controls + log/visualization\nTabbed mode is a two-pages mode, where the first page shows controls and the second one shows visualization and log.\nTabbed with platers mode is the same as Tabbed, but with two extra pages for the STL and G-Code platers."), "UI"), self.reload_ui)
         self.settings._add(ComboSetting("controlsmode", "Standard", ["Standard", "Mini"], _("Controls mode"), _("Standard controls include all controls needed for printer setup and calibration, while Mini controls are limited to the ones needed for daily printing. QC is quality control steps intended for testing a newly assembled printers basic functionality."), "UI"), self.reload_ui)
@@ -853,6 +861,8 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         self.settings._add(BooleanSetting("trackcurrentlayer3d", False, _("Track current layer in main 3D view"), _("Track the currently printing layer in the main 3D visualization"), "Viewer"))
         self.settings._add(FloatSpinSetting("gcview_path_width", 0.4, 0.01, 2, _("Extrusion width for 3D viewer"), _("Width of printed path in 3D viewer"), "Viewer", increment = 0.05), self.update_gcview_params)
         self.settings._add(FloatSpinSetting("gcview_path_height", 0.3, 0.01, 2, _("Layer height for 3D viewer"), _("Height of printed path in 3D viewer"), "Viewer", increment = 0.05), self.update_gcview_params)
+        self.settings._add(BooleanSetting("gcview_lod", True, _("Simplify small paths in 3D viewer"), _("Draw printed paths as simplified lines when they are too small on screen to be told apart"), "Viewer"), self.update_gcview_lod)
+        self.settings._add(SpinSetting("gcview_detail_layers", 0, 0, 10000, _("Layers in full detail in 3D viewer"), _("Number of top visible layers drawn as printed paths in 3D viewer, lower layers being drawn as simplified lines (0 to draw all layers in full detail)"), "Viewer"), self.update_gcview_lod)
         self.settings._add(BooleanSetting("tempgraph", True, _("Display temperature graph"), _("Display time-lapse temperature graph"), "UI"), self.reload_ui)
         self.settings._add(BooleanSetting("tempgauges", False, _("Display temperature gauges"), _("Display graphical gauges for temperatures visualization"), "UI"), self.reload_ui)
         self.settings._add(BooleanSetting("lockbox", False, _("Display interface lock checkbox"), _("Display a checkbox that, when check, locks most of Pronterface"), "UI"), self.reload_ui)
@@ -972,6 +982,12 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         if need_reload:
             self.start_viz_thread()
 
+    def update_gcview_lod(self, *args):
+        if hasattr(self, "gviz") and hasattr(self.gviz, "set_gcview_lod"):
+            self.gviz.set_gcview_lod(self.settings.gcview_lod, self.settings.gcview_detail_layers)
+        if hasattr(self, "gwindow") and hasattr(self.gwindow, "set_gcview_lod"):
+            self.gwindow.set_gcview_lod(self.settings.gcview_lod, self.settings.gcview_detail_layers)
+
     def update_monitor(self, *args):
         if hasattr(self, "graph") and self.display_graph:  # QC mode doesn't have graph
             if self.settings.monitor and not self.settings.uimode == "QC":
@@ -1008,14 +1024,6 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         # Call pronsole's statuschecker inner loop function to handle
         # temperature monitoring and status loop sleep
         pronsole.pronsole.statuschecker_inner(self, self.settings.monitor)
-        try:
-            while not self.sentglines.empty():
-                gc = self.sentglines.get_nowait()
-                if hasattr(self, 'gviz'):
-                    wx.CallAfter(self.gviz.addgcodehighlight, gc)
-                self.sentglines.task_done()
-        except Queue.Empty:
-            pass
 
     def statuschecker(self):
         if not self.settings.uimode == "QC":
@@ -1447,10 +1455,24 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
     def output_gcode_stats(self):
         gcode = self.fgcode
         self.log(_("%.2fmm of filament used in this print") % gcode.filament_length)
+        tool_stats = gcode.tool_stats(self.settings.filament_diameter)
+        for tool in sorted(tool_stats):
+            length, volume, bbox = tool_stats[tool]
+            self.log(_("- %.2fmm (%.2fcm3) with tool %d") % (length, volume / 1000., tool))
+            self.log(_("  from %.2f mm to %.2f mm in X and from %.2f mm to %.2f mm in Y") % bbox)
+        self.log(_("%.2fmm of extrusion moves and %.2fmm of travel moves") % (gcode.extrusion_distance, gcode.travel_distance))
+        distances, edges = gcode.feedrate_histogram()
+        self.log(_("Distance per feedrate:"))
+        for i, distance in enumerate(distances):
+            if distance:
+                self.log(_("- %d to %d mm/min: %.2fmm") % (edges[i], edges[i + 1], distance))
         self.log(_("The print goes:"))
         self.log(_("- from %.2f mm to %.2f mm in X and is %.2f mm wide") % (gcode.xmin, gcode.xmax, gcode.width))
         self.log(_("- from %.2f mm to %.2f mm in Y and is %.2f mm deep") % (gcode.ymin, gcode.ymax, gcode.depth))
         self.log(_("- from %.2f mm to %.2f mm in Z and is %.2f mm high") % (gcode.zmin, gcode.zmax, gcode.height))
+        first_layer = gcode.first_layer_bbox()
+        if first_layer is not None:
+            self.log(_("The first layer goes from %.2f mm to %.2f mm in X and from %.2f mm to %.2f mm in Y") % first_layer)
         self.log(_("Estimated duration: %d layers, %s") % gcode.estimate_duration())
 
     def loadviz(self, gcode = None):
@@ -1589,8 +1611,6 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         elif gline.command.startswith("T"):
             tool = gline.command[1:]
             if hasattr(self, "extrudersel"): wx.CallAfter(self.extrudersel.SetValue, tool)
-        if gline.is_move:
-            self.sentglines.put_nowait(gline)
 
     def is_excluded_move(self, gline):
         """Check whether the given moves ends at a position specified as
@@ -1645,10 +1665,31 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
     def printsentcb(self, gline):
         """Callback when a print gcode has been sent"""
         if not self.settings.uimode == "QC" and gline.is_move:
-            if hasattr(self.gwindow, "set_current_gline"):
-                wx.CallAfter(self.gwindow.set_current_gline, gline)
-            if hasattr(self.gviz, "set_current_gline"):
-                wx.CallAfter(self.gviz.set_current_gline, gline)
+            # The 2D viewer highlights the sent moves when it repaints,
+            # which the status checker triggers regularly
+            self.gviz.addprinthighlight(self.p.queueindex)
+            # Moves are sent faster than they can be shown, so only the
+            # last one is shown, posting a single event at a time
+            self.sent_gline = gline
+            if not self.sent_gline_pending:
+                self.sent_gline_pending = True
+                wx.CallAfter(self.show_sent_gline)
+
+    def show_sent_gline(self):
+        gline = self.shown_gline = self.sent_gline
+        if hasattr(self.gwindow, "set_current_gline"):
+            self.gwindow.set_current_gline(gline)
+        if hasattr(self.gviz, "set_current_gline"):
+            self.gviz.set_current_gline(gline)
+        wx.CallLater(self.progress_refresh_interval, self.sent_gline_shown)
+
+    def sent_gline_shown(self):
+        # Clear the flag before checking for newer moves, so that moves
+        # sent meanwhile are either seen here or post a new event
+        self.sent_gline_pending = False
+        if self.sent_gline is not self.shown_gline:
+            self.sent_gline_pending = True
+            self.show_sent_gline()
 
     def layer_change_cb(self, newlayer):
         """Callback when the printed layer changed"""
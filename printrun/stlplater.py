@@ -31,6 +31,7 @@ import sys
 import re
 import traceback
 import subprocess
+import numpy
 from copy import copy
 
 from printrun import stltool
@@ -74,6 +75,10 @@ class showstl(wx.Window):
         self.prevsel = -1
 
     def prepare_model(self, m, scale):
+        # Duplicated models keep the bitmap of the model they copy
+        if getattr(m, "bitmap_data", None) is m.data:
+            return
+        m.bitmap_data = m.data
         m.bitmap = wx.EmptyBitmap(800, 800, 32)
         dc = wx.MemoryDC()
         dc.SelectObject(m.bitmap)
@@ -81,8 +86,8 @@ class showstl(wx.Window):
         dc.SetBrush(wx.Brush((0, 0, 0, 255)))
         dc.SetBrush(wx.Brush(wx.Colour(128, 255, 128)))
         dc.SetPen(wx.Pen(wx.Colour(128, 128, 128)))
-        for i in m.facets:
-            dc.DrawPolygon([wx.Point(400 + scale * p[0], (400 - scale * p[1])) for p in i[1]])
+        corners = m.data[:, 1:, :2] * (scale, -scale) + 400
+        dc.DrawPolygonList(corners.round().astype(int).tolist())
         dc.SelectObject(wx.NullBitmap)
         m.bitmap.SetMask(wx.Mask(m.bitmap, wx.Colour(0, 0, 0, 255)))
 
@@ -336,12 +341,16 @@ class StlPlaterPanel(PlaterPanel):
         best_facet = None
         best_dist = float("inf")
         for key, model in self.models.iteritems():
-            transformation = transformation_matrix(model)
-            transformed = model.transform(transformation)
-            if not transformed.intersect_box(ray_near, ray_far):
+            # Bring the ray to the model rather than transforming the model,
+            # so that its picking hierarchy is kept between clicks. The
+            # transformation is rigid, so distances are unchanged.
+            inverse = numpy.linalg.inv(transformation_matrix(model))
+            model_near = inverse.dot(stltool.homogeneous(ray_near))[:3]
+            model_far = inverse.dot(stltool.homogeneous(ray_far))[:3]
+            if not model.intersect_box(model_near, model_far):
                 logging.debug("Skipping %s for rebase search" % key)
                 continue
-            facet, facet_dist = transformed.intersect(ray_near, ray_far)
+            facet, facet_dist = model.intersect(model_near, model_far)
             if facet is not None and facet_dist < best_dist:
                 best_match = key
                 best_facet = facet
@@ -457,7 +466,6 @@ class StlPlaterPanel(PlaterPanel):
 
     def export_to(self, name):
         with open(name.replace(".", "_") + ".scad", "w") as sf:
-            facets = []
             for model in self.models.values():
                 r = model.rot
                 o = model.offsets
@@ -469,9 +477,11 @@ class StlPlaterPanel(PlaterPanel):
                                                 r,
                                                 co[0], co[1], co[2],
                                                 model.filename))
-                model = model.transform(transformation_matrix(model))
-                facets += model.facets
-            stltool.emitstl(name, facets, "plater_export")
+            # Models are transformed one at a time while writing
+            meshes = (stltool.transform_facets(model.data,
+                                              transformation_matrix(model))
+                      for model in self.models.values())
+            stltool.emitmeshes(name, meshes, "plater_export")
             logging.info(_("Wrote plate to %s") % name)
 
     def autoplate(self, event = None):
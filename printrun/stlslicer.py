@@ -0,0 +1,197 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Slicing of STL meshes into the contours of their layers, for the DLP
+# projector, without an external slicer. Contours are closed polygons
+# filled with the even-odd rule, so holes need no orientation.
+
+import math
+import logging
+import multiprocessing
+import threading
+import xml.etree.ElementTree
+
+import numpy
+
+from printrun.stltool import segment_loops
+
+svg_namespace = "{http://www.w3.org/2000/svg}"
+slic3r_namespace = "{http://slic3r.org/namespaces/slic3r}"
+
+# Layers sliced by each job of the process pool
+layers_per_job = 16
+
+def layer_heights(data, layer_height):
+    """Heights of the middle of the layers of an (N, 4, 3) facets array"""
+    if not layer_height > 0:
+        raise ValueError("Layer height must be positive, got %r" % layer_height)
+    z = data[:, 1:, 2]
+    if not len(z):
+        return numpy.zeros(0)
+    zmin = float(z.min())
+    count = int(math.ceil((float(z.max()) - zmin) / layer_height))
+    return zmin + layer_height * (numpy.arange(count) + 0.5)
+
+class LayerIndex(object):
+    """Interval index over the z ranges of triangles, listing the triangles
+    crossing each of the planes at the sorted heights zs"""
+
+    def __init__(self, vertices, zs):
+        z = vertices[:, :, 2]
+        first = numpy.searchsorted(zs, z.min(axis = 1), "left")
+        last = numpy.searchsorted(zs, z.max(axis = 1), "right")
+        counts = numpy.maximum(last - first, 0)
+        starts = numpy.cumsum(counts) - counts
+        triangles = numpy.repeat(numpy.arange(len(vertices)), counts)
+        layers = numpy.repeat(first - starts, counts) + numpy.arange(counts.sum())
+        order = numpy.argsort(layers, kind = "mergesort")
+        self.triangles = triangles[order]
+        self.layers = layers[order]
+        self.offsets = numpy.searchsorted(self.layers, numpy.arange(len(zs) + 1))
+
+    def triangles_at(self, layer):
+        return self.triangles[self.offsets[layer]:self.offsets[layer + 1]]
+
+def plane_segments(triangles, z):
+    """Segments cut in (N, 3, 3) triangles by the horizontal planes at the
+    heights z, one per triangle, as (N, 2) start and end points and a mask
+    of the triangles actually crossing their plane"""
+    sides = triangles[:, :, 2] - z[:, None]
+    above = sides >= 0
+    nabove = above.sum(axis = 1)
+    crossing = (nabove == 1) | (nabove == 2)
+    # Rotate the triangles so that the vertex alone on its side comes first
+    alone = numpy.where(nabove == 1, above.argmax(axis = 1),
+                        above.argmin(axis = 1))
+    order = (alone[:, None] + numpy.arange(3)) % 3
+    rows = numpy.arange(len(order))[:, None]
+    triangles = triangles[rows, order]
+    sides = sides[rows, order]
+
+    def split(p, q, sp, sq):
+        # Computed from the lower end of the edge, so that both triangles
+        # sharing it get the exact same point
+        lower = (sp < 0)[:, None]
+        low = numpy.where(lower, p, q)
+        high = numpy.where(lower, q, p)
+        s_low = numpy.where(lower[:, 0], sp, sq)
+        s_high = numpy.where(lower[:, 0], sq, sp)
+        # Triangles not crossing their plane give meaningless points
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            ratio = s_low / (s_low - s_high)
+            return (low + (high - low) * ratio[:, None])[:, :2]
+    starts = split(triangles[:, 0], triangles[:, 1], sides[:, 0], sides[:, 1])
+    ends = split(triangles[:, 0], triangles[:, 2], sides[:, 0], sides[:, 2])
+    return starts, ends, crossing
+
+def slice_layers(vertices, zs):
+    """Contours of (N, 3, 3) triangles at the sorted heights zs, as a list
+    per layer of (K, 2) polygons"""
+    index = LayerIndex(vertices, zs)
+    triangles = vertices[index.triangles].astype(numpy.float64)
+    starts, ends, crossing = plane_segments(triangles, zs[index.layers])
+    # Points are matched once rounded, for meshes whose facets do not
+    # share exactly the same vertices
+    start_keys = map(tuple, numpy.round(starts, 5).tolist())
+    end_keys = map(tuple, numpy.round(ends, 5).tolist())
+    crossing = crossing.tolist()
+    layers = []
+    for layer in xrange(len(zs)):
+        begin, end = index.offsets[layer], index.offsets[layer + 1]
+        segments = [(start_keys[i], end_keys[i]) for i in xrange(begin, end)
+                    if crossing[i] and start_keys[i] != end_keys[i]]
+        layers.append([numpy.array(loop) for loop in segment_loops(segments)])
+    return layers
+
+slice_pool = None
+slice_pool_lock = threading.Lock()
+
+def get_slice_pool(processes):
+    """Return the pool of processes slicing meshes, started on first use and
+    shared by all the slicings, or None if slicing is to be done by the
+    calling thread"""
+    global slice_pool
+    if processes <= 1:
+        return None
+    with slice_pool_lock:
+        if slice_pool is None:
+            try:
+                slice_pool = multiprocessing.Pool(processes)
+            except (OSError, ImportError) as e:
+                logging.warning("Could not start processes slicing meshes, slicing in the calling thread: %s" % e)
+                slice_pool = False
+    return slice_pool or None
+
+def _slice_job(job):
+    vertices, zs = job
+    return slice_layers(vertices, zs)
+
+def slice_mesh(data, layer_height = None, zs = None, processes = None):
+    """Slice an (N, 4, 3) facets array at the heights zs, by default the
+    middle of layers of layer_height, in a shared pool of processes each
+    slicing a range of heights. Return the list of the (z, polygons) of
+    the layers."""
+    vertices = data[:, 1:]
+    if zs is None:
+        zs = layer_heights(data, layer_height)
+    zs = numpy.sort(numpy.asarray(zs, numpy.float64))
+    z = vertices[:, :, 2]
+    zmin = z.min(axis = 1)
+    zmax = z.max(axis = 1)
+    jobs = []
+    for start in xrange(0, len(zs), layers_per_job):
+        job_zs = zs[start:start + layers_per_job]
+        selected = (zmax >= job_zs[0]) & (zmin <= job_zs[-1])
+        jobs.append((vertices[selected], job_zs))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = get_slice_pool(processes) if len(jobs) > 1 else None
+    if pool is None:
+        results = map(_slice_job, jobs)
+    else:
+        results = pool.map(_slice_job, jobs)
+    layers = []
+    for result in results:
+        layers += result
+    return zip(zs.tolist(), layers)
+
+def mesh_bounds(data):
+    """(minx, miny, maxx, maxy) of an (N, 4, 3) facets array"""
+    xy = data[:, 1:, :2].reshape(-1, 2)
+    return tuple(xy.min(axis = 0).tolist() + xy.max(axis = 0).tolist())
+
+def layer_svg(z, polygons, bounds):
+    """SVG element of a layer as read by the DLP projector from Slic3r
+    files, white polygons on black, in millimeters from the corner of
+    bounds seen from above"""
+    minx, miny, maxx, maxy = bounds
+    width = "%f" % (maxx - minx)
+    height = "%f" % (maxy - miny)
+    svg = xml.etree.ElementTree.Element(svg_namespace + "svg")
+    svg.set("height", height + "mm")
+    svg.set("width", width + "mm")
+    svg.set("viewBox", "0 0 " + width + " " + height)
+    svg.set("style", "background-color:black;fill:white;")
+    group = xml.etree.ElementTree.SubElement(svg, svg_namespace + "g")
+    group.set(slic3r_namespace + "z", "%f" % z)
+    path = []
+    for polygon in polygons:
+        points = ["%f %f" % (x - minx, maxy - y) for x, y in polygon.tolist()]
+        path.append("M " + " L ".join(points) + " Z")
+    if path:
+        element = xml.etree.ElementTree.SubElement(group, svg_namespace + "path")
+        element.set("d", " ".join(path))
+        element.set("style", "fill:white;fill-rule:evenodd;stroke:none")
+    return svg
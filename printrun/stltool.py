@@ -16,6 +16,7 @@
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import string
 import struct
 import math
 import logging
@@ -94,67 +95,461 @@ def ray_box_intersection(ray_near, ray_dir, p0, p1):
             return True
     return False
 
-def emitstl(filename, facets = [], objname = "stltool_export", binary = True):
+def ray_triangles_intersection(ray_near, ray_dir, triangles):
+    """Vectorized Möller–Trumbore intersection of a ray with an (N, 3, 3)
+    array of triangles, returning the distances along the ray, inf where
+    a triangle is missed"""
+    eps = 0.000001
+    v1 = triangles[:, 0]
+    edge1 = triangles[:, 1] - v1
+    edge2 = triangles[:, 2] - v1
+    pvec = numpy.cross(ray_dir, edge2)
+    det = (edge1 * pvec).sum(axis = 1)
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+        inv_det = 1. / det
+        tvec = ray_near - v1
+        u = (tvec * pvec).sum(axis = 1) * inv_det
+        qvec = numpy.cross(tvec, edge1)
+        v = qvec.dot(ray_dir) * inv_det
+        t = (edge2 * qvec).sum(axis = 1) * inv_det
+        hit = ((abs(det) >= eps) & (u >= 0.) & (u <= 1.)
+               & (v >= 0.) & (u + v <= 1.) & (t >= eps))
+    return numpy.where(hit, t, float("inf"))
+
+def morton_codes(points):
+    """30 bits Morton codes of points, after scaling their bounding box to
+    a 1024 cells grid"""
+    low = points.min(axis = 0)
+    extent = points.max(axis = 0) - low
+    extent[extent == 0] = 1
+    cells = ((points - low) * (1023. / extent)).astype(numpy.uint32)
+    codes = numpy.zeros(len(points), numpy.uint32)
+    for axis in range(3):
+        x = cells[:, axis]
+        x = (x | (x << 16)) & 0x030000FF
+        x = (x | (x << 8)) & 0x0300F00F
+        x = (x | (x << 4)) & 0x030C30C3
+        x = (x | (x << 2)) & 0x09249249
+        codes |= x << (2 - axis)
+    return codes
+
+class BVH(object):
+    """Bounding volume hierarchy over the triangles of a mesh for ray
+    picking. Triangles are sorted along a Morton curve and cut into leaves
+    of leaf_size triangles, which are the bottom of a complete binary tree
+    of bounding boxes. Rays go down the tree a level at a time, and are then
+    tested against the triangles of the leaves they reach all at once."""
+
+    leaf_size = 16
+
+    def __init__(self, vertices):
+        self.count = len(vertices)
+        self.order = numpy.argsort(morton_codes(vertices.mean(axis = 1)),
+                                   kind = "mergesort")
+        self.triangles = vertices[self.order]
+        nleaves = max(1, -(-self.count // self.leaf_size))
+        nleaves = 1 << (nleaves - 1).bit_length()
+        # Empty leaves get inverted boxes, which rays are never found in
+        low = numpy.empty((nleaves * self.leaf_size, 3), vertices.dtype)
+        high = numpy.empty_like(low)
+        low[self.count:] = float("inf")
+        high[self.count:] = float("-inf")
+        low[:self.count] = self.triangles.min(axis = 1)
+        high[:self.count] = self.triangles.max(axis = 1)
+        low = low.reshape(nleaves, self.leaf_size, 3).min(axis = 1)
+        high = high.reshape(nleaves, self.leaf_size, 3).max(axis = 1)
+        # Boxes of each level of the tree, from the root to the leaves
+        self.levels = [(low, high)]
+        while len(low) > 1:
+            low = low.reshape(-1, 2, 3).min(axis = 1)
+            high = high.reshape(-1, 2, 3).max(axis = 1)
+            self.levels.insert(0, (low, high))
+
+    def intersect(self, ray_near, ray_dir):
+        """Index of the first triangle hit by the ray and its distance along
+        the ray, or None and inf"""
+        # Rays along an axis get a huge rather than infinite inverse, so that
+        # boxes touching their origin on that axis do not give 0 * inf
+        inv_dir = 1. / numpy.where(ray_dir == 0, 1e-300, ray_dir)
+        nodes = numpy.zeros(1, numpy.intp)
+        for depth, (low, high) in enumerate(self.levels):
+            if depth:
+                nodes = (nodes[:, None] * 2 + (0, 1)).ravel()
+            low = low[nodes]
+            high = high[nodes]
+            with numpy.errstate(over = "ignore", invalid = "ignore"):
+                t1 = (low - ray_near) * inv_dir
+                t2 = (high - ray_near) * inv_dir
+            tmin = numpy.minimum(t1, t2).max(axis = 1)
+            tmax = numpy.maximum(t1, t2).min(axis = 1)
+            inside = (low <= high).all(axis = 1)
+            nodes = nodes[inside & (tmax >= numpy.maximum(tmin, 0))]
+            if not len(nodes):
+                return None, float("inf")
+        indices = (nodes[:, None] * self.leaf_size
+                   + numpy.arange(self.leaf_size)).ravel()
+        indices = indices[indices < self.count]
+        dists = ray_triangles_intersection(
+            ray_near, ray_dir, self.triangles[indices].astype(numpy.float64))
+        best = dists.argmin()
+        if dists[best] == float("inf"):
+            return None, float("inf")
+        return int(self.order[indices[best]]), float(dists[best])
+
+def segment_loops(segments):
+    """Chain (start, end) segments into closed loops of points, whatever
+    their direction, dropping the chains that do not close"""
+    neighbours = {}
+    for start, end in segments:
+        neighbours.setdefault(start, []).append(end)
+        neighbours.setdefault(end, []).append(start)
+    loops = []
+    for start in neighbours.keys():
+        while neighbours[start]:
+            loop = [start]
+            point = neighbours[start].pop()
+            neighbours[point].remove(start)
+            while point != start:
+                if not neighbours[point]:
+                    loop = None
+                    break
+                loop.append(point)
+                following = neighbours[point].pop()
+                neighbours[following].remove(point)
+                point = following
+            if loop is not None and len(loop) >= 3:
+                loops.append(loop)
+    return loops
+
+def polygon_area(points):
+    """Signed area of an (N, 2) polygon, positive when counter clockwise"""
+    x = points[:, 0]
+    y = points[:, 1]
+    return 0.5 * (x * numpy.roll(y, -1) - numpy.roll(x, -1) * y).sum()
+
+def points_in_polygon(points, polygon):
+    """Even-odd test of an (N, 2) array of points against an (M, 2)
+    polygon"""
+    x = points[:, 0][:, None]
+    y = points[:, 1][:, None]
+    x0 = polygon[:, 0]
+    y0 = polygon[:, 1]
+    x1 = numpy.roll(x0, -1)
+    y1 = numpy.roll(y0, -1)
+    straddle = (y0 > y) != (y1 > y)
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+        crossing_x = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        return ((straddle & (x < crossing_x)).sum(axis = 1) % 2) == 1
+
+def points_in_triangle(points, a, b, c, strict = True):
+    """Whether (N, 2) points are inside the counter clockwise triangle abc,
+    or on its boundary when not strict"""
+    def side(p, q):
+        return ((q[0] - p[0]) * (points[:, 1] - p[1])
+                - (q[1] - p[1]) * (points[:, 0] - p[0]))
+    if strict:
+        return (side(a, b) > 0) & (side(b, c) > 0) & (side(c, a) > 0)
+    return (side(a, b) >= 0) & (side(b, c) >= 0) & (side(c, a) >= 0)
+
+def cross2(a, b, c):
+    """Twice the signed area of the 2D triangle abc"""
+    return (b[0] - a[0]) * (c[1] - b[1]) - (b[1] - a[1]) * (c[0] - b[0])
+
+def bridge_hole(points, outer, hole):
+    """Merge a clockwise hole into a counter clockwise outer polygon, both
+    lists of indices into the (N, 2) points array, by joining the rightmost
+    vertex of the hole to a vertex of the outer polygon it sees (as
+    described in "Triangulation by Ear Clipping" by David Eberly)"""
+    m = max(range(len(hole)), key = lambda i: points[hole[i], 0])
+    mx, my = points[hole[m]]
+    poly = points[outer]
+    following = numpy.roll(poly, -1, axis = 0)
+    straddle = (poly[:, 1] <= my) != (following[:, 1] <= my)
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+        crossing_x = poly[:, 0] + ((my - poly[:, 1])
+                                   * (following[:, 0] - poly[:, 0])
+                                   / (following[:, 1] - poly[:, 1]))
+    candidates = numpy.nonzero(straddle & (crossing_x >= mx))[0]
+    if len(candidates):
+        edge = candidates[crossing_x[candidates].argmin()]
+        ix = crossing_x[edge]
+        visible = edge if poly[edge, 0] > following[edge, 0] \
+            else (edge + 1) % len(outer)
+        # Reflex vertices inside the triangle formed with the ray may hide
+        # the chosen vertex, the one closest in angle to the ray then wins
+        previous = numpy.roll(poly, 1, axis = 0)
+        turns = ((poly[:, 0] - previous[:, 0]) * (following[:, 1] - poly[:, 1])
+                 - (poly[:, 1] - previous[:, 1]) * (following[:, 0] - poly[:, 0]))
+        a, b = (mx, my), (ix, my)
+        c = tuple(poly[visible])
+        if c[1] < my:
+            a, b = b, a
+        hidden = numpy.nonzero((turns < 0) & points_in_triangle(poly, a, b, c))[0]
+        if len(hidden):
+            dx = poly[hidden, 0] - mx
+            dy = abs(poly[hidden, 1] - my)
+            angles = numpy.arctan2(dy, dx)
+            visible = hidden[numpy.lexsort((dx * dx + dy * dy, angles))[0]]
+    else:
+        dist = ((poly - (mx, my)) ** 2).sum(axis = 1)
+        visible = dist.argmin()
+    visible = int(visible)
+    return (outer[:visible + 1] + hole[m:] + hole[:m + 1]
+            + outer[visible:])
+
+def earclip(points, polygon):
+    """Triangulate a counter clockwise polygon given as a list of indices
+    into the (N, 2) points array, returning index triplets"""
+    polygon = list(polygon)
+    triangles = []
+    i = 0
+    failures = 0
+    while len(polygon) > 3:
+        n = len(polygon)
+        i %= n
+        a = polygon[i - 1]
+        b = polygon[i]
+        c = polygon[(i + 1) % n]
+        pa, pb, pc = points[a], points[b], points[c]
+        ear = cross2(pa, pb, pc) > 0
+        if ear:
+            others = points[polygon]
+            # Vertices on the edges of the ear count too, as clipping it
+            # would leave them in the middle of an edge
+            inside = points_in_triangle(others, pa, pb, pc, strict = False)
+            # The ear vertices, also found twice along hole bridges, do not
+            inside &= ~((others == pa).all(axis = 1)
+                        | (others == pb).all(axis = 1)
+                        | (others == pc).all(axis = 1))
+            ear = not inside.any()
+        # Give up on finding proper ears in polygons made invalid by
+        # rounding rather than looping forever
+        if ear or failures >= n:
+            triangles.append((a, b, c))
+            del polygon[i]
+            failures = 0
+        else:
+            i += 1
+            failures += 1
+    triangles.append(tuple(polygon))
+    return triangles
+
+def triangulate_loops(points, loops):
+    """Triangulate the area enclosed by closed loops of indices into the
+    (N, 2) points array, loops inside an odd number of others being holes.
+    Triangles are counter clockwise."""
+    polygons = [points[loop] for loop in loops]
+    areas = [polygon_area(polygon) for polygon in polygons]
+    depths = []
+    parents = []
+    for i, loop in enumerate(loops):
+        containers = [j for j in range(len(loops)) if j != i
+                      and points_in_polygon(polygons[i][:1], polygons[j])[0]]
+        depths.append(len(containers))
+        parents.append(min(containers, key = lambda j: abs(areas[j]))
+                       if containers else None)
+    outers = {}
+    for i, loop in enumerate(loops):
+        if depths[i] % 2 == 0:
+            outers.setdefault(i, [])
+        elif parents[i] is not None:
+            outers.setdefault(parents[i], []).append(i)
+    triangles = []
+    for i, holes in outers.items():
+        outer = list(loops[i]) if areas[i] > 0 else list(reversed(loops[i]))
+        # Bridging holes from the rightmost one keeps earlier bridges from
+        # crossing later holes
+        holes.sort(key = lambda j: -polygons[j][:, 0].max())
+        for j in holes:
+            hole = list(loops[j]) if areas[j] < 0 else list(reversed(loops[j]))
+            outer = bridge_hole(points, outer, hole)
+        triangles += earclip(points, outer)
+    return triangles
+
+# Layout of the facets of binary STL files
+facet_dtype = numpy.dtype([("normal", "<f4", (3,)),
+                           ("vertices", "<f4", (3, 3)),
+                           ("attributes", "<u2")])
+
+# Tables blanking the keywords of ASCII STL files, keeping only numbers. When
+# numbers have exponents, the e of the keywords is left and removed next.
+ascii_letters = string.ascii_letters
+ascii_keyword_table = string.maketrans(ascii_letters, " " * len(ascii_letters))
+ascii_letters = ascii_letters.replace("e", "").replace("E", "")
+ascii_exponent_table = string.maketrans(ascii_letters, " " * len(ascii_letters))
+del ascii_letters
+
+def binary_stl_facetcount(data):
+    """Number of facets announced by the header of a binary STL file, or
+    None if data is too short to hold them"""
+    if len(data) < 84:
+        return None
+    facetcount = struct.unpack_from("<I", data, 80)[0]
+    if len(data) < 84 + facetcount * facet_dtype.itemsize:
+        return None
+    return facetcount
+
+def is_binary_stl(data):
+    """Whether data holds a binary STL file, telling by its size since the
+    header of binary files may also start with solid. Some exporters pad
+    binary files, so larger files are binary too unless they start with
+    ASCII facets."""
+    facetcount = binary_stl_facetcount(data)
+    if facetcount is None:
+        return False
+    if len(data) == 84 + facetcount * facet_dtype.itemsize:
+        return True
+    return "facet normal" not in data[:1024]
+
+def facets_to_array(facets):
+    """Convert a list of (normal, (v1, v2, v3)) facets to an (N, 4, 3)
+    array holding the normal then the vertices of each facet"""
+    data = numpy.zeros((len(facets), 4, 3), numpy.float32)
+    if facets:
+        data[:, 0] = [facet[0] for facet in facets]
+        data[:, 1:] = [list(facet[1]) for facet in facets]
+    return data
+
+def vertices_to_array(vertices):
+    """(N, 4, 3) facets array of an (N, 3, 3) array of triangles"""
+    data = numpy.empty((len(vertices), 4, 3), numpy.float32)
+    data[:, 0] = array_normals(vertices)
+    data[:, 1:] = vertices
+    return data
+
+def transform_facets(data, m = I):
+    """Apply the 4x4 matrix m to an (N, 4, 3) facets array, returning a new
+    array with recomputed normals"""
+    m = numpy.asarray(m, numpy.float64)
+    vertices = data[:, 1:].astype(numpy.float64)
+    return vertices_to_array(vertices.dot(m[:3, :3].T) + m[:3, 3])
+
+def array_normals(vertices):
+    """Unit normals of an (N, 3, 3) array of triangles, zero for degenerate
+    ones"""
+    normals = numpy.cross(vertices[:, 1] - vertices[:, 0],
+                          vertices[:, 2] - vertices[:, 1])
+    lengths = numpy.sqrt((normals * normals).sum(axis = 1))
+    lengths[lengths == 0] = 1
+    return normals / lengths[:, None]
+
+# Facets written at once when exporting, bounding the memory used for
+# conversions
+export_chunk = 65536
+
+ascii_facet_format = ("  facet normal %.9g %.9g %.9g\n"
+                      "   outer loop\n"
+                      "    vertex %.9g %.9g %.9g\n"
+                      "    vertex %.9g %.9g %.9g\n"
+                      "    vertex %.9g %.9g %.9g\n"
+                      "   endloop\n"
+                      "  endfacet\n")
+
+def write_binary_facets(f, data):
+    """Write an (N, 4, 3) facets array to f as binary STL records"""
+    records = numpy.zeros(min(len(data), export_chunk), facet_dtype)
+    for start in xrange(0, len(data), export_chunk):
+        chunk = data[start:start + export_chunk]
+        records = records[:len(chunk)]
+        records["normal"] = chunk[:, 0]
+        records["vertices"] = chunk[:, 1:]
+        f.write(memoryview(records))
+
+def write_ascii_facets(f, data):
+    """Write an (N, 4, 3) facets array to f as ASCII STL facets"""
+    for start in xrange(0, len(data), export_chunk):
+        chunk = data[start:start + export_chunk]
+        f.write((ascii_facet_format * len(chunk))
+                % tuple(chunk.ravel().tolist()))
+
+def emitmeshes(filename, meshes, objname = "stltool_export", binary = True):
+    """Write the (N, 4, 3) facets arrays yielded by meshes one after the
+    other to filename as a single solid, without ever holding them all"""
     if filename is None:
         return
+    count = 0
     if binary:
         with open(filename, "wb") as f:
-            buf = "".join(["\0"] * 80)
-            buf += struct.pack("<I", len(facets))
-            facetformat = struct.Struct("<ffffffffffffH")
-            for facet in facets:
-                l = list(facet[0][:])
-                for vertex in facet[1]:
-                    l += list(vertex[:])
-                l.append(0)
-                buf += facetformat.pack(*l)
-            f.write(buf)
+            # The facet count is only known once all meshes are written
+            f.write("\0" * 84)
+            for data in meshes:
+                write_binary_facets(f, data)
+                count += len(data)
+            f.seek(80)
+            f.write(struct.pack("<I", count))
     else:
         with open(filename, "w") as f:
             f.write("solid " + objname + "\n")
-            for i in facets:
-                f.write("  facet normal " + " ".join(map(str, i[0])) + "\n   outer loop\n")
-                for j in i[1]:
-                    f.write("    vertex " + " ".join(map(str, j)) + "\n")
-                f.write("   endloop" + "\n")
-                f.write("  endfacet" + "\n")
+            for data in meshes:
+                write_ascii_facets(f, data)
             f.write("endsolid " + objname + "\n")
 
+def emitstl(filename, facets = [], objname = "stltool_export", binary = True):
+    """Write facets, a list of (normal, (v1, v2, v3)) tuples or an (N, 4, 3)
+    array, to filename"""
+    if not isinstance(facets, numpy.ndarray):
+        facets = facets_to_array(facets)
+    emitmeshes(filename, [facets], objname, binary)
+
 class stl(object):
+    """Triangle mesh, stored in data as an (N, 4, 3) float32 array holding
+    the normal then the three vertices of each facet. The facets list of
+    (normal, (v1, v2, v3)) tuples is built from it when first accessed, and
+    assigning it replaces the mesh."""
 
     _dims = None
+    _bvh = None
+    _data = None
+    _facets = None
+
+    def _get_data(self):
+        if self._data is None:
+            self._data = facets_to_array(self._facets or [])
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+        self._facets = None
+        self._dims = None
+        self._bvh = None
+    data = property(_get_data, _set_data)
+
+    def _get_facets(self):
+        if self._facets is None:
+            self._facets = [(facet[0], (facet[1], facet[2], facet[3]))
+                            for facet in self.data]
+        return self._facets
+
+    def _set_facets(self, facets):
+        self._facets = facets
+        self._data = None
+        self._dims = None
+        self._bvh = None
+    facets = property(_get_facets, _set_facets)
+
+    def _get_facetsminz(self):
+        return zip(self.data[:, 1:, 2].min(axis = 1).tolist(), self.facets)
+    facetsminz = property(_get_facetsminz)
+
+    def _get_facetsmaxz(self):
+        return zip(self.data[:, 1:, 2].max(axis = 1).tolist(), self.facets)
+    facetsmaxz = property(_get_facetsmaxz)
 
     def _get_dims(self):
         if self._dims is None:
-            minx = float("inf")
-            miny = float("inf")
-            minz = float("inf")
-            maxx = float("-inf")
-            maxy = float("-inf")
-            maxz = float("-inf")
-            for normal, facet in self.facets:
-                for vert in facet:
-                    if vert[0] < minx:
-                        minx = vert[0]
-                    if vert[1] < miny:
-                        miny = vert[1]
-                    if vert[2] < minz:
-                        minz = vert[2]
-                    if vert[0] > maxx:
-                        maxx = vert[0]
-                    if vert[1] > maxy:
-                        maxy = vert[1]
-                    if vert[2] > maxz:
-                        maxz = vert[2]
-            self._dims = [minx, maxx, miny, maxy, minz, maxz]
+            vertices = self.data[:, 1:].reshape(-1, 3)
+            if not len(vertices):
+                inf = float("inf")
+                return [inf, -inf, inf, -inf, inf, -inf]
+            mins = vertices.min(axis = 0).tolist()
+            maxs = vertices.max(axis = 0).tolist()
+            self._dims = [mins[0], maxs[0], mins[1], maxs[1], mins[2], maxs[2]]
         return self._dims
     dims = property(_get_dims)
 
     def __init__(self, filename = None):
         self.facet = (numpy.zeros(3), (numpy.zeros(3), numpy.zeros(3), numpy.zeros(3)))
         self.facets = []
-        self.facetsminz = []
-        self.facetsmaxz = []
 
         self.name = ""
         self.insolid = 0
@@ -163,39 +558,68 @@ class stl(object):
         self.facetloc = 0
         if filename is None:
             return
-        with open(filename) as f:
+        with open(filename, "rb") as f:
             data = f.read()
-        if "facet normal" in data[1:300] and "outer loop" in data[1:300]:
-            lines = data.split("\n")
-            for line in lines:
-                if not self.parseline(line):
-                    return
+        if is_binary_stl(data):
+            self.name = "binary soloid"
+            self.data = self._parse_binary(data)
+        elif data.lstrip()[:5] == "solid" or "facet normal" in data[:1024]:
+            self.data = self._parse_ascii(data)
+            if not len(self.data) and binary_stl_facetcount(data):
+                logging.warning("No facets in ascii stl solid - attempting to parse as binary")
+                self.name = "binary soloid"
+                self.data = self._parse_binary(data)
         else:
             logging.warning("Not an ascii stl solid - attempting to parse as binary")
-            f = open(filename, "rb")
-            buf = f.read(84)
-            while len(buf) < 84:
-                newdata = f.read(84 - len(buf))
-                if not len(newdata):
-                    break
-                buf += newdata
-            facetcount = struct.unpack_from("<I", buf, 80)
-            facetformat = struct.Struct("<ffffffffffffH")
-            for i in xrange(facetcount[0]):
-                buf = f.read(50)
-                while len(buf) < 50:
-                    newdata = f.read(50 - len(buf))
-                    if not len(newdata):
-                        break
-                    buf += newdata
-                fd = list(facetformat.unpack(buf))
-                self.name = "binary soloid"
-                facet = [fd[:3], [fd[3:6], fd[6:9], fd[9:12]]]
-                self.facets.append(facet)
-                self.facetsminz.append((min(map(lambda x: x[2], facet[1])), facet))
-                self.facetsmaxz.append((max(map(lambda x: x[2], facet[1])), facet))
-            f.close()
-            return
+            self.name = "binary soloid"
+            self.data = self._parse_binary(data)
+        if not len(self.data):
+            logging.warning("No facets found in %s" % filename)
+
+    def _parse_ascii(self, data):
+        """Parse the first solid of an ASCII STL file by dropping the
+        keywords and reading all the numbers at once, falling back to line
+        by line parsing for files not laid out as expected"""
+        start = data.find("solid")
+        if start < 0:
+            return self._parse_ascii_lines(data)
+        header_end = data.find("\n", start)
+        if header_end < 0:
+            return self._parse_ascii_lines(data)
+        end = data.find("endsolid", header_end)
+        if end < 0:
+            end = len(data)
+        body = data[header_end:end]
+        facetcount = body.count("endfacet")
+        if "e-" in body or "e+" in body or "E-" in body or "E+" in body:
+            body = body.translate(ascii_exponent_table)
+            body = body.replace(" e ", " ")
+        else:
+            body = body.translate(ascii_keyword_table)
+        values = numpy.fromstring(body, numpy.float32, sep = " ")
+        if not facetcount or values.size != 12 * facetcount:
+            return self._parse_ascii_lines(data)
+        self.name = data[start + 6:header_end].strip()
+        return values.reshape(-1, 4, 3)
+
+    def _parse_ascii_lines(self, data):
+        self.facets = []
+        for line in data.split("\n"):
+            if not self.parseline(line):
+                break
+        return facets_to_array(self.facets)
+
+    def _parse_binary(self, data):
+        if len(data) < 84:
+            return numpy.zeros((0, 4, 3), numpy.float32)
+        facetcount = struct.unpack_from("<I", data, 80)[0]
+        # Truncated files keep their complete facets
+        facetcount = min(facetcount, (len(data) - 84) // facet_dtype.itemsize)
+        records = numpy.frombuffer(data, facet_dtype, facetcount, 84)
+        facets = numpy.empty((facetcount, 4, 3), numpy.float32)
+        facets[:, 0] = records["normal"]
+        facets[:, 1:] = records["vertices"]
+        return facets
 
     def intersect_box(self, ray_near, ray_far):
         ray_near = numpy.array(ray_near)
@@ -210,17 +634,13 @@ class stl(object):
         ray_near = numpy.array(ray_near)
         ray_far = numpy.array(ray_far)
         ray_dir = normalize(ray_far - ray_near)
-        best_facet = None
-        best_dist = float("inf")
-        for facet_i, (normal, facet) in enumerate(self.facets):
-            match, dist = ray_triangle_intersection(ray_near, ray_dir, facet)
-            if match and dist < best_dist:
-                best_facet = facet_i
-                best_dist = dist
-        return best_facet, best_dist
+        if self._bvh is None:
+            self._bvh = BVH(self.data[:, 1:])
+        return self._bvh.intersect(ray_near, ray_dir)
 
     def rebase(self, facet_i):
-        normal, facet = self.facets[facet_i]
+        normal = self.data[facet_i, 0].astype(numpy.float64)
+        facet = self.data[facet_i, 1:].astype(numpy.float64)
         u1 = facet[1] - facet[0]
         v2 = facet[2] - facet[0]
         n1 = u1.dot(u1)
@@ -246,28 +666,95 @@ class stl(object):
         return newmodel
 
     def cut(self, axis, direction, dist):
+        """Keep the part of the mesh below dist along axis (direction 1) or
+        above it (direction -1). Facets crossing the plane are split, and
+        the cross-section is closed by a cap."""
+        vertices = self.data[:, 1:].astype(numpy.float64)
+        # Signed distances to the plane, positive on the kept side
+        sides = direction * (dist - vertices[:, :, axis])
+        outside = sides < 0
+        noutside = outside.sum(axis = 1)
+        whole = vertices[noutside == 0]
+        crossing = (noutside == 1) | (noutside == 2)
+        vertices = vertices[crossing]
+        sides = sides[crossing]
+        single_out = noutside[crossing] == 1
+        # Rotate the facets, keeping their orientation, so that the vertex
+        # alone on its side of the plane comes first
+        alone = numpy.where(single_out, outside[crossing].argmax(axis = 1),
+                            outside[crossing].argmin(axis = 1))
+        order = (alone[:, None] + numpy.arange(3)) % 3
+        rows = numpy.arange(len(order))[:, None]
+        vertices = vertices[rows, order]
+        sides = sides[rows, order]
+        a, b, c = vertices[:, 0], vertices[:, 1], vertices[:, 2]
+        sa, sb, sc = sides[:, 0], sides[:, 1], sides[:, 2]
+
+        def split(p, q, sp, sq):
+            # Intersections are computed from the kept end of the edge so
+            # that both facets sharing it get the exact same point
+            keep_p = (sp >= 0)[:, None]
+            inner = numpy.where(keep_p, p, q)
+            outer = numpy.where(keep_p, q, p)
+            s_inner = numpy.where(keep_p[:, 0], sp, sq)
+            s_outer = numpy.where(keep_p[:, 0], sq, sp)
+            point = inner + (outer - inner) * (s_inner / (s_inner - s_outer))[:, None]
+            point[:, axis] = dist
+            point[s_inner == 0] = inner[s_inner == 0]
+            return point
+        ab = split(a, b, sa, sb)
+        ac = split(a, c, sa, sc)
+        one = single_out
+        two = ~single_out
+        pieces = numpy.concatenate([
+            numpy.stack([ab[one], b[one], c[one]], axis = 1),
+            numpy.stack([ab[one], c[one], ac[one]], axis = 1),
+            numpy.stack([a[two], ab[two], ac[two]], axis = 1),
+        ])
+        pieces = numpy.concatenate([pieces, self._cap(ab, ac, axis, direction)])
+        normals = numpy.cross(pieces[:, 1] - pieces[:, 0],
+                              pieces[:, 2] - pieces[:, 1])
+        pieces = pieces[(normals != 0).any(axis = 1)]
+        return self._derive(numpy.concatenate([whole, pieces]))
+
+    def _cap(self, starts, ends, axis, direction):
+        """Triangles closing the loops formed by the segments of a cut
+        along axis, facing away from the kept side"""
+        # Points are matched once rounded, for meshes whose facets do not
+        # share exactly the same vertices
+        keys = []
+        for array in (starts, ends):
+            keys.append(map(tuple, numpy.round(array, 5).tolist()))
+        points = {}
+        for key, point in zip(keys[0] + keys[1], numpy.concatenate([starts, ends])):
+            points.setdefault(key, point)
+        segments = [segment for segment in zip(keys[0], keys[1])
+                    if segment[0] != segment[1]]
+        loops = segment_loops(segments)
+        if sum(len(loop) for loop in loops) < len(segments):
+            logging.warning("Some of the cut could not be capped as the mesh is not closed")
+        indices = {}
+        index_loops = []
+        for loop in loops:
+            index_loops.append([indices.setdefault(key, len(indices))
+                                for key in loop])
+        points_array = numpy.empty((len(indices), 3))
+        for key, i in indices.iteritems():
+            points_array[i] = points[key]
+        points = points_array
+        # Plane axes such that counter clockwise turns face up the cut axis
+        planar = points[:, [(axis + 1) % 3, (axis + 2) % 3]]
+        triangles = triangulate_loops(planar, index_loops)
+        triangles = numpy.array(triangles, numpy.intp).reshape(-1, 3)
+        if direction != 1:
+            triangles = triangles[:, ::-1]
+        return points[triangles]
+
+    def _derive(self, vertices):
+        """New mesh of this name made of the (N, 3, 3) vertices array"""
         s = stl()
-        s.facets = []
-        f = min if direction == 1 else max
-        for _, facet in self.facets:
-            minval = f([vertex[axis] for vertex in facet])
-            if direction * minval > direction * dist:
-                continue
-            vertices = []
-            for vertex in facet:
-                vertex = numpy.copy(vertex)
-                if direction * (vertex[axis] - dist) > 0:
-                    vertex[axis] = dist
-                vertices.append(vertex)
-            s.facets.append(genfacet(vertices))
-        s.insolid = 0
-        s.infacet = 0
-        s.inloop = 0
-        s.facetloc = 0
+        s.data = vertices_to_array(vertices)
         s.name = self.name
-        for facet in s.facets:
-            s.facetsminz += [(min(map(lambda x:x[2], facet[1])), facet)]
-            s.facetsmaxz += [(max(map(lambda x:x[2], facet[1])), facet)]
         return s
 
     def translation_matrix(self, v):
@@ -321,26 +808,13 @@ class stl(object):
 
     def transform(self, m = I):
         s = stl()
-        s.facets = [applymatrix(i, m) for i in self.facets]
-        s.insolid = 0
-        s.infacet = 0
-        s.inloop = 0
-        s.facetloc = 0
+        s.data = transform_facets(self.data, m)
         s.name = self.name
-        for facet in s.facets:
-            s.facetsminz += [(min(map(lambda x:x[2], facet[1])), facet)]
-            s.facetsmaxz += [(max(map(lambda x:x[2], facet[1])), facet)]
         return s
 
     def export(self, f = sys.stdout):
         f.write("solid " + self.name + "\n")
-        for i in self.facets:
-            f.write("  facet normal " + " ".join(map(str, i[0])) + "\n")
-            f.write("   outer loop" + "\n")
-            for j in i[1]:
-                f.write("    vertex " + " ".join(map(str, j)) + "\n")
-            f.write("   endloop" + "\n")
-            f.write("  endfacet" + "\n")
+        write_ascii_facets(f, self.data)
         f.write("endsolid " + self.name + "\n")
         f.flush()
 
@@ -361,9 +835,6 @@ class stl(object):
         elif l.startswith("endfacet"):
             self.infacet = 0
             self.facets.append(self.facet)
-            facet = self.facet
-            self.facetsminz += [(min(map(lambda x:x[2], facet[1])), facet)]
-            self.facetsmaxz += [(max(map(lambda x:x[2], facet[1])), facet)]
         elif l.startswith("vertex"):
             l = l.replace(", ", ".")
             self.facet[1][self.facetloc][:] = numpy.array(map(float, l.split()[1:]))
@@ -32,7 +32,9 @@ from pyglet.gl import GL_AMBIENT_AND_DIFFUSE, glBegin, glClearColor, \
     glGetDoublev, GL_MODELVIEW_MATRIX, GLdouble, glClearDepth, glDepthFunc, \
     GL_LEQUAL, GL_BLEND, glBlendFunc, GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA, \
     GL_LINE_LOOP, glGetFloatv, GL_LINE_WIDTH, glLineWidth, glDisable, \
-    GL_LINE_SMOOTH
+    GL_LINE_SMOOTH, glEnableClientState, glDisableClientState, \
+    GL_VERTEX_ARRAY, GL_NORMAL_ARRAY, glVertexPointer, glNormalPointer, \
+    glDrawArrays, GL_FLOAT
 from pyglet import gl
 
 from .gl.panel import wxGLPanel
@@ -43,27 +45,41 @@ def vec(*args):
     return (GLfloat * len(args))(*args)
 
 class stlview(object):
-    def __init__(self, facets, batch):
-        # Create the vertex and normal arrays.
-        vertices = []
-        normals = []
-
-        for i in facets:
-            for j in i[1]:
-                vertices.extend(j)
-                normals.extend(i[0])
-
-        # Create a list of triangle indices.
-        indices = range(3 * len(facets))  # [[3*i, 3*i+1, 3*i+2] for i in xrange(len(facets))]
-        self.vertex_list = batch.add_indexed(len(vertices) // 3,
-                                             GL_TRIANGLES,
-                                             None,  # group,
-                                             indices,
-                                             ('v3f/static', vertices),
-                                             ('n3f/static', normals))
+    """GL buffer of the facets of a mesh, drawn as non indexed triangles.
+    Models sharing the same facets array, as duplicates on the plate do,
+    share one instance and so upload their geometry once."""
+
+    def __init__(self, data):
+        self.data = data
+        self.count = 3 * len(data)
+        self.buffer = None
+
+    def init(self):
+        # Interleaved vertex and normal of each corner of the facets
+        corners = numpy.empty((len(self.data), 3, 2, 3), numpy.float32)
+        corners[:, :, 0] = self.data[:, 1:]
+        corners[:, :, 1] = self.data[:, None, 0]
+        self.buffer = actors.numpy2vbo(corners)
+
+    def draw(self):
+        if not self.count:
+            return
+        if self.buffer is None:
+            self.init()
+        self.buffer.bind()
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_NORMAL_ARRAY)
+        glVertexPointer(3, GL_FLOAT, 24, self.buffer.ptr)
+        glNormalPointer(GL_FLOAT, 24, self.buffer.ptr + 12)
+        glDrawArrays(GL_TRIANGLES, 0, self.count)
+        glDisableClientState(GL_NORMAL_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        self.buffer.unbind()
 
     def delete(self):
-        self.vertex_list.delete()
+        if self.buffer is not None:
+            self.buffer.delete()
+            self.buffer = None
 
 class StlViewPanel(wxGLPanel):
 
@@ -260,9 +276,10 @@ class StlViewPanel(wxGLPanel):
         wx.CallAfter(self.Refresh)
 
     def prepare_model(self, m, scale):
-        batch = pyglet.graphics.Batch()
-        stlview(m.facets, batch = batch)
-        m.batch = batch
+        # Duplicated models keep the buffer of the model they copy
+        glmesh = getattr(m, "glmesh", None)
+        if glmesh is None or glmesh.data is not m.data:
+            m.glmesh = stlview(m.data)
         # m.animoffset = 300
         # threading.Thread(target = self.anim, args = (m, )).start()
         wx.CallAfter(self.Refresh)
@@ -317,7 +334,7 @@ class StlViewPanel(wxGLPanel):
             glRotatef(model.rot, 0.0, 0.0, 1.0)
             glTranslatef(*(model.centeroffset))
             glScalef(*model.scale)
-            model.batch.draw()
+            model.glmesh.draw()
             glPopMatrix()
         glPopMatrix()
         glEnable(GL_CULL_FACE)
@@ -166,7 +166,7 @@ setup(name = "Printrun",
       license = "GPLv3",
       data_files = data_files,
       packages = ["printrun", "printrun.gl", "printrun.gl.libtatlin", "printrun.gui", "printrun.power"],
-      scripts = ["pronsole.py", "pronterface.py", "plater.py", "printcore.py"],
+      scripts = ["pronsole.py", "pronterface.py", "plater.py", "printcore.py", "gcoderender.py"],
       cmdclass = cmdclass,
       ext_modules = extensions,
       )
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Time G-Code parsing and 3D viewer mesh building, without opening any
+# window. Run it on the same file before and after a change to compare.
+# The md5 sums of the generated buffers tell whether the output changed.
+# Passing "zigzag" instead of a file times a generated print of many small
+# layers of zigzag infill, which is what slows down the per-layer steps.
+# The time spent in each of the mesh building steps is then shown for a
+# build without the process pool.
+
+import sys
+import os
+import time
+import hashlib
+import cProfile
+import pstats
+
+import pyglet
+pyglet.options['shadow_window'] = False
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.gl.libtatlin import actors, meshes
+
+if len(sys.argv) < 2:
+    print "Usage: %s file.gcode|zigzag [runs] [build processes]" % sys.argv[0]
+    sys.exit(1)
+runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+if len(sys.argv) > 3:
+    actors.GcodeModel.build_processes = int(sys.argv[3])
+# Time meshing rather than the mesh cache
+actors.GcodeModel.use_mesh_cache = False
+# Start the mesh building processes before timing
+actors.get_mesh_pool(actors.GcodeModel.build_processes)
+
+def zigzag_gcode(nlayers = 400, nlines = 46):
+    lines = ["G21", "G90", "M82", "G92 E0"]
+    e = 0
+    for layer in range(nlayers):
+        lines.append("G1 Z%.2f F3000" % (0.2 * (layer + 1)))
+        lines.append("G1 X10 Y10 F6000")
+        for line in range(nlines):
+            e += 0.5
+            lines.append("G1 X%d Y%.2f E%.2f F1800" %
+                         (10 + 20 * (line % 2), 10 + 0.5 * line, e))
+    return lines
+
+start = time.time()
+if sys.argv[1] == "zigzag":
+    gcode = gcoder.GCode(zigzag_gcode())
+else:
+    gcode = gcoder.GCode(open(sys.argv[1], "rU"))
+nmoves = sum(1 for line in gcode.lines if line.is_move)
+print "Parsed %d lines (%d moves, %d layers) in %.2fs" % \
+    (len(gcode), nmoves, len(gcode.all_layers), time.time() - start)
+
+for model_class in (actors.GcodeModel, actors.GcodeModelLight):
+    timings = []
+    for run in range(runs):
+        model = model_class()
+        start = time.time()
+        for layer in model.load_data(gcode):
+            pass
+        timings.append(time.time() - start)
+    digest = hashlib.md5()
+    nbytes = 0
+    for name in ("travels", "vertices", "normals", "colors", "indices"):
+        if hasattr(model, name):
+            digest.update(getattr(model, name).tostring())
+            nbytes += getattr(model, name).nbytes
+    best = min(timings)
+    print "%s: %.3fs (%.0f moves/s), buffers %.1fMB md5 %s" % \
+        (model_class.__name__, best, nmoves / best if best else 0,
+         nbytes / 1e6, digest.hexdigest())
+
+# Gathering moves and building their tubes alone, without the simplified
+# lines, culling boxes and vertex packing GcodeModel adds on top of them
+if gcode.move_arrays_current():
+    model = actors.GcodeModel()
+    timings = []
+    for run in range(runs):
+        start = time.time()
+        layer_moves = meshes.LayerMoves(gcode)
+        state = (0, (0, 0, 0), False, 0.0, 0.0, 0.0)
+        for layer_idx in range(len(gcode.all_layers)):
+            (glines, extruding, next_extruding, positions, position_counts,
+             tools) = layer_moves.layer(layer_idx, state[1], model.arc_tolerance)
+            if glines:
+                colors = model.movement_colors(glines, extruding, tools)
+                state = meshes.build_layer_mesh(
+                    positions, position_counts, extruding, next_extruding,
+                    colors[:, :3], state, model.path_halfwidth * 1.2,
+                    model.path_halfheight * 1.2)[-1]
+        timings.append(time.time() - start)
+    best = min(timings)
+    print "Tubes only: %.3fs (%.0f moves/s)" % (best, nmoves / best if best else 0)
+
+# Steps of a build in this process, slowest first
+actors.GcodeModel.build_processes = 0
+model = actors.GcodeModel()
+profile = cProfile.Profile()
+profile.enable()
+for layer in model.load_data(gcode):
+    pass
+profile.disable()
+stats = pstats.Stats(profile)
+steps = [(function[2], stat[3]) for function, stat in stats.stats.items()
+         if function[0].endswith("meshes.py")]
+steps.sort(key = lambda step: -step[1])
+print "Serial build: %.3fs, of which" % stats.total_tt
+for name, seconds in steps[:6]:
+    print "  %s: %.3fs" % (name, seconds)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Time STL loading. ASCII files are also loaded line by line to compare
+# with the bulk parser. Pass an ASCII output path to first write an ASCII
+# copy of the file (for instance of a large binary one) and time that copy.
+# The md5 sum of the loaded mesh tells whether the output changed.
+
+import sys
+import os
+import time
+import hashlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import stltool
+
+if len(sys.argv) < 2:
+    print "Usage: %s file.stl [runs] [ascii copy.stl]" % sys.argv[0]
+    sys.exit(1)
+path = sys.argv[1]
+runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+if len(sys.argv) > 3:
+    start = time.time()
+    with open(sys.argv[3], "w") as f:
+        stltool.stl(path).export(f)
+    path = sys.argv[3]
+    print "Wrote ASCII copy %s in %.2fs" % (path, time.time() - start)
+
+size = os.path.getsize(path)
+
+def bench(load):
+    timings = []
+    for run in range(runs):
+        start = time.time()
+        data = load()
+        timings.append(time.time() - start)
+    best = min(timings)
+    return data, best
+
+def load_lines():
+    with open(path, "rb") as f:
+        return stltool.stl()._parse_ascii_lines(f.read())
+
+data, best = bench(lambda: stltool.stl(path).data)
+print "Loaded %d facets from %.1fMB in %.3fs (%.1fMB/s), md5 %s" % \
+    (len(data), size / 1e6, best, size / 1e6 / best if best else 0,
+     hashlib.md5(data.tostring()).hexdigest())
+with open(path, "rb") as f:
+    binary = stltool.is_binary_stl(f.read())
+if not binary:
+    data, best = bench(load_lines)
+    print "Line by line: %.3fs (%.1fMB/s), md5 %s" % \
+        (best, size / 1e6 / best if best else 0,
+         hashlib.md5(data.tostring()).hexdigest())